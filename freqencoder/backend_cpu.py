@@ -0,0 +1,28 @@
+import torch
+
+# Pure PyTorch implementation of the `_freqencoder` bindings, used when CUDA is not available.
+# Functions mirror the signatures in `src/bindings.cpp` and write into the pre-allocated outputs.
+# Layout per row: [x (D), sin(2^0 x) (D), cos(2^0 x) (D), ..., sin(2^(deg-1) x) (D), cos(2^(deg-1) x) (D)]
+
+
+def freq_encode_forward(inputs, B, D, deg, C, outputs):
+    # inputs: [B, D], float
+    # outputs: [B, C], C = D + D * deg * 2
+    freqs = torch.exp2(torch.arange(deg, dtype=inputs.dtype, device=inputs.device)) # [deg]
+    x = inputs.unsqueeze(1) * freqs.unsqueeze(-1) # [B, deg, D]
+
+    outputs[:, :D] = inputs
+    outputs[:, D:].view(B, deg, 2, D).copy_(torch.stack([torch.sin(x), torch.cos(x)], dim=2))
+
+
+def freq_encode_backward(grad, outputs, B, D, deg, C, grad_inputs):
+    # grad: [B, C]
+    # outputs: [B, C], saved forward outputs, reused as sin/cos
+    # grad_inputs: [B, D]
+    freqs = torch.exp2(torch.arange(deg, dtype=grad.dtype, device=grad.device)).view(1, deg, 1)
+
+    grad_sc = grad[:, D:].view(B, deg, 2, D)
+    sc = outputs[:, D:].view(B, deg, 2, D)
+
+    # d sin(f x) = f cos(f x), d cos(f x) = - f sin(f x)
+    grad_inputs.copy_(grad[:, :D] + (freqs * (grad_sc[:, :, 0] * sc[:, :, 1] - grad_sc[:, :, 1] * sc[:, :, 0])).sum(1))
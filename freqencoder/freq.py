@@ -6,10 +6,14 @@ from torch.autograd import Function
 from torch.autograd.function import once_differentiable
 from torch.cuda.amp import custom_bwd, custom_fwd 
 
-try:
-    import _freqencoder as _backend
-except ImportError:
-    from .backend import _backend
+if torch.cuda.is_available():
+    try:
+        import _freqencoder as _backend
+    except ImportError:
+        from .backend import _backend
+else:
+    # no GPU, fall back to the pure PyTorch implementation (same interface as the CUDA bindings).
+    from . import backend_cpu as _backend
 
 
 class _freq_encoder(Function):
@@ -19,7 +23,7 @@ class _freq_encoder(Function):
         # inputs: [B, input_dim], float 
         # RETURN: [B, F], float
 
-        if not inputs.is_cuda: inputs = inputs.cuda()
+        if torch.cuda.is_available() and not inputs.is_cuda: inputs = inputs.cuda()
         inputs = inputs.contiguous()
 
         B, input_dim = inputs.shape # batch size, coord dim
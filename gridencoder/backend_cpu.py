@@ -0,0 +1,189 @@
+import numpy as np
+
+import torch
+
+# Pure PyTorch implementation of the `_gridencoder` bindings, used when CUDA is not available.
+# Functions mirror the signatures in `src/bindings.cpp` and write into the pre-allocated outputs.
+# Inputs are processed level by level in chunks of `CHUNK_SIZE` points, so peak memory does not grow with the batch size.
+
+CHUNK_SIZE = 65536
+
+PRIMES = [1, 2654435761, 805459861, 3674653429, 2097192037, 1434869437, 2165219737]
+
+
+def _level_meta(offsets, level, S, H):
+    # same float32 arithmetic as the kernels
+    hashmap_size = int(offsets[level + 1] - offsets[level])
+    scale = float(np.float32(np.exp2(np.float32(level * np.float32(S)))) * np.float32(H) - np.float32(1.0))
+    resolution = int(np.ceil(scale)) + 1
+    return hashmap_size, scale, resolution
+
+
+def _grid_index(pos_grid, gridtype, align_corners, hashmap_size, resolution):
+    # pos_grid: int64, [b, D] --> int64, [b], row index into this level's embeddings
+    D = pos_grid.shape[1]
+
+    stride = 1
+    index = torch.zeros_like(pos_grid[:, 0])
+    for d in range(D):
+        if stride > hashmap_size:
+            break
+        index = index + pos_grid[:, d] * stride
+        stride *= resolution if align_corners else (resolution + 1)
+
+    # gridtype: 0 == hash, 1 == tiled
+    if gridtype == 0 and stride > hashmap_size:
+        index = torch.zeros_like(pos_grid[:, 0])
+        for d in range(D):
+            index = index ^ ((pos_grid[:, d] * PRIMES[d]) & 0xFFFFFFFF)
+
+    return (index & 0xFFFFFFFF) % hashmap_size
+
+
+def _locate(inputs, scale, align_corners, interp):
+    # inputs: float, [b, D] --> pos_grid: int64, [b, D], pos / pos_deriv: float, [b, D]
+    pos = inputs * scale + (0.0 if align_corners else 0.5)
+    pos_floor = torch.floor(pos)
+    pos = pos - pos_floor
+    pos_grid = pos_floor.long()
+
+    # smoothstep instead of linear
+    if interp == 1:
+        pos_deriv = 6 * pos * (1.0 - pos)
+        pos = pos * pos * (3.0 - 2.0 * pos)
+    else:
+        pos_deriv = torch.ones_like(pos)
+
+    return pos_grid, pos, pos_deriv
+
+
+def _corners(pos_grid, pos):
+    # yield (corner id, corner grid position, trilinear weight) for the 2^D corners.
+    D = pos_grid.shape[1]
+    for idx in range(1 << D):
+        bits = torch.tensor([(idx >> d) & 1 for d in range(D)], dtype=pos_grid.dtype, device=pos_grid.device)
+        w = torch.where(bits.bool(), pos, 1 - pos).prod(-1)
+        yield idx, pos_grid + bits, w
+
+
+def _in_bound(inputs):
+    return ((inputs >= 0) & (inputs <= 1)).all(-1)
+
+
+def grid_encode_forward(inputs, embeddings, offsets, outputs, B, D, C, L, S, H, dy_dx, gridtype, align_corners, interp):
+    # inputs: [B, D], float, in [0, 1]
+    # embeddings: [sO, C], float
+    # offsets: [L + 1], int
+    # outputs: [L, B, C], float
+    # dy_dx: [B, L * D * C] or None
+    offsets = offsets.tolist()
+    inputs = inputs.float()
+
+    if dy_dx is not None:
+        dy_dx_view = dy_dx.view(B, L, D, C)
+
+    for level in range(L):
+        hashmap_size, scale, resolution = _level_meta(offsets, level, S, H)
+        grid = embeddings[offsets[level]:offsets[level + 1]].float()
+
+        for b0 in range(0, B, CHUNK_SIZE):
+            b1 = min(b0 + CHUNK_SIZE, B)
+            x = inputs[b0:b1]
+            valid = _in_bound(x).unsqueeze(-1)
+
+            pos_grid, pos, pos_deriv = _locate(x, scale, align_corners, interp)
+
+            results = torch.zeros(b1 - b0, C, dtype=torch.float32, device=inputs.device)
+            values = []
+            for idx, pos_grid_local, w in _corners(pos_grid, pos):
+                val = grid[_grid_index(pos_grid_local, gridtype, align_corners, hashmap_size, resolution)]
+                results += w.unsqueeze(-1) * val
+                values.append(val)
+
+            # if input out of bound, just set output to 0
+            outputs[level, b0:b1] = torch.where(valid, results, torch.zeros_like(results)).to(outputs.dtype)
+
+            if dy_dx is not None:
+                for gd in range(D):
+                    results_grad = torch.zeros(b1 - b0, C, dtype=torch.float32, device=inputs.device)
+                    other = [d for d in range(D) if d != gd]
+                    for idx in range(1 << D):
+                        if idx & (1 << gd):
+                            continue
+                        w = torch.full_like(pos[:, 0], scale)
+                        for d in other:
+                            w = w * (pos[:, d] if idx & (1 << d) else 1 - pos[:, d])
+                        results_grad += (w * pos_deriv[:, gd]).unsqueeze(-1) * (values[idx | (1 << gd)] - values[idx])
+                    dy_dx_view[b0:b1, level, gd] = torch.where(valid, results_grad, torch.zeros_like(results_grad)).to(dy_dx.dtype)
+
+
+def grid_encode_backward(grad, inputs, embeddings, offsets, grad_embeddings, B, D, C, L, S, H, dy_dx, grad_inputs, gridtype, align_corners, interp):
+    # grad: [L, B, C], float
+    # grad_embeddings: [sO, C]
+    # grad_inputs: [B, D] or None
+    offsets = offsets.tolist()
+    inputs = inputs.float()
+
+    for level in range(L):
+        hashmap_size, scale, resolution = _level_meta(offsets, level, S, H)
+        grad_grid = grad_embeddings[offsets[level]:offsets[level + 1]]
+
+        for b0 in range(0, B, CHUNK_SIZE):
+            b1 = min(b0 + CHUNK_SIZE, B)
+            x = inputs[b0:b1]
+
+            # grad is init as 0, so out-of-bound inputs are simply dropped.
+            valid = _in_bound(x)
+            x = x[valid]
+            g = grad[level, b0:b1][valid].float()
+
+            pos_grid, pos, _ = _locate(x, scale, align_corners, interp)
+
+            for idx, pos_grid_local, w in _corners(pos_grid, pos):
+                index = _grid_index(pos_grid_local, gridtype, align_corners, hashmap_size, resolution)
+                grad_grid.index_add_(0, index, (w.unsqueeze(-1) * g).to(grad_grid.dtype))
+
+    if dy_dx is not None:
+        # grad_inputs[b, d] = sum_{l, c} grad[l, b, c] * dy_dx[b, l, d, c]
+        for b0 in range(0, B, CHUNK_SIZE):
+            b1 = min(b0 + CHUNK_SIZE, B)
+            grad_inputs[b0:b1] = torch.einsum('lbc,bldc->bd', grad[:, b0:b1].float(), dy_dx[b0:b1].view(-1, L, D, C).float()).to(grad_inputs.dtype)
+
+
+def grad_total_variation(inputs, embeddings, grad, offsets, weight, B, D, C, L, S, H, gridtype, align_corners):
+    # inputs: [B, D], float, in [0, 1]
+    # embeddings / grad: [sO, C], grad is updated in-place
+    offsets = offsets.tolist()
+    inputs = inputs.float()
+    w = weight / (2 * D)
+
+    for level in range(L):
+        hashmap_size, scale, resolution = _level_meta(offsets, level, S, H)
+        grid = embeddings[offsets[level]:offsets[level + 1]].float()
+        grad_grid = grad[offsets[level]:offsets[level + 1]]
+
+        for b0 in range(0, B, CHUNK_SIZE):
+            b1 = min(b0 + CHUNK_SIZE, B)
+            x = inputs[b0:b1]
+
+            # if input out of bound, do nothing
+            x = x[_in_bound(x)]
+            pos_grid = torch.floor(x * scale + (0.0 if align_corners else 0.5)).long()
+
+            # total variation on pos_grid
+            index = _grid_index(pos_grid, gridtype, align_corners, hashmap_size, resolution)
+            cur = grid[index]
+            results = torch.zeros_like(cur)
+            idelta = torch.zeros_like(cur)
+
+            for d in range(D):
+                for side, mask in ((1, pos_grid[:, d] < resolution), (-1, pos_grid[:, d] > 0)):
+                    neighbor = pos_grid.clone()
+                    neighbor[:, d] += side
+                    grad_val = cur - grid[_grid_index(neighbor, gridtype, align_corners, hashmap_size, resolution)]
+                    grad_val = torch.where(mask.unsqueeze(-1), grad_val, torch.zeros_like(grad_val))
+                    results += grad_val
+                    idelta += grad_val * grad_val
+
+            # index may collide, so accumulate with index_add_
+            grad_grid.index_add_(0, index, (w * results * torch.rsqrt(idelta + 1e-9)).to(grad_grid.dtype))
@@ -24,12 +24,33 @@ if __name__ == '__main__':
     parser.add_argument('--lr_net', type=float, default=5e-4, help="initial learning rate")
     parser.add_argument('--ckpt', type=str, default='latest')
     parser.add_argument('--num_rays', type=int, default=4096 * 16, help="num rays sampled per image for each training step")
+    parser.add_argument('--train_batch', type=int, default=1, help="number of frames sampled for each training step, the num_rays rays are split evenly among them")
     parser.add_argument('--cuda_ray', action='store_true', help="use CUDA raymarching instead of pytorch")
     parser.add_argument('--max_steps', type=int, default=16, help="max num steps sampled per ray (only valid when using --cuda_ray)")
     parser.add_argument('--num_steps', type=int, default=16, help="num steps sampled per ray (only valid when NOT using --cuda_ray)")
     parser.add_argument('--upsample_steps', type=int, default=0, help="num steps up-sampled per ray (only valid when NOT using --cuda_ray)")
     parser.add_argument('--update_extra_interval', type=int, default=16, help="iter interval to update extra status (only valid when using --cuda_ray)")
+    parser.add_argument('--update_extra_interval_max', type=int, default=0, help="double the update interval up to this many iters while the density grid is stable, <= --update_extra_interval to keep it fixed")
+    parser.add_argument('--grid_change_thresh', type=float, default=1e-3, help="the density grid is stable if an update flips less than this fraction of occupancy bits")
+    parser.add_argument('--grid_update_ratio', type=float, default=1, help="fraction of density grid cells queried per update after 16 full updates, half uniformly and half among occupied cells (1 for full updates)")
+    parser.add_argument('--grid_update_conds', type=int, default=1, help="number of random audio / eye conditions queried in one pass per density grid update, the grid keeps their max density")
+    parser.add_argument('--grid_freeze_patience', type=int, default=0, help="stop updating the density grid after this many consecutive stable updates (see --grid_change_thresh), 0 to disable")
+    parser.add_argument('--grid_clusters', type=int, default=0, help="after training, build a density bitfield per cluster of training conditions and store them in the checkpoint, inference then marches each frame with its cluster's bitfield (0 to disable)")
+    parser.add_argument('--grid_dtype', type=str, default='float32', choices=['float32', 'float16', 'uint8'], help="storage of the density grid in checkpoints and at inference (training keeps it in float32), uint8 is log-quantized (only valid when using --cuda_ray)")
+    parser.add_argument('--bitfield_only', action='store_true', help="inference only: do not keep the density grid, only its bitfield (only valid when using --cuda_ray)")
+    parser.add_argument('--torso_reuse_thresh', type=float, default=0, help="at inference, frames whose head pose (euler angles and translation) falls in the same bin of this size reuse the torso layer, 0 to disable")
+    parser.add_argument('--torso_downscale', type=int, default=1, help="at inference, render the torso on a coarser pixel grid by this factor and upsample it, visible torso edges are still rendered at full resolution")
+    parser.add_argument('--torso_benchmark', action='store_true', help="instead of testing, report FPS and PSNR (against full resolution) of --torso_downscale 1, 2, 4, 8 on the first 100 test frames")
     parser.add_argument('--max_ray_batch', type=int, default=4096, help="batch size of rays at inference to avoid OOM (only valid when NOT using --cuda_ray)")
+    parser.add_argument('--head_cull', action='store_true', help="at inference, only march rays inside the screen-space bbox of the head density grid (only valid when using --cuda_ray)")
+    parser.add_argument('--warm_start', action='store_true', help="at inference, start ray marching from the last frame's reprojected depth (only valid when using --cuda_ray)")
+    parser.add_argument('--warm_start_margin', type=float, default=0.05, help="safety margin before the last surface for --warm_start, also the max head motion before falling back to a full march")
+    parser.add_argument('--mip_levels', type=int, default=4, help="levels of the occupancy pyramid over the density bitfield, ray marching skips empty 2^k blocks in one step, 0 to disable")
+    parser.add_argument('--test_batch', type=int, default=1, help="number of frames rendered together in one call at test (only valid when using --cuda_ray)")
+    parser.add_argument('--compile_mlp', action='store_true', help="build the FiLM-conditioned sigma network with torch.compile")
+    parser.add_argument('--march_policy', type=str, default='alive', choices=['fixed', 'alive', 'samples'], help="how many steps each alive ray marches per network call at inference (only valid when using --cuda_ray)")
+    parser.add_argument('--march_n_step', type=int, default=None, help="max (or fixed) steps per ray per network call at inference, defaults to 8 (64 for --march_policy samples)")
+    parser.add_argument('--march_samples', type=int, default=2**18, help="target samples per network call for --march_policy samples")
 
 
     ### network backbone options
@@ -48,6 +69,9 @@ if __name__ == '__main__':
     ### dataset options
     parser.add_argument('--color_space', type=str, default='srgb', help="Color space, supports (linear, srgb)")
     parser.add_argument('--preload', type=int, default=0, help="0 means load data from disk on-the-fly, 1 means preload to CPU, 2 means GPU.")
+    parser.add_argument('--frame_store', action='store_true', help="with --preload 0, also pack the gt images into the uint8 memory-mapped frame store in the workspace cache, rays are read from it without decoding")
+    parser.add_argument('--prefetch', type=int, default=0, help="collate up to this many batches ahead of the trainer in background threads, 0 to disable")
+    parser.add_argument('--prefetch_threads', type=int, default=1, help="number of threads collating batches for --prefetch")
     # (the default value is for the fox dataset)
     parser.add_argument('--bound', type=float, default=1, help="assume the scene is bounded in box[-bound, bound]^3, if > 1, will invoke adaptive ray marching.")
     parser.add_argument('--scale', type=float, default=4, help="scale camera location into box[-bound, bound]^3")
@@ -133,6 +157,13 @@ if __name__ == '__main__':
         # assert opt.patch_size > 16, "patch_size should > 16 to run LPIPS loss."
         assert opt.num_rays % (opt.patch_size ** 2) == 0, "patch_size ** 2 should be dividable by num_rays."
     
+    if opt.bitfield_only:
+        assert opt.test, "--bitfield_only drops the density grid, it is only valid with --test."
+
+    if opt.train_batch > 1:
+        assert not opt.finetune_lips, "--train_batch > 1 does not support --finetune_lips, the lips rect differs between frames."
+        assert opt.num_rays % (opt.train_batch * opt.patch_size ** 2) == 0, "train_batch * patch_size ** 2 should be dividable by num_rays."
+
     if opt.finetune_lips:
         # do not update density grid in finetune stage
         opt.update_extra_interval = 1e9
@@ -156,7 +187,10 @@ if __name__ == '__main__':
     # manually load state dict for head
     if opt.torso and opt.head_ckpt != '':
         
-        model_dict = torch.load(opt.head_ckpt, map_location='cpu')['model']
+        head_ckpt = torch.load(opt.head_ckpt, map_location='cpu')
+        model_dict = head_ckpt['model']
+        if 'grid_clusters' in head_ckpt:
+            model.grid_clusters = head_ckpt['grid_clusters']
 
         missing_keys, unexpected_keys = model.load_state_dict(model_dict, strict=False)
 
@@ -204,6 +238,9 @@ if __name__ == '__main__':
             # we still need test_loader to provide audio features for testing.
             with NeRFGUI(opt, trainer, test_loader) as gui:
                 gui.render()
+
+        elif opt.torso_benchmark:
+            trainer.benchmark_torso(test_loader)
         
         else:
             
@@ -220,7 +257,7 @@ if __name__ == '__main__':
 
         train_loader = NeRFDataset(opt, device=device, type='train').dataloader()
 
-        assert len(train_loader) < opt.ind_num, f"[ERROR] dataset too many frames: {len(train_loader)}, please increase --ind_num to this number!"
+        assert len(train_loader._data.poses) < opt.ind_num, f"[ERROR] dataset too many frames: {len(train_loader._data.poses)}, please increase --ind_num to this number!"
 
         # temp fix: for update_extra_states
         model.aud_features = train_loader._data.auds
@@ -249,6 +286,10 @@ if __name__ == '__main__':
             print(f'[INFO] max_epoch = {max_epoch}')
             trainer.train(train_loader, valid_loader, max_epoch)
 
+            # condition-clustered bitfields for inference, stored in the checkpoint
+            if opt.grid_clusters > 0:
+                trainer.build_grid_clusters(opt.grid_clusters, valid_loader)
+
             # free some mem
             del train_loader, valid_loader
             torch.cuda.empty_cache()
@@ -89,6 +89,21 @@ class AudioAttNet(nn.Module):
         smoothed_y = torch.sum(y*x, dim=0) # [8,1]*[8,c]=>[8,c]=>[c,]
         return smoothed_y
     
+def film(x, scale, shift):
+    ''' FiLM modulation x * (scale + 1) + shift, broadcast instead of repeating the condition per sample.
+    Args:
+        x: [N, dim], fresh output of a linear layer, it is modified in-place if no gradient is needed.
+        scale, shift: [1, dim] (per frame) or [N, dim] (per sample)
+    Returns:
+        x: [N, dim]
+    '''
+    if torch.is_grad_enabled() and (x.requires_grad or scale.requires_grad or shift.requires_grad):
+        # one fused kernel, x is kept for backward
+        return torch.addcmul(shift, x, scale + 1)
+    # x + x * scale + shift, no allocation
+    return x.addcmul_(x, scale).add_(shift)
+
+
 class MLP(nn.Module):
     def __init__(self, dim_in, dim_out, dim_hidden, num_layers):
         super().__init__()
@@ -103,23 +118,52 @@ class MLP(nn.Module):
 
         self.net = nn.ModuleList(net)
 
-    def forward(self, x, scales=None, shifts=None):
-        if scales is not None and shifts is not None:
-            for l in range(self.num_layers):
-                x = self.net[l](x)
-                if l != self.num_layers - 1:
-                    shift = scales[l].repeat(x.shape[0], 1) # [1,cond_dim] ==> [N, cond_dim]
-                    scale = shifts[l].repeat(x.shape[0], 1) # [1,cond_dim] ==> [N, cond_dim]
-                    x = x*(scale+1.0)+shift
-                    x = F.relu(x, inplace=True)
+    def cond_bias(self, c):
+        # c: [1, dim_c], the trailing inputs of the first layer that are shared by all samples (e.g. eye / individual code).
+        # return: [1, dim_hidden], their contribution to the first layer, pass it as `bias` instead of concatenating c to every sample.
+        return F.linear(c, self.net[0].weight[:, -c.shape[-1]:])
+
+    def first_layer(self, x, bias=None):
+        # bias: [1 or N, dim_hidden] from cond_bias, x then only holds the leading inputs of the first layer.
+        if bias is None:
+            return self.net[0](x)
+        return torch.addmm(bias, x, self.net[0].weight[:, :x.shape[-1]].t())
+
+    def forward(self, x, bias=None):
+        for l in range(self.num_layers):
+            x = self.first_layer(x, bias) if l == 0 else self.net[l](x)
+            if l != self.num_layers - 1:
+                x = F.relu(x, inplace=True)
+        return x
 
-        else:
-            for l in range(self.num_layers):
-                x = self.net[l](x)
-                if l != self.num_layers - 1:
-                    x = F.relu(x, inplace=True)
+
+class CondMLP(MLP):
+    ''' MLP with FiLM conditioning after each hidden layer, relu(W x * (scale + 1) + shift).
+    Same parameters (and state_dict keys) as MLP. If compile, forward runs through torch.compile,
+    which fuses the FiLM and relu into the matmul epilogues.
+    '''
+    def __init__(self, dim_in, dim_out, dim_hidden, num_layers, compile=False):
+        super().__init__(dim_in, dim_out, dim_hidden, num_layers)
+        self.compiled_forward = torch.compile(self._forward, dynamic=True) if compile else None
+
+    def _forward(self, x, scales, shifts, bias=None):
+        for l in range(self.num_layers):
+            x = self.first_layer(x, bias) if l == 0 else self.net[l](x)
+            if l != self.num_layers - 1:
+                # NOTE: the two halves are applied as (shift, scale) = (scales[l], shifts[l]), as the checkpoints were trained this way.
+                x = film(x, shifts[l], scales[l])
+                x = F.relu(x, inplace=True)
         return x
 
+    def forward(self, x, scales=None, shifts=None, bias=None):
+        # scales, shifts: list of [1 or N, dim_hidden], one per hidden layer
+        if scales is None or shifts is None:
+            return super().forward(x, bias)
+        if self.compiled_forward is not None:
+            return self.compiled_forward(x, scales, shifts, bias)
+        return self._forward(x, scales, shifts, bias)
+
+
 class NeRFNetwork(NeRFRenderer):
     def __init__(self,
                  opt,
@@ -230,21 +274,22 @@ class NeRFNetwork(NeRFRenderer):
         enc_pose = self.pose_encoder(poses)
         enc_x = self.torso_deform_encoder(x)
 
+        # pose and individual code are shared by all pixels, they are the trailing inputs of both nets and folded into the first layer's bias
         if c is not None:
-            h = torch.cat([enc_x, enc_pose.repeat(x.shape[0], 1), c.repeat(x.shape[0], 1)], dim=-1)
+            cond = torch.cat([enc_pose, c.view(1, -1)], dim=-1)
         else:
-            h = torch.cat([enc_x, enc_pose.repeat(x.shape[0], 1)], dim=-1)
+            cond = enc_pose
 
-        dx = self.torso_deform_net(h)
+        dx = self.torso_deform_net(enc_x, bias=self.torso_deform_net.cond_bias(cond))
 
         x = (x + dx).clamp(-1, 1)
 
         x = self.torso_encoder(x, bound=1)
 
         # h = torch.cat([x, h, enc_a.repeat(x.shape[0], 1)], dim=-1)
-        h = torch.cat([x, h], dim=-1)
+        h = torch.cat([x, enc_x], dim=-1)
 
-        h = self.torso_net(h)
+        h = self.torso_net(h, bias=self.torso_net.cond_bias(cond))
 
         alpha = torch.sigmoid(h[..., :1])
         color = torch.sigmoid(h[..., 1:])
@@ -252,12 +297,34 @@ class NeRFNetwork(NeRFRenderer):
         return alpha, color, dx
 
 
-    def forward(self, x, d, enc_a, c, e=None):
+    def get_cond(self, enc_a, c=None, e=None):
+        ''' per-frame conditioning context, shared by all forward / density calls of a frame.
+        The audio, eye and individual codes are the trailing inputs of ambient_net, sigma_net and color_net,
+        so they are folded into a first-layer bias once instead of being repeated for every sample.
+        Args:
+            enc_a: [1, aud_dim] or None
+            c: [1, ind_dim] or None, individual code
+            e: [1, 1] or None, eye feature
+        Returns:
+            cond: dict
+        '''
+        return {
+            'ambient_bias': self.ambient_net.cond_bias(enc_a) if enc_a is not None else None,
+            'sigma_bias': self.sigma_net.cond_bias(e) if e is not None else None,
+            'color_bias': self.color_net.cond_bias(c) if c is not None else None,
+        }
+
+
+    def forward(self, x, d, enc_a, c, e=None, cond=None):
         # x: [N, 3], in [-bound, bound]
         # d: [N, 3], nomalized in [-1, 1]
         # enc_a: [1, aud_dim]
         # c: [1, ind_dim], individual code
         # e: [1, 1], eye feature
+        # cond: per-frame context from get_cond, computed here if None
+
+        if cond is None:
+            cond = self.get_cond(enc_a, c, e)
 
         # starter, ender = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
         # starter.record()
@@ -268,14 +335,12 @@ class NeRFNetwork(NeRFRenderer):
             enc_w = self.encoder_ambient(ambient, bound=1)
         else:
             
-            enc_a = enc_a.repeat(x.shape[0], 1) 
             enc_x = self.encoder(x, bound=self.bound)
 
             # ender.record(); torch.cuda.synchronize(); curr_time = starter.elapsed_time(ender); print(f"enocoder_deform = {curr_time}"); starter.record()
 
             # ambient
-            ambient = torch.cat([enc_x, enc_a], dim=1)
-            ambient = self.ambient_net(ambient).float()
+            ambient = self.ambient_net(enc_x, bias=cond['ambient_bias']).float()
             ambient = torch.tanh(ambient) # map to [-1, 1]
 
             # ender.record(); torch.cuda.synchronize(); curr_time = starter.elapsed_time(ender); print(f"de-an net = {curr_time}"); starter.record()
@@ -285,12 +350,10 @@ class NeRFNetwork(NeRFRenderer):
 
         # ender.record(); torch.cuda.synchronize(); curr_time = starter.elapsed_time(ender); print(f"encoder = {curr_time}"); starter.record()
 
-        if e is not None:
-            h = torch.cat([enc_x, enc_w, e.repeat(x.shape[0], 1)], dim=-1)
-        else:
-            h = torch.cat([enc_x, enc_w], dim=-1)
+        # eye feature is folded into sigma_net's first layer (cond['sigma_bias'])
+        h = torch.cat([enc_x, enc_w], dim=-1)
 
-        h = self.sigma_net(h)
+        h = self.sigma_net(h, bias=cond['sigma_bias'])
 
         # ender.record(); torch.cuda.synchronize(); curr_time = starter.elapsed_time(ender); print(f"sigma_net = {curr_time}"); starter.record()
         sigma = trunc_exp(h[..., 0])
@@ -301,12 +364,10 @@ class NeRFNetwork(NeRFRenderer):
 
         # ender.record(); torch.cuda.synchronize(); curr_time = starter.elapsed_time(ender); print(f"encoder_dir = {curr_time}"); starter.record()
 
-        if c is not None:
-            h = torch.cat([enc_d, geo_feat, c.repeat(x.shape[0], 1)], dim=-1)
-        else:
-            h = torch.cat([enc_d, geo_feat], dim=-1)
+        # individual code is folded into color_net's first layer (cond['color_bias'])
+        h = torch.cat([enc_d, geo_feat], dim=-1)
         
-        h = self.color_net(h)
+        h = self.color_net(h, bias=cond['color_bias'])
         # ender.record(); torch.cuda.synchronize(); curr_time = starter.elapsed_time(ender); print(f"color_net = {curr_time}"); starter.record()
         
         # sigmoid activation for rgb
@@ -315,23 +376,24 @@ class NeRFNetwork(NeRFRenderer):
         return sigma, color, ambient
 
 
-    def density(self, x, enc_a, e=None):
+    def density(self, x, enc_a, e=None, cond=None):
         # x: [N, 3], in [-bound, bound]
 
+        if cond is None:
+            cond = self.get_cond(enc_a, None, e)
+
         if enc_a is None:
             ambient = torch.zeros_like(x[:, :self.ambient_dim])
             enc_x = self.encoder(x, bound=self.bound)
             enc_w = self.encoder_ambient(ambient, bound=1)
         else:
 
-            enc_a = enc_a.repeat(x.shape[0], 1) 
             enc_x = self.encoder(x, bound=self.bound)
 
             # ender.record(); torch.cuda.synchronize(); curr_time = starter.elapsed_time(ender); print(f"enocoder_deform = {curr_time}"); starter.record()
 
             # ambient
-            ambient = torch.cat([enc_x, enc_a], dim=1)
-            ambient = self.ambient_net(ambient).float()
+            ambient = self.ambient_net(enc_x, bias=cond['ambient_bias']).float()
             ambient = torch.tanh(ambient) # map to [-1, 1]
 
             # ender.record(); torch.cuda.synchronize(); curr_time = starter.elapsed_time(ender); print(f"de-an net = {curr_time}"); starter.record()
@@ -341,12 +403,10 @@ class NeRFNetwork(NeRFRenderer):
 
         # ender.record(); torch.cuda.synchronize(); curr_time = starter.elapsed_time(ender); print(f"encoder = {curr_time}"); starter.record()
 
-        if e is not None:
-            h = torch.cat([enc_x, enc_w, e.repeat(x.shape[0], 1)], dim=-1)
-        else:
-            h = torch.cat([enc_x, enc_w], dim=-1)
+        # eye feature is folded into sigma_net's first layer (cond['sigma_bias'])
+        h = torch.cat([enc_x, enc_w], dim=-1)
 
-        h = self.sigma_net(h)
+        h = self.sigma_net(h, bias=cond['sigma_bias'])
 
         sigma = trunc_exp(h[..., 0])
         geo_feat = h[..., 1:]
@@ -503,21 +563,22 @@ class GeneNeRFNetwork(NeRFRenderer):
         enc_pose = self.pose_encoder(poses)
         enc_x = self.torso_deform_encoder(x)
 
+        # pose and individual code are shared by all pixels, they are the trailing inputs of both nets and folded into the first layer's bias
         if c is not None:
-            h = torch.cat([enc_x, enc_pose.repeat(x.shape[0], 1), c.repeat(x.shape[0], 1)], dim=-1)
+            cond = torch.cat([enc_pose, c.view(1, -1)], dim=-1)
         else:
-            h = torch.cat([enc_x, enc_pose.repeat(x.shape[0], 1)], dim=-1)
+            cond = enc_pose
 
-        dx = self.torso_deform_net(h)
+        dx = self.torso_deform_net(enc_x, bias=self.torso_deform_net.cond_bias(cond))
 
         x = (x + dx).clamp(-1, 1)
 
         x = self.torso_encoder(x, bound=1)
 
         # h = torch.cat([x, h, enc_a.repeat(x.shape[0], 1)], dim=-1)
-        h = torch.cat([x, h], dim=-1)
+        h = torch.cat([x, enc_x], dim=-1)
 
-        h = self.torso_net(h)
+        h = self.torso_net(h, bias=self.torso_net.cond_bias(cond))
 
         alpha = torch.sigmoid(h[..., :1])
         color = torch.sigmoid(h[..., 1:])
@@ -525,12 +586,34 @@ class GeneNeRFNetwork(NeRFRenderer):
         return alpha, color, dx
 
 
-    def forward(self, x, d, enc_a, c, e=None):
+    def get_cond(self, enc_a, c=None, e=None):
+        ''' per-frame conditioning context, shared by all forward / density calls of a frame.
+        The audio, eye and individual codes are the trailing inputs of ambient_net, sigma_net and color_net,
+        so they are folded into a first-layer bias once instead of being repeated for every sample.
+        Args:
+            enc_a: [1, aud_dim] or None
+            c: [1, ind_dim] or None, individual code
+            e: [1, 1] or None, eye feature
+        Returns:
+            cond: dict
+        '''
+        return {
+            'ambient_bias': self.ambient_net.cond_bias(enc_a) if enc_a is not None else None,
+            'sigma_bias': self.sigma_net.cond_bias(e) if e is not None else None,
+            'color_bias': self.color_net.cond_bias(c) if c is not None else None,
+        }
+
+
+    def forward(self, x, d, enc_a, c, e=None, cond=None):
         # x: [N, 3], in [-bound, bound]
         # d: [N, 3], nomalized in [-1, 1]
         # enc_a: [1, aud_dim]
         # c: [1, ind_dim], individual code
         # e: [1, 1], eye feature
+        # cond: per-frame context from get_cond, computed here if None
+
+        if cond is None:
+            cond = self.get_cond(enc_a, c, e)
 
         # starter, ender = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
         # starter.record()
@@ -541,14 +624,12 @@ class GeneNeRFNetwork(NeRFRenderer):
             enc_w = self.encoder_ambient(ambient, bound=1)
         else:
             
-            enc_a = enc_a.repeat(x.shape[0], 1) 
             enc_x = self.encoder(x, bound=self.bound)
 
             # ender.record(); torch.cuda.synchronize(); curr_time = starter.elapsed_time(ender); print(f"enocoder_deform = {curr_time}"); starter.record()
 
             # ambient
-            ambient = torch.cat([enc_x, enc_a], dim=1)
-            ambient = self.ambient_net(ambient).float()
+            ambient = self.ambient_net(enc_x, bias=cond['ambient_bias']).float()
             ambient = torch.tanh(ambient) # map to [-1, 1]
 
             # ender.record(); torch.cuda.synchronize(); curr_time = starter.elapsed_time(ender); print(f"de-an net = {curr_time}"); starter.record()
@@ -558,12 +639,10 @@ class GeneNeRFNetwork(NeRFRenderer):
 
         # ender.record(); torch.cuda.synchronize(); curr_time = starter.elapsed_time(ender); print(f"encoder = {curr_time}"); starter.record()
 
-        if e is not None:
-            h = torch.cat([enc_x, enc_w, e.repeat(x.shape[0], 1)], dim=-1)
-        else:
-            h = torch.cat([enc_x, enc_w], dim=-1)
+        # eye feature is folded into sigma_net's first layer (cond['sigma_bias'])
+        h = torch.cat([enc_x, enc_w], dim=-1)
 
-        h = self.sigma_net(h)
+        h = self.sigma_net(h, bias=cond['sigma_bias'])
 
         # ender.record(); torch.cuda.synchronize(); curr_time = starter.elapsed_time(ender); print(f"sigma_net = {curr_time}"); starter.record()
         sigma = trunc_exp(h[..., 0])
@@ -574,12 +653,10 @@ class GeneNeRFNetwork(NeRFRenderer):
 
         # ender.record(); torch.cuda.synchronize(); curr_time = starter.elapsed_time(ender); print(f"encoder_dir = {curr_time}"); starter.record()
 
-        if c is not None:
-            h = torch.cat([enc_d, geo_feat, c.repeat(x.shape[0], 1)], dim=-1)
-        else:
-            h = torch.cat([enc_d, geo_feat], dim=-1)
+        # individual code is folded into color_net's first layer (cond['color_bias'])
+        h = torch.cat([enc_d, geo_feat], dim=-1)
         
-        h = self.color_net(h)
+        h = self.color_net(h, bias=cond['color_bias'])
         # ender.record(); torch.cuda.synchronize(); curr_time = starter.elapsed_time(ender); print(f"color_net = {curr_time}"); starter.record()
         
         # sigmoid activation for rgb
@@ -588,23 +665,24 @@ class GeneNeRFNetwork(NeRFRenderer):
         return sigma, color, ambient
 
 
-    def density(self, x, enc_a, e=None):
+    def density(self, x, enc_a, e=None, cond=None):
         # x: [N, 3], in [-bound, bound]
 
+        if cond is None:
+            cond = self.get_cond(enc_a, None, e)
+
         if enc_a is None:
             ambient = torch.zeros_like(x[:, :self.ambient_dim])
             enc_x = self.encoder(x, bound=self.bound)
             enc_w = self.encoder_ambient(ambient, bound=1)
         else:
 
-            enc_a = enc_a.repeat(x.shape[0], 1) 
             enc_x = self.encoder(x, bound=self.bound)
 
             # ender.record(); torch.cuda.synchronize(); curr_time = starter.elapsed_time(ender); print(f"enocoder_deform = {curr_time}"); starter.record()
 
             # ambient
-            ambient = torch.cat([enc_x, enc_a], dim=1)
-            ambient = self.ambient_net(ambient).float()
+            ambient = self.ambient_net(enc_x, bias=cond['ambient_bias']).float()
             ambient = torch.tanh(ambient) # map to [-1, 1]
 
             # ender.record(); torch.cuda.synchronize(); curr_time = starter.elapsed_time(ender); print(f"de-an net = {curr_time}"); starter.record()
@@ -614,12 +692,10 @@ class GeneNeRFNetwork(NeRFRenderer):
 
         # ender.record(); torch.cuda.synchronize(); curr_time = starter.elapsed_time(ender); print(f"encoder = {curr_time}"); starter.record()
 
-        if e is not None:
-            h = torch.cat([enc_x, enc_w, e.repeat(x.shape[0], 1)], dim=-1)
-        else:
-            h = torch.cat([enc_x, enc_w], dim=-1)
+        # eye feature is folded into sigma_net's first layer (cond['sigma_bias'])
+        h = torch.cat([enc_x, enc_w], dim=-1)
 
-        h = self.sigma_net(h)
+        h = self.sigma_net(h, bias=cond['sigma_bias'])
 
         sigma = trunc_exp(h[..., 0])
         geo_feat = h[..., 1:]
@@ -694,7 +770,7 @@ class R2TalkerNeRF(NeRFRenderer):
 
         self.eye_dim = 1 if self.exp_eye else 0
 
-        self.sigma_net = MLP(self.in_dim + self.eye_dim, 1 + self.geo_feat_dim, self.hidden_dim, self.num_layers)
+        self.sigma_net = CondMLP(self.in_dim + self.eye_dim, 1 + self.geo_feat_dim, self.hidden_dim, self.num_layers, compile=self.opt.compile_mlp)
 
 
         # color network
@@ -740,21 +816,22 @@ class R2TalkerNeRF(NeRFRenderer):
         enc_pose = self.pose_encoder(poses)
         enc_x = self.torso_deform_encoder(x)
 
+        # pose and individual code are shared by all pixels, they are the trailing inputs of both nets and folded into the first layer's bias
         if c is not None:
-            h = torch.cat([enc_x, enc_pose.repeat(x.shape[0], 1), c.repeat(x.shape[0], 1)], dim=-1)
+            cond = torch.cat([enc_pose, c.view(1, -1)], dim=-1)
         else:
-            h = torch.cat([enc_x, enc_pose.repeat(x.shape[0], 1)], dim=-1)
+            cond = enc_pose
 
-        dx = self.torso_deform_net(h)
+        dx = self.torso_deform_net(enc_x, bias=self.torso_deform_net.cond_bias(cond))
 
         x = (x + dx).clamp(-1, 1)
 
         x = self.torso_encoder(x, bound=1)
 
         # h = torch.cat([x, h, enc_a.repeat(x.shape[0], 1)], dim=-1)
-        h = torch.cat([x, h], dim=-1)
+        h = torch.cat([x, enc_x], dim=-1)
 
-        h = self.torso_net(h)
+        h = self.torso_net(h, bias=self.torso_net.cond_bias(cond))
 
         alpha = torch.sigmoid(h[..., :1])
         color = torch.sigmoid(h[..., 1:])
@@ -762,29 +839,46 @@ class R2TalkerNeRF(NeRFRenderer):
         return alpha, color, dx
 
 
-    def forward(self, x, d, enc_a, c, e=None):
-        # x: [N, 3], in [-bound, bound]
-        # d: [N, 3], nomalized in [-1, 1]
-        # enc_a: [1, aud_dim]
-        # c: [1, ind_dim], individual code
-        # e: [1, 1], eye feature
-
+    def get_cond(self, enc_a, c=None, e=None):
+        ''' per-frame conditioning context, shared by all forward / density calls of a frame.
+        The FiLM scales / shifts only depend on the landmark encoding, and the eye / individual codes
+        are folded into a first-layer bias, so nothing here is recomputed or repeated per sample.
+        Args:
+            enc_a: [1, 5 * 68 * lm_dim], encoded landmarks
+            c: [1, ind_dim] or None, individual code
+            e: [1, 1] or None, eye feature
+        Returns:
+            cond: dict
+        '''
         cond_feat_1 = self.mlp_lms_style_1(enc_a)
         scale_1, shift_1 = cond_feat_1.chunk(2, dim=-1)
 
         cond_feat_2 = self.mlp_lms_style_2(enc_a)
         scale_2, shift_2 = cond_feat_2.chunk(2, dim=-1)
 
-        self.scales = [scale_1, scale_2]
-        self.shifts = [shift_1, shift_2]
+        return {
+            'scales': [scale_1, scale_2],
+            'shifts': [shift_1, shift_2],
+            'sigma_bias': self.sigma_net.cond_bias(e) if e is not None else None,
+            'color_bias': self.color_net.cond_bias(c) if c is not None else None,
+        }
 
-        enc_x = self.encoder(x, bound=self.bound)
 
-        if e is not None:
-            enc_x = torch.cat([enc_x, e.repeat(x.shape[0], 1)], dim=-1)
+    def forward(self, x, d, enc_a, c, e=None, cond=None):
+        # x: [N, 3], in [-bound, bound]
+        # d: [N, 3], nomalized in [-1, 1]
+        # enc_a: [1, aud_dim]
+        # c: [1, ind_dim], individual code
+        # e: [1, 1], eye feature
+        # cond: per-frame context from get_cond, computed here if None
+
+        if cond is None:
+            cond = self.get_cond(enc_a, c, e)
 
+        enc_x = self.encoder(x, bound=self.bound)
 
-        h = self.sigma_net(enc_x, scales=self.scales, shifts=self.shifts)  
+        # eye feature is folded into sigma_net's first layer (cond['sigma_bias'])
+        h = self.sigma_net(enc_x, scales=cond['scales'], shifts=cond['shifts'], bias=cond['sigma_bias'])  
 
         sigma = trunc_exp(h[..., 0])
         geo_feat = h[..., 1:]
@@ -792,38 +886,27 @@ class R2TalkerNeRF(NeRFRenderer):
         # color
         enc_d = self.encoder_dir(d)
 
-        if c is not None:
-            h = torch.cat([enc_d, geo_feat, c.repeat(x.shape[0], 1)], dim=-1)
-        else:
-            h = torch.cat([enc_d, geo_feat], dim=-1)
+        # individual code is folded into color_net's first layer (cond['color_bias'])
+        h = torch.cat([enc_d, geo_feat], dim=-1)
 
-        h = self.color_net(h)
+        h = self.color_net(h, bias=cond['color_bias'])
 
         # sigmoid activation for rgb
         color = torch.sigmoid(h)
-        ambient = torch.zeros((enc_x.shape[0], 2)).cuda() # fake ambient_pos
+        ambient = torch.zeros((enc_x.shape[0], 2), device=enc_x.device) # fake ambient_pos
 
         return sigma, color, ambient
 
 
-    def density(self, x, enc_a, e=None):
+    def density(self, x, enc_a, e=None, cond=None):
         # x: [N, 3], in [-bound, bound]
 
-        cond_feat_1 = self.mlp_lms_style_1(enc_a)
-        scale_1, shift_1 = cond_feat_1.chunk(2, dim=-1)
-
-        cond_feat_2 = self.mlp_lms_style_2(enc_a)
-        scale_2, shift_2 = cond_feat_2.chunk(2, dim=-1)
-
-        self.scales = [scale_1, scale_2]
-        self.shifts = [shift_1, shift_2]
+        if cond is None:
+            cond = self.get_cond(enc_a, None, e)
 
         enc_x = self.encoder(x, bound=self.bound)
 
-        if e is not None:
-            enc_x = torch.cat([enc_x, e.repeat(x.shape[0], 1)], dim=-1)
-
-        h = self.sigma_net(enc_x, scales=self.scales, shifts=self.shifts)  
+        h = self.sigma_net(enc_x, scales=cond['scales'], shifts=cond['shifts'], bias=cond['sigma_bias'])  
 
         sigma = trunc_exp(h[..., 0])
         geo_feat = h[..., 1:]
@@ -3,6 +3,9 @@ import cv2
 import glob
 import json
 import tqdm
+import hashlib
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from scipy.spatial.transform import Slerp, Rotation
 import matplotlib.pyplot as plt 
@@ -13,7 +16,7 @@ import torch
 import torch.nn.functional as F
 from torch.utils.data import DataLoader
 
-from .utils import get_audio_features, get_rays, get_bg_coords, convert_poses
+from .utils import get_audio_features, get_rays, get_bg_coords, convert_poses, merge_frames
 os.environ["KMP_DUPLICATE_LIB_OK"]="TRUE"
 # ref: https://github.com/NVlabs/instant-ngp/blob/b76004c8cf478880227401ae763be4c02f80b62f/include/neural-graphics-primitives/nerf_loader.h#L50
 def nerf_matrix_to_ngp(pose, scale=0.33, offset=[0, 0, 0]):
@@ -26,6 +29,15 @@ def nerf_matrix_to_ngp(pose, scale=0.33, offset=[0, 0, 0]):
     return new_pose
 
 
+def composite_bg_torso(torso_img, bg_img):
+    # torso_img: uint8 [H, W, 4], RGBA
+    # bg_img: float [H, W, 3] in [0, 1]
+    # return: uint8 [H, W, 3], the torso over the background
+    alpha = torso_img[..., 3:].astype(np.float32) / 255
+    image = torso_img[..., :3].astype(np.float32) / 255 * alpha + bg_img * (1 - alpha)
+    return (image * 255 + 0.5).astype(np.uint8)
+
+
 def smooth_camera_path(poses, kernel_size=5):
     # smooth the camera trajectory...
     # poses: [N, 4, 4], numpy array
@@ -44,6 +56,41 @@ def smooth_camera_path(poses, kernel_size=5):
 
     return poses
 
+def load_landmarks(root_path):
+    ''' load all ori_imgs/*.lms landmarks of a dataset, through one cache file next to it (lms_cache.npz).
+    The cache is rebuilt when any .lms file is added, removed or modified (path, size, mtime).
+    Args:
+        root_path: dataset directory
+    Returns:
+        landmarks: dict, img_id (str) --> [68, 2] landmarks
+    '''
+    paths = sorted(glob.glob(os.path.join(root_path, 'ori_imgs', '*.lms')))
+    key = hashlib.sha1()
+    for path in paths:
+        stat = os.stat(path)
+        key.update(f'{os.path.basename(path)}_{stat.st_size}_{stat.st_mtime_ns}'.encode())
+    key = key.hexdigest()
+    cache_path = os.path.join(root_path, 'lms_cache.npz')
+
+    if os.path.exists(cache_path):
+        cache = np.load(cache_path)
+        if str(cache['key']) == key:
+            return dict(zip(cache['img_ids'].tolist(), cache['lms']))
+
+    img_ids = [os.path.basename(path)[:-4] for path in paths]
+    lms = np.stack([np.loadtxt(path) for path in tqdm.tqdm(paths, desc='Loading landmarks')], axis=0) if len(paths) > 0 else np.zeros((0, 68, 2)) # [N, 68, 2]
+
+    # the dataset directory may be read-only, then parse the .lms files every time.
+    try:
+        tmp_path = os.path.join(root_path, 'lms_cache.tmp.npz')
+        np.savez(tmp_path, key=key, img_ids=np.array(img_ids), lms=lms)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f'[WARN] failed to write landmark cache {cache_path}: {e}')
+
+    return dict(zip(img_ids, lms))
+
+
 def polygon_area(x, y):
     x_ = x - x.mean()
     y_ = y - y.mean()
@@ -81,6 +128,34 @@ def visualize_poses(poses, size=0.1):
     trimesh.Scene(objects).show()
 
 
+class PrefetchLoader:
+    ''' iterate a DataLoader with its batches collated ahead of time by a pool of threads.
+    Up to depth batches are in flight and are returned in order, so the trainer only blocks when the data is behind.
+    collate mostly runs in cv2 / numpy / torch calls that release the GIL, so the threads overlap with training.
+    Other attributes (_data, has_gt, batch_size, ...) are forwarded to the wrapped loader.
+    '''
+    def __init__(self, loader, depth=2, num_threads=1):
+        self.loader = loader
+        self.depth = depth
+        self.num_threads = num_threads
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def __iter__(self):
+        futures = collections.deque()
+        with ThreadPoolExecutor(self.num_threads) as pool:
+            for batch in self.loader.batch_sampler:
+                futures.append(pool.submit(self.loader.collate_fn, [self.loader.dataset[i] for i in batch]))
+                if len(futures) > self.depth:
+                    yield futures.popleft().result()
+            while len(futures) > 0:
+                yield futures.popleft().result()
+
+
 class NeRFDataset_Test:
     def __init__(self, opt, device, downscale=1):
         super().__init__()
@@ -332,6 +407,7 @@ class NeRFDataset_Test:
 
         results['poses'] = convert_poses(poses) # [B, 6]
         results['poses_matrix'] = poses # [B, 4, 4]
+        results['intrinsics'] = self.intrinsics # [4]
             
         return results
 
@@ -364,6 +440,7 @@ class NeRFDataset:
         self.downscale = downscale
         self.root_path = opt.path
         self.preload = opt.preload # 0 = disk, 1 = cpu, 2 = gpu
+        self.frame_store = self.preload == 0 and opt.frame_store # read gt images from the packed frame store
         self.scale = opt.scale # camera radius scale to make sure camera are inside the bounding box.
         self.offset = opt.offset # camera offset
         self.bound = opt.bound # bounding box half length, also used as the radius to random sample poses.
@@ -373,7 +450,11 @@ class NeRFDataset:
         self.end_index = opt.data_range[1]
 
         self.training = self.type in ['train', 'all', 'trainval']
-        self.num_rays = self.opt.num_rays if self.training else -1
+        # with --train_batch B, each of the B frames of a step contributes num_rays / B rays
+        self.num_rays = self.opt.num_rays // self.opt.train_batch if self.training else -1
+
+        # the torso composited over the bg is only read in training, or as the bg when the torso is not rendered
+        self.use_bg_torso = not self.opt.torso or self.training
 
         # load nerf-compatible format data.
         
@@ -482,6 +563,8 @@ class NeRFDataset:
         self.lips_rect = []
         self.eye_area = []
 
+        landmarks = load_landmarks(self.root_path)
+
         for f in tqdm.tqdm(frames, desc=f'Loading {type} data'):
 
             f_path = os.path.join(self.root_path, 'gt_imgs', str(f['img_id']) + '.jpg')
@@ -495,9 +578,8 @@ class NeRFDataset:
             self.poses.append(pose)
 
             if self.preload > 0:
-                image = cv2.imread(f_path, cv2.IMREAD_UNCHANGED) # [H, W, 3] o [H, W, 4]
-                image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-                image = image.astype(np.float32) / 255 # [H, W, 3/4]
+                image = cv2.imread(f_path, cv2.IMREAD_UNCHANGED) # [H, W, 3]
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB) # uint8, converted to float after the ray gather in collate
 
                 self.images.append(image)
             else:
@@ -507,14 +589,14 @@ class NeRFDataset:
         
             torso_img_path = os.path.join(self.root_path, 'torso_imgs', str(f['img_id']) + '.png')
 
-            if self.preload > 0:
-                torso_img = cv2.imread(torso_img_path, cv2.IMREAD_UNCHANGED) # [H, W, 4]
-                torso_img = cv2.cvtColor(torso_img, cv2.COLOR_BGRA2RGBA)
-                torso_img = torso_img.astype(np.float32) / 255 # [H, W, 3/4]
+            if self.use_bg_torso:
+                if self.preload > 0:
+                    torso_img = cv2.imread(torso_img_path, cv2.IMREAD_UNCHANGED) # [H, W, 4]
+                    torso_img = cv2.cvtColor(torso_img, cv2.COLOR_BGRA2RGBA) # uint8, composited over the bg below
 
-                self.torso_img.append(torso_img)
-            else:
-                self.torso_img.append(torso_img_path)
+                    self.torso_img.append(torso_img)
+                else:
+                    self.torso_img.append(torso_img_path)
 
             # find the corresponding audio to the image frame
             if not self.opt.asr and self.opt.aud == '':
@@ -522,7 +604,7 @@ class NeRFDataset:
                 self.auds.append(aud)
 
             # load lms and extract face
-            lms = np.loadtxt(os.path.join(self.root_path, 'ori_imgs', str(f['img_id']) + '.lms')) # [68, 2]
+            lms = landmarks[str(f['img_id'])] # [68, 2]
 
             xmin, xmax = int(lms[31:36, 1].min()), int(lms[:, 1].max())
             ymin, ymax = int(lms[:, 0].min()), int(lms[:, 0].max())
@@ -575,6 +657,19 @@ class NeRFDataset:
 
         self.bg_img = bg_img
 
+        # the torso composited over the bg once per frame, uint8 [N, H, W, 3]
+        self.bg_torso_img = None
+        if self.preload > 0:
+            if self.use_bg_torso:
+                self.bg_torso_img = np.stack([composite_bg_torso(torso_img, bg_img) for torso_img in self.torso_img], axis=0)
+        elif self.use_bg_torso or self.frame_store:
+            store = self.load_frame_store(bg_img, self.torso_img if self.use_bg_torso else None, self.images if self.frame_store else None) # [N, 1/2, H, W, 3]
+            if self.use_bg_torso:
+                self.bg_torso_img = store[:, 0]
+            if self.frame_store:
+                self.images = store[:, -1]
+        del self.torso_img
+
         self.poses = np.stack(self.poses, axis=0)
 
         # smooth camera path...
@@ -584,11 +679,11 @@ class NeRFDataset:
         self.poses = torch.from_numpy(self.poses) # [N, 4, 4]
 
         if self.preload > 0:
-            self.images = torch.from_numpy(np.stack(self.images, axis=0)) # [N, H, W, C]
-            self.torso_img = torch.from_numpy(np.stack(self.torso_img, axis=0)) # [N, H, W, C]
-        else:
+            self.images = torch.from_numpy(np.stack(self.images, axis=0)) # [N, H, W, 3], uint8
+            if self.bg_torso_img is not None:
+                self.bg_torso_img = torch.from_numpy(self.bg_torso_img) # [N, H, W, 3]
+        elif not self.frame_store:
             self.images = np.array(self.images)
-            self.torso_img = np.array(self.torso_img)
 
         if self.opt.asr:
             # live streaming, no pre-calculated auds
@@ -638,8 +733,9 @@ class NeRFDataset:
 
             self.bg_img = self.bg_img.to(torch.half).to(self.device)
 
-            self.torso_img = self.torso_img.to(torch.half).to(self.device)
-            self.images = self.images.to(torch.half).to(self.device)
+            if self.bg_torso_img is not None:
+                self.bg_torso_img = self.bg_torso_img.to(self.device)
+            self.images = self.images.to(self.device)
             
             if self.opt.exp_eye:
                 self.eye_area = self.eye_area.to(self.device)
@@ -678,10 +774,78 @@ class NeRFDataset:
             return size - res - 1
 
 
+    def load_frame_store(self, bg_img, torso_paths=None, image_paths=None):
+        ''' preload == 0: pack the frames once into a contiguous uint8 [N, P, H, W, 3] .npy in the workspace cache, and memory-map it.
+        The planes are the torso composited over the bg (if torso_paths is given), then the gt image (if image_paths is given).
+        The store is keyed by the source images (path, size, mtime) and the bg image.
+        Args:
+            bg_img: float [H, W, 3] in [0, 1]
+            torso_paths: optional list of N torso RGBA .png paths
+            image_paths: optional list of N gt image paths
+        Returns:
+            store: np.memmap, uint8 [N, P, H, W, 3], read-only
+        '''
+        planes = [paths for paths in (torso_paths, image_paths) if paths is not None]
+        key = hashlib.sha1()
+        key.update(f'torso={torso_paths is not None}_image={image_paths is not None}'.encode())
+        for paths in planes:
+            for path in paths:
+                key.update(f'{path}_{os.path.getsize(path)}_{os.path.getmtime(path)}'.encode())
+        key.update(np.ascontiguousarray(bg_img, dtype=np.float32).tobytes())
+        store_path = os.path.join(self.opt.workspace, 'cache', f'frames_{key.hexdigest()}.npy')
+
+        if not os.path.exists(store_path):
+            os.makedirs(os.path.dirname(store_path), exist_ok=True)
+            tmp_path = store_path + '.tmp'
+            N = len(planes[0])
+            store = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(N, len(planes), self.H, self.W, 3))
+            for i in tqdm.tqdm(range(N), desc=f'Packing {self.type} frames'):
+                p = 0
+                if torso_paths is not None:
+                    torso_img = cv2.imread(torso_paths[i], cv2.IMREAD_UNCHANGED) # [H, W, 4]
+                    torso_img = cv2.cvtColor(torso_img, cv2.COLOR_BGRA2RGBA)
+                    store[i, p] = composite_bg_torso(torso_img, bg_img)
+                    p += 1
+                if image_paths is not None:
+                    image = cv2.imread(image_paths[i], cv2.IMREAD_UNCHANGED) # [H, W, 3]
+                    store[i, p] = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            store.flush()
+            del store
+            os.replace(tmp_path, store_path)
+
+        print(f'[INFO] load frame store: {store_path}')
+
+        return np.load(store_path, mmap_mode='r')
+
+
+    def read_frame(self, frames, index, inds=None):
+        # frames: uint8 [N, H, W, 3], a tensor, or a memory map if preload == 0
+        # inds: [B, N], only read these rays, None for the whole frame
+        # return: uint8 [B, N or H*W, 3] on device
+        frame = frames[index[0]] # [H, W, 3]
+        if self.preload == 0:
+            # slice the rays straight out of the memory map, only their pages are read
+            frame = frame.reshape(-1, 3)
+            if inds is not None:
+                frame = frame[inds[0].cpu().numpy()]
+            return torch.from_numpy(np.array(frame)).unsqueeze(0).to(self.device) # copy, the memory map is read-only
+
+        frame = frame.view(1, -1, 3).to(self.device)
+        if inds is not None:
+            frame = torch.gather(frame, 1, torch.stack(3 * [inds], -1)) # [B, N, 3]
+        return frame
+
+
     def collate(self, index):
 
-        B = len(index) # a list of length 1
-        # assert B == 1
+        B = len(index) # a list of length 1, or --train_batch
+
+        if B > 1:
+            # collate each frame on its own and stack them, their rays are rendered in one step
+            datas = [self.collate([i]) for i in index]
+            results = merge_frames(datas)
+            results['bg_coords'] = torch.cat([data['bg_coords'] for data in datas], dim=1) # [1, B * N, 2]
+            return results
 
         results = {}
 
@@ -723,41 +887,34 @@ class NeRFDataset:
         else:
             results['eye'] = None
 
-        # load bg
-        bg_torso_img = self.torso_img[index]
-        if self.preload == 0: # on the fly loading
-            bg_torso_img = cv2.imread(bg_torso_img[0], cv2.IMREAD_UNCHANGED) # [H, W, 4]
-            bg_torso_img = cv2.cvtColor(bg_torso_img, cv2.COLOR_BGRA2RGBA)
-            bg_torso_img = bg_torso_img.astype(np.float32) / 255 # [H, W, 3/4]
-            bg_torso_img = torch.from_numpy(bg_torso_img).unsqueeze(0)
-        bg_torso_img = bg_torso_img[..., :3] * bg_torso_img[..., 3:] + self.bg_img * (1 - bg_torso_img[..., 3:])
-        bg_torso_img = bg_torso_img.view(B, -1, 3).to(self.device)
+        # load bg, with the torso precomputed over it (uint8), only the sampled rays are converted
+        if not self.opt.torso or self.training:
+            bg_torso_img = self.read_frame(self.bg_torso_img, index, rays['inds'] if self.training else None).float() / 255 # [B, N, 3]
 
         if not self.opt.torso:
             bg_img = bg_torso_img
         else:
             bg_img = self.bg_img.view(1, -1, 3).repeat(B, 1, 1).to(self.device)
-
-        if self.training:
-            bg_img = torch.gather(bg_img, 1, torch.stack(3 * [rays['inds']], -1)) # [B, N, 3]
+            if self.training:
+                bg_img = torch.gather(bg_img, 1, torch.stack(3 * [rays['inds']], -1)) # [B, N, 3]
 
         results['bg_color'] = bg_img
 
         if self.opt.torso and self.training:
-            bg_torso_img = torch.gather(bg_torso_img, 1, torch.stack(3 * [rays['inds']], -1)) # [B, N, 3]
             results['bg_torso_color'] = bg_torso_img
 
-        images = self.images[index] # [B, H, W, 3/4]
-        if self.preload == 0:
-            images = cv2.imread(images[0], cv2.IMREAD_UNCHANGED) # [H, W, 3]
+        if self.preload > 0 or self.frame_store:
+            images = self.read_frame(self.images, index, rays['inds'] if self.training else None).float() / 255 # [B, N, 3]
+            if not self.training:
+                images = images.view(B, self.H, self.W, 3)
+        else: # on the fly loading
+            images = cv2.imread(self.images[index[0]], cv2.IMREAD_UNCHANGED) # [H, W, 3]
             images = cv2.cvtColor(images, cv2.COLOR_BGR2RGB)
             images = images.astype(np.float32) / 255 # [H, W, 3]
-            images = torch.from_numpy(images).unsqueeze(0)
-        images = images.to(self.device)
+            images = torch.from_numpy(images).unsqueeze(0).to(self.device) # [B, H, W, 3]
 
-        if self.training:
-            C = images.shape[-1]
-            images = torch.gather(images.view(B, -1, C), 1, torch.stack(C * [rays['inds']], -1)) # [B, N, 3/4]
+            if self.training:
+                images = torch.gather(images.view(B, -1, 3), 1, torch.stack(3 * [rays['inds']], -1)) # [B, N, 3]
             
         results['images'] = images
 
@@ -770,6 +927,7 @@ class NeRFDataset:
 
         results['poses'] = convert_poses(poses) # [B, 6]
         results['poses_matrix'] = poses # [B, 4, 4]
+        results['intrinsics'] = self.intrinsics # [4]
             
         return results
 
@@ -786,10 +944,13 @@ class NeRFDataset:
             else:
                 size = 2 * self.poses.shape[0]
 
-        loader = DataLoader(list(range(size)), batch_size=1, collate_fn=self.collate, shuffle=self.training, num_workers=0)
+        loader = DataLoader(list(range(size)), batch_size=self.opt.train_batch if self.training else 1, collate_fn=self.collate, shuffle=self.training, num_workers=0)
         loader._data = self # an ugly fix... we need poses in trainer.
 
         # do evaluate if has gt images and use self-driven setting
         loader.has_gt = (self.opt.aud == '')
 
+        if self.opt.prefetch > 0:
+            loader = PrefetchLoader(loader, self.opt.prefetch, self.opt.prefetch_threads)
+
         return loader        
\ No newline at end of file
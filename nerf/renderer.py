@@ -1,4 +1,6 @@
+import os
 import math
+import hashlib
 import trimesh
 import numpy as np
 import random
@@ -8,7 +10,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 import raymarching
-from .utils import custom_meshgrid, get_audio_features, euler_angles_to_matrix, convert_poses
+from .utils import get_audio_features, euler_angles_to_matrix, convert_poses, get_bg_coords
+from .scheduler import get_step_scheduler
 
 def sample_pdf(bins, weights, n_samples, det=False):
     # This implementation is from NeRF
@@ -59,6 +62,37 @@ def plot_pointcloud(pc, color=None):
     trimesh.Scene([pc, axes, sphere]).show()
 
 
+# log-quantized uint8 density grid: code 0 is an untrained cell (-1), codes 1 ... 255 cover log1p(density) in [0, log1p(GRID_LOG_MAX)].
+GRID_LOG_MAX = 1e4
+
+
+def encode_density_grid(grid, dtype='float32'):
+    ''' convert a float32 density grid to its storage dtype.
+    uint8 codes are rounded to the nearest level (a step is ~4% of the density), so encoding a decoded grid keeps its codes.
+    Args:
+        grid: float, [CAS, H * H * H], -1 for untrained cells
+        dtype: str, float32 / float16 / uint8
+    Returns:
+        grid: [CAS, H * H * H] of dtype
+    '''
+    if dtype == 'float16':
+        return grid.clamp(max=65504).half()
+    elif dtype == 'uint8':
+        code = torch.log1p(grid.clamp(0, GRID_LOG_MAX)) / math.log1p(GRID_LOG_MAX) * 254 + 1
+        code = torch.round(code).clamp(1, 255)
+        return torch.where(grid < 0, torch.zeros_like(code), code).to(torch.uint8)
+    return grid.float()
+
+
+def decode_density_grid(grid):
+    # inverse of encode_density_grid, the storage dtype is read from the tensor.
+    # return: float32, [CAS, H * H * H]
+    if grid.dtype == torch.uint8:
+        density = torch.expm1((grid.float() - 1) / 254 * math.log1p(GRID_LOG_MAX))
+        return torch.where(grid == 0, - torch.ones_like(density), density)
+    return grid.float()
+
+
 class NeRFRenderer(nn.Module):
     def __init__(self, opt):
 
@@ -108,13 +142,49 @@ class NeRFRenderer(nn.Module):
 
         # extra state for cuda raymarching
     
-        # 3D head density grid
-        density_grid = torch.zeros([self.cascade, self.grid_size ** 3]) # [CAS, H * H * H]
+        # 3D head density grid, stored as --grid_dtype in checkpoints and at inference. Training keeps it in float32,
+        # the ema update would flicker on a quantized grid. Inference with --bitfield_only keeps just the bitfield.
+        self.grid_dtype = self.opt.grid_dtype
+        self.grid_resident_dtype = self.grid_dtype if self.opt.test else 'float32'
+        if self.opt.bitfield_only:
+            density_grid = None
+        else:
+            density_grid = encode_density_grid(torch.zeros([self.cascade, self.grid_size ** 3]), self.grid_resident_dtype) # [CAS, H * H * H]
         density_bitfield = torch.zeros(self.cascade * self.grid_size ** 3 // 8, dtype=torch.uint8) # [CAS * H * H * H // 8]
         self.register_buffer('density_grid', density_grid)
         self.register_buffer('density_bitfield', density_bitfield)
         self.mean_density = 0
         self.iter_density = 0
+        # occupied cells of density_bitfield in world space, for screen-space culling at inference.
+        self.occupied_cells = None
+        # cell positions of the density grids, built once (see get_grid_xyzs / get_torso_grid_xys).
+        self.grid_xyzs = None
+        self.torso_grid_xys = None
+        # occupancy pyramid over density_bitfield, lets ray marching skip large empty blocks.
+        self.mip_levels = self.opt.mip_levels
+        self.density_bitfield_mip = None
+        # fraction of cells re-evaluated per update once warmed up, and the telemetry of the last update.
+        self.grid_update_ratio = self.opt.grid_update_ratio
+        self.grid_change_rate = 1.0 # fraction of occupancy bits flipped by the last update
+        self.grid_cells_updated = 0 # density queries of the last update
+        self.grid_cells_total = 0 # density queries of a full update with one condition
+        # conditions (random audio / eye) whose max density updates the grid, and whether updates are stopped (converged).
+        self.grid_update_conds = self.opt.grid_update_conds
+        self.grid_frozen = False
+        # bitfields of condition clusters for inference (see build_grid_clusters), stored in the checkpoint, and their selected unions / pyramids.
+        self.grid_clusters = None
+        self.grid_cluster_cache = {}
+        # pixels over the torso density grid per inference resolution (see get_torso_mask), until the torso grid is updated.
+        self.torso_mask_cache = {}
+        # torso layers of previous frames keyed by quantized head pose (see get_torso_layer), and how often they were reused.
+        self.torso_layer_cache = {}
+        self.torso_layer_stats = {'hits': 0, 'calls': 0}
+        # torso rendered on a coarser pixel grid at inference (see get_torso_layer_upsampled), 1 for full resolution.
+        self.torso_downscale = self.opt.torso_downscale
+        # last inference frame's surface, for temporal warm-start of ray marching.
+        self.warm_start_state = None
+        # number of steps per call of the inference march loop (network batch size), and its telemetry.
+        self.step_scheduler = get_step_scheduler(self.opt.march_policy, self.opt.march_n_step, self.opt.march_samples)
 
         # 2D torso density grid
         if self.torso:
@@ -142,26 +212,329 @@ class NeRFRenderer(nn.Module):
     def color(self, x, d, mask=None, **kwargs):
         raise NotImplementedError()
 
+    # per-frame conditioning context passed to forward / density as `cond`.
+    def get_cond(self, enc_a, c=None, e=None):
+        raise NotImplementedError()
+
     def reset_extra_state(self):
         if not self.cuda_ray:
             return 
         # density grid
-        self.density_grid.zero_()
+        self.set_density_grid(torch.zeros_like(self.get_density_grid()))
         self.mean_density = 0
         self.iter_density = 0
+        self.grid_change_rate = 1.0
+        self.grid_frozen = False
         # step counter
         self.step_counter.zero_()
         self.mean_count = 0
         self.local_step = 0
 
 
-    def run_cuda(self, rays_o, rays_d, auds, bg_coords, poses, eye=None, index=0, dt_gamma=0, bg_color=None, perturb=False, force_all_rays=False, max_steps=1024, T_thresh=1e-4, **kwargs):
-        # rays_o, rays_d: [B, N, 3], assumes B == 1
-        # auds: [B, 16] or [B, 68, 3]
+    def get_density_grid(self):
+        # float32 density grid [CAS, H * H * H], -1 for untrained cells. This is the buffer itself if stored as float32, else a decoded copy.
+        return decode_density_grid(self.density_grid)
+
+
+    def set_density_grid(self, grid):
+        # store a float32 density grid (from get_density_grid) in the resident dtype.
+        self.density_grid.copy_(encode_density_grid(grid, self.grid_resident_dtype))
+
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        # checkpoints always store density_grid as --grid_dtype.
+        super()._save_to_state_dict(destination, prefix, keep_vars)
+        key = prefix + 'density_grid'
+        if key in destination and self.grid_resident_dtype != self.grid_dtype:
+            destination[key] = encode_density_grid(decode_density_grid(destination[key]), self.grid_dtype)
+
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints may store density_grid in another dtype, or have none (best checkpoints).
+        key = prefix + 'density_grid'
+        if key in state_dict:
+            if self.density_grid is None:
+                state_dict.pop(key)
+            elif state_dict[key].dtype != self.density_grid.dtype:
+                state_dict[key] = encode_density_grid(decode_density_grid(state_dict[key]), self.grid_resident_dtype)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+    def reset_bitfield_caches(self):
+        # drop everything derived from density_bitfield, rebuilt lazily on next use.
+        self.occupied_cells = None
+        self.density_bitfield_mip = None
+        self.grid_cluster_cache = {}
+        self.torso_mask_cache = {}
+        self.torso_layer_cache = {}
+
+
+    @torch.no_grad()
+    def get_grid_xyzs(self):
+        # positions of all density grid cells in morton order (density_grid[cas, i] <--> xyzs[cas][i]), cached.
+        # return: list of C [H * H * H, 3], scaled to each cascade (noise is added by the caller).
+        device = self.density_bitfield.device
+        if self.grid_xyzs is None or self.grid_xyzs[0].device != device:
+            indices = torch.arange(self.grid_size ** 3, dtype=torch.int32, device=device)
+            coords = raymarching.morton3D_invert(indices) # [H * H * H, 3], in [0, 128)
+            xyzs = 2 * coords.float() / (self.grid_size - 1) - 1 # [H * H * H, 3] in [-1, 1]
+            self.grid_xyzs = []
+            for cas in range(self.cascade):
+                bound = min(2 ** cas, self.bound)
+                half_grid_size = bound / self.grid_size
+                # scale to current cascade's resolution
+                self.grid_xyzs.append(xyzs * (bound - half_grid_size))
+        return self.grid_xyzs
+
+
+    @torch.no_grad()
+    def get_torso_grid_xys(self):
+        # positions of all torso density grid cells in index order (density_grid_torso[i] <--> xys[i]), cached.
+        # return: [H * H, 2] (noise is added by the caller).
+        device = self.density_bitfield.device
+        if self.torso_grid_xys is None or self.torso_grid_xys.device != device:
+            indices = torch.arange(self.grid_size ** 2, device=device)
+            coords = torch.stack([indices % self.grid_size, torch.div(indices, self.grid_size, rounding_mode='floor')], dim=-1) # NOTE: xy transposed!
+            xys = 2 * coords.float() / (self.grid_size - 1) - 1 # [H * H, 2] in [-1, 1]
+            self.torso_grid_xys = xys * (1 - 1 / self.grid_size)
+        return self.torso_grid_xys
+
+
+    @torch.no_grad()
+    def get_bitfield_mip(self):
+        if self.density_bitfield_mip is None:
+            self.density_bitfield_mip = raymarching.mip_bitfield(self.density_bitfield, self.cascade, self.mip_levels)
+        return self.density_bitfield_mip
+
+
+    def get_resolution_key(self, bg_coords):
+        # identifies the full-image bg_coords [H * W, 2] of an inference resolution by their count and first / last coords.
+        return (bg_coords.shape[0],) + tuple(bg_coords[[0, 1, -1]].view(-1).tolist())
+
+
+    @torch.no_grad()
+    def get_torso_mask(self, bg_coords):
+        # pixels whose torso occupancy passes the threshold, sampled from density_grid_torso.
+        # bg_coords: [N, 2] (of one frame)
+        # return: indices [M] (int64) of these pixels and their bg_coords [M, 2].
+        # At inference bg_coords cover the full image, so the result is cached per resolution until the torso grid is updated.
+        if not self.training:
+            key = self.get_resolution_key(bg_coords)
+            if key in self.torso_mask_cache:
+                return self.torso_mask_cache[key]
+
+        density_thresh_torso = min(self.density_thresh_torso, self.mean_density_torso)
+        occupancy = F.grid_sample(self.density_grid_torso.view(1, 1, self.grid_size, self.grid_size), bg_coords.view(1, -1, 1, 2), align_corners=True).view(-1)
+        inds = torch.nonzero(occupancy > density_thresh_torso).squeeze(-1)
+        result = (inds, bg_coords[inds])
+
+        if not self.training:
+            self.torso_mask_cache[key] = result
+        return result
+
+
+    def get_torso_layer(self, bg_coords, mask_coords, poses, enc_a, ind_code=None):
+        # torso alpha [M, 1], color [M, 3] and deform of the masked pixels (mask_coords, from get_torso_mask(bg_coords)) of one frame.
+        # forward_torso only depends on the pixels, the head pose [1, 6] and the individual code (fixed at inference),
+        # so at inference with --torso_reuse_thresh > 0 a layer is reused by all frames whose pose falls in the same bin of that size.
+        thresh = self.opt.torso_reuse_thresh
+        if self.training or thresh <= 0:
+            self.torso_layer_cache = {}
+            return self.forward_torso(mask_coords, poses, enc_a, ind_code)
+
+        # the mask is fixed per resolution until the torso grid is updated, which drops this cache too.
+        key = self.get_resolution_key(bg_coords) + tuple(torch.round(poses.view(-1) / thresh).long().tolist())
+        self.torso_layer_stats['calls'] += 1
+        if key in self.torso_layer_cache:
+            self.torso_layer_stats['hits'] += 1
+        else:
+            # poses may drift through many bins
+            if len(self.torso_layer_cache) >= 16:
+                self.torso_layer_cache = {}
+            self.torso_layer_cache[key] = self.forward_torso(mask_coords, poses, enc_a, ind_code)
+        return self.torso_layer_cache[key]
+
+
+    @torch.no_grad()
+    def get_torso_coarse_grid(self, bg_coords, factor):
+        # bg_coords of a factor x coarser pixel grid than the full-image bg_coords [H * W, 2], cached per resolution with the torso masks.
+        # return: coarse bg_coords [h * w, 2], h, w
+        key = ('coarse', factor) + self.get_resolution_key(bg_coords)
+        if key not in self.torso_mask_cache:
+            # bg_coords[i * W + j] = (X[i], Y[j]), see get_bg_coords
+            W = (bg_coords[:, 0] == bg_coords[0, 0]).sum().item()
+            H = bg_coords.shape[0] // W
+            h, w = max(H // factor, 2), max(W // factor, 2)
+            self.torso_mask_cache[key] = (get_bg_coords(h, w, bg_coords.device).view(-1, 2), h, w)
+        return self.torso_mask_cache[key]
+
+
+    @torch.no_grad()
+    def get_torso_layer_upsampled(self, bg_coords, mask_inds, mask_coords, poses, enc_a, ind_code, head_alpha, factor):
+        # torso alpha [M, 1] and color [M, 3] of the masked pixels (from get_torso_mask), evaluated on a factor x coarser pixel grid and bilinearly upsampled.
+        # Torso edges (upsampled alpha away from 0 and 1) that the head does not cover (head_alpha < 0.99) are evaluated at full resolution.
+        # bg_coords: [H * W, 2], head_alpha: [H * W], weights_sum of the frame
+        coarse_coords, h, w = self.get_torso_coarse_grid(bg_coords, factor)
+        coarse_inds, coarse_mask_coords = self.get_torso_mask(coarse_coords)
+
+        layer = torch.zeros(h * w, 4, device=bg_coords.device)
+        if coarse_inds.shape[0] > 0:
+            alpha, color, _ = self.get_torso_layer(coarse_coords, coarse_mask_coords, poses, enc_a, ind_code)
+            layer[coarse_inds] = torch.cat([alpha, color], dim=-1).float()
+
+        # rows of the pixel grid are x, so grid_sample takes (y, x)
+        layer = layer.view(1, h, w, 4).permute(0, 3, 1, 2)
+        layer = F.grid_sample(layer, mask_coords.flip(-1).view(1, -1, 1, 2), align_corners=True).view(4, -1).t() # [M, 4]
+        alpha, color = layer[:, :1].contiguous(), layer[:, 1:].contiguous()
+
+        refine = (alpha[:, 0] > 0.01) & (alpha[:, 0] < 0.99) & (head_alpha[mask_inds] < 0.99)
+        refine_inds = torch.nonzero(refine).squeeze(-1)
+        if refine_inds.shape[0] > 0:
+            alpha_refine, color_refine, _ = self.forward_torso(mask_coords[refine_inds], poses, enc_a, ind_code)
+            alpha[refine_inds] = alpha_refine.float()
+            color[refine_inds] = color_refine.float()
+
+        return alpha, color
+
+
+    @torch.no_grad()
+    def get_occupied_cells(self):
+        # world-space centers [M, 3] and half sizes [M] of the occupied cells in density_bitfield, cached until the bitfield is updated.
+        if self.occupied_cells is None:
+            H3 = self.grid_size ** 3
+            shifts = torch.arange(8, dtype=torch.uint8, device=self.density_bitfield.device)
+            bits = (self.density_bitfield.unsqueeze(-1) >> shifts) & 1 # [CAS * H * H * H // 8, 8]
+            indices = torch.nonzero(bits.view(-1)).squeeze(-1) # [M], cas * H3 + morton
+
+            cas = torch.div(indices, H3, rounding_mode='floor')
+            coords = raymarching.morton3D_invert((indices - cas * H3).int()).float() # [M, 3], in [0, 128)
+            mip_bound = torch.clamp(2 ** cas.float(), max=self.bound) # [M]
+
+            # same cell layout as the ray marching kernels: cell n covers [2n/H - 1, 2(n+1)/H - 1] * mip_bound
+            xyzs = ((2 * coords + 1) / self.grid_size - 1) * mip_bound.unsqueeze(-1)
+            half_sizes = mip_bound / self.grid_size
+
+            self.occupied_cells = (xyzs, half_sizes)
+
+        return self.occupied_cells
+
+    @torch.no_grad()
+    def get_head_rect(self, pose, intrinsics, H, W, margin=1):
+        ''' screen-space bounding box of the occupied cells in density_bitfield.
+        Rays outside of it only pass empty cells, so they can be skipped by run_cuda at inference.
+        Args:
+            pose: [1, 4, 4] or [4, 4], cam2world
+            intrinsics: [4], (fx, fy, cx, cy)
+            H, W: int
+        Returns:
+            rect: (xmin, xmax, ymin, ymax), the same [row, col] convention as get_rays, or None if it cannot be bounded.
+        '''
+
+        xyzs, half_sizes = self.get_occupied_cells()
+
+        if xyzs.shape[0] == 0:
+            return (0, 0, 0, 0)
+
+        fx, fy, cx, cy = intrinsics
+        pose = pose.view(4, 4).to(xyzs.device, torch.float32)
+
+        # world2cam, bound each cell by its circumscribed sphere
+        cam_xyzs = (xyzs - pose[:3, 3]) @ pose[:3, :3] # [M, 3]
+        radius = half_sizes * math.sqrt(3) # [M]
+
+        z = cam_xyzs[:, 2]
+        # cells fully behind the camera are never hit
+        front = z > - radius
+        cam_xyzs, radius, z = cam_xyzs[front], radius[front], z[front]
+
+        if cam_xyzs.shape[0] == 0:
+            return (0, 0, 0, 0)
+
+        # a cell crossing the image plane has no finite projection, fall back to the full image.
+        if (z - radius <= 0).any():
+            return None
+
+        # x / z is monotonic in z, so the extremes over the cell lie at z - r or z + r
+        z_near = (z - radius).unsqueeze(-1)
+        z_far = (z + radius).unsqueeze(-1)
+        lo = cam_xyzs[:, :2] - radius.unsqueeze(-1)
+        hi = cam_xyzs[:, :2] + radius.unsqueeze(-1)
+        lo = torch.minimum(lo / z_near, lo / z_far).amin(0) # [2]
+        hi = torch.maximum(hi / z_near, hi / z_far).amax(0) # [2]
+
+        # rays go through pixel centers (i + 0.5, j + 0.5)
+        ymin = max(int(math.floor(lo[0].item() * fx + cx - 0.5)) - margin, 0)
+        ymax = min(int(math.ceil(hi[0].item() * fx + cx - 0.5)) + 1 + margin, W)
+        xmin = max(int(math.floor(lo[1].item() * fy + cy - 0.5)) - margin, 0)
+        xmax = min(int(math.ceil(hi[1].item() * fy + cy - 0.5)) + 1 + margin, H)
+
+        return (xmin, max(xmin, xmax), ymin, max(ymin, ymax))
+
+    @torch.no_grad()
+    def get_warm_start(self, rays_o, rays_d, poses, nears, margin=0.05):
+        ''' start each ray a safety margin before the surface its pixel hit in the last frame.
+        The last surface points are kept in world space and re-expressed along the current rays,
+        so a small pose delta is accounted for. Falls back to nears when the pose jumps.
+        Args:
+            rays_o, rays_d: [N, 3]
+            poses: [1, 6], euler angles + translation
+            nears: [N]
+        Returns:
+            rays_t: [N]
+        '''
+
+        state = self.warm_start_state
+        if state is None or state['xyzs'].shape[0] != rays_o.shape[0]:
+            return nears.clone()
+
+        # how far the head (around the origin) moves in camera space, rotation x camera distance + translation.
+        poses = poses.view(-1).float()
+        d_rot = poses[:3] - state['poses'][:3]
+        d_rot = torch.atan2(torch.sin(d_rot), torch.cos(d_rot)).abs().max()
+        d_trans = (poses[3:] - state['poses'][3:]).norm()
+        if (d_rot * poses[3:].norm() + d_trans).item() > margin:
+            return nears.clone()
+
+        t = ((state['xyzs'] - rays_o) * rays_d).sum(-1) - margin
+        return torch.where(state['valid'], torch.maximum(nears, t), nears)
+
+    def select_cond(self, cond, frame, B):
+        # pick each sample's own frame from a B-frame conditioning context.
+        # cond: from get_cond, per-frame entries are [B, ...], shared ones (e.g. the test ind code) are kept as is.
+        # frame: int64, [M], frame index of each sample.
+        def _select(v):
+            if torch.is_tensor(v) and v.dim() > 1 and v.shape[0] == B:
+                return v[frame]
+            return v
+        out = {}
+        for k, v in cond.items():
+            out[k] = [_select(x) for x in v] if isinstance(v, (list, tuple)) else _select(v)
+        return out
+
+    def get_sample_frames(self, rays, M, N_frame):
+        # frame index of each sample from march_rays_train, for B > 1 frames in a training step.
+        # rays: int32, [N, 3], (ray index, point offset, point count), a ray's samples are contiguous, but rays are not in order.
+        # return: int64, [M], alignment padding gets frame 0.
+        rays = rays.long()
+        frame = torch.div(rays[:, 0], N_frame, rounding_mode='floor')
+        # +frame at each ray's first sample and -frame after its last one, the prefix sum fills in the ray (empty rays cancel out)
+        delta = torch.zeros(M + 1, dtype=torch.long, device=rays.device)
+        delta.index_add_(0, rays[:, 1].clamp(max=M), frame)
+        delta.index_add_(0, (rays[:, 1] + rays[:, 2]).clamp(max=M), -frame)
+        return delta.cumsum(0)[:M]
+
+    def run_cuda(self, rays_o, rays_d, auds, bg_coords, poses, eye=None, index=0, dt_gamma=0, bg_color=None, perturb=False, force_all_rays=False, max_steps=1024, T_thresh=1e-4, head_mask=None, warm_start=False, warm_start_margin=0.05, **kwargs):
+        # rays_o, rays_d: [B, N, 3], B > 1 renders several frames in one call (--test_batch at inference, --train_batch in training)
+        # auds: [16] / [68, 3] windows of one frame, or stacked as [B, ...] if B > 1
+        # poses: [B, 6], eye: [B, 1]
         # index: [B]
+        # head_mask: [B * N], bool, only march these rays at inference (e.g. from get_head_rect), the rest only get torso/bg.
+        # warm_start: at inference, start rays from last frame's surface (see get_warm_start), only used if B == 1
         # return: image: [B, N, 3], depth: [B, N]
 
         prefix = rays_o.shape[:-1]
+        B = prefix[0] if len(prefix) > 1 else 1
+        warm_start = warm_start and B == 1
         rays_o = rays_o.contiguous().view(-1, 3)
         rays_d = rays_d.contiguous().view(-1, 3)
         bg_coords = bg_coords.contiguous().view(-1, 2)
@@ -171,10 +544,16 @@ class NeRFRenderer(nn.Module):
             dT = self.camera_dT[index] # [1, 3]
             dR = euler_angles_to_matrix(self.camera_dR[index] / 180 * np.pi + 1e-8).squeeze(0) # [1, 3] --> [3, 3]
             
-            rays_o = rays_o + dT
-            rays_d = rays_d @ dR
+            if B == 1:
+                rays_o = rays_o + dT
+                rays_d = rays_d @ dR
+            else:
+                # [B, 3], [B, 3, 3], per frame
+                rays_o = (rays_o.view(B, -1, 3) + dT.unsqueeze(1)).view(-1, 3)
+                rays_d = torch.bmm(rays_d.view(B, -1, 3), dR).view(-1, 3)
 
         N = rays_o.shape[0] # N = B * N, in fact
+        N_frame = N // B # rays per frame
         device = rays_o.device
 
         results = {}
@@ -185,13 +564,20 @@ class NeRFRenderer(nn.Module):
         fars = fars.detach()
 
         # encode audio
-        enc_a = self.encode_audio(auds) # [1, 64]
+        if B == 1:
+            enc_a = self.encode_audio(auds) # [1, 64]
+        else:
+            enc_a = torch.cat([self.encode_audio(auds[b]) for b in range(B)], dim=0) # [B, 64]
 
         if enc_a is not None and self.smooth_lips:
-            if self.enc_a is not None:
-                _lambda = 0.35
-                enc_a = _lambda * self.enc_a + (1 - _lambda) * enc_a
-            self.enc_a = enc_a
+            # frames are smoothed in order, exactly as if they were rendered one by one
+            enc_a = list(enc_a.split(1, dim=0))
+            for b in range(B):
+                if self.enc_a is not None:
+                    _lambda = 0.35
+                    enc_a[b] = _lambda * self.enc_a + (1 - _lambda) * enc_a[b]
+                self.enc_a = enc_a[b]
+            enc_a = torch.cat(enc_a, dim=0)
 
         
         if self.individual_dim > 0:
@@ -203,15 +589,23 @@ class NeRFRenderer(nn.Module):
         else:
             ind_code = None
 
+        # conditioning shared by all samples of this frame
+        cond = self.get_cond(enc_a, ind_code, eye)
+
         if self.training:
             # setup counter
             counter = self.step_counter[self.local_step % 16]
             counter.zero_() # set to 0
             self.local_step += 1
 
-            xyzs, dirs, deltas, rays = raymarching.march_rays_train(rays_o, rays_d, self.bound, self.density_bitfield, self.cascade, self.grid_size, nears, fars, counter, self.mean_count, perturb, 128, force_all_rays, dt_gamma, max_steps)
+            xyzs, dirs, deltas, rays = raymarching.march_rays_train(rays_o, rays_d, self.bound, self.density_bitfield, self.cascade, self.grid_size, nears, fars, counter, self.mean_count, perturb, 128, force_all_rays, dt_gamma, max_steps, self.get_bitfield_mip())
             
-            sigmas, rgbs, ambient = self(xyzs, dirs, enc_a, ind_code, eye)
+            if B > 1:
+                # each sample takes its ray's frame conditioning
+                frame = self.get_sample_frames(rays, xyzs.shape[0], N_frame)
+                sigmas, rgbs, ambient = self(xyzs, dirs, enc_a, ind_code, eye, cond=self.select_cond(cond, frame, B))
+            else:
+                sigmas, rgbs, ambient = self(xyzs, dirs, enc_a, ind_code, eye, cond=cond)
             sigmas = self.density_scale * sigmas
 
             #print(f'valid RGB query ratio: {mask.sum().item() / mask.shape[0]} (total = {mask.sum().item()})')
@@ -230,9 +624,17 @@ class NeRFRenderer(nn.Module):
             depth = torch.zeros(N, dtype=dtype, device=device)
             image = torch.zeros(N, 3, dtype=dtype, device=device)
             
-            n_alive = N
-            rays_alive = torch.arange(n_alive, dtype=torch.int32, device=device) # [N]
-            rays_t = nears.clone() # [N]
+            if head_mask is not None:
+                rays_alive = torch.nonzero(head_mask.view(-1)).squeeze(-1).int() # [n_alive]
+            else:
+                rays_alive = torch.arange(N, dtype=torch.int32, device=device) # [N]
+            if warm_start:
+                rays_t = self.get_warm_start(rays_o, rays_d, poses, nears, warm_start_margin) # [N]
+            else:
+                rays_t = nears.clone() # [N]
+
+            # occupancy of this frame's condition cluster if available, tighter than the union over all conditions
+            density_bitfield, density_bitfield_mip = self.get_cluster_bitfield(enc_a, eye)
 
             step = 0
             
@@ -246,11 +648,18 @@ class NeRFRenderer(nn.Module):
                     break
 
                 # decide compact_steps
-                n_step = max(min(N // n_alive, 8), 1)
+                n_step = self.step_scheduler(N, n_alive)
+                self.step_scheduler.record(n_alive, n_step)
 
-                xyzs, dirs, deltas = raymarching.march_rays(n_alive, n_step, rays_alive, rays_t, rays_o, rays_d, self.bound, self.density_bitfield, self.cascade, self.grid_size, nears, fars, 128, perturb if step == 0 else False, dt_gamma, max_steps)
+                xyzs, dirs, deltas = raymarching.march_rays(n_alive, n_step, rays_alive, rays_t, rays_o, rays_d, self.bound, density_bitfield, self.cascade, self.grid_size, nears, fars, 128, perturb if step == 0 else False, dt_gamma, max_steps, density_bitfield_mip)
 
-                sigmas, rgbs, ambient = self(xyzs, dirs, enc_a, ind_code, eye)
+                if B > 1:
+                    # points are laid out as [n_alive, n_step] (+ align padding), each takes its ray's frame conditioning
+                    frame = torch.div(rays_alive[:n_alive].long(), N_frame, rounding_mode='floor').repeat_interleave(n_step)
+                    frame = F.pad(frame, (0, xyzs.shape[0] - frame.shape[0]))
+                    sigmas, rgbs, ambient = self(xyzs, dirs, enc_a, ind_code, eye, cond=self.select_cond(cond, frame, B))
+                else:
+                    sigmas, rgbs, ambient = self(xyzs, dirs, enc_a, ind_code, eye, cond=cond)
                 sigmas = self.density_scale * sigmas
 
                 raymarching.composite_rays(n_alive, n_step, rays_alive, rays_t, sigmas, rgbs, deltas, weights_sum, depth, image, T_thresh)
@@ -260,10 +669,24 @@ class NeRFRenderer(nn.Module):
                 # print(f'step = {step}, n_step = {n_step}, n_alive = {n_alive}, xyzs: {xyzs.shape}')
 
                 step += n_step
+
+            self.step_scheduler.end_frame(B)
+
+            if warm_start:
+                # expected depth of mostly opaque rays
+                valid = weights_sum > 0.5
+                t_surface = depth / weights_sum.clamp(min=1e-6)
+                self.warm_start_state = {
+                    'poses': poses.detach().view(-1).float(),
+                    'xyzs': rays_o + t_surface.unsqueeze(-1) * rays_d,
+                    'valid': valid,
+                }
             
         # background
         if bg_color is None:
             bg_color = 1
+        elif B > 1 and torch.is_tensor(bg_color) and bg_color.dim() == 3:
+            bg_color = bg_color.expand(B, N_frame, 3).reshape(-1, 3) # [B * N, 3]
 
         # first mix torso with background
         if self.torso:
@@ -278,28 +701,51 @@ class NeRFRenderer(nn.Module):
                 ind_code_torso = None
             
             # 2D density grid for acceleration...
-            density_thresh_torso = min(self.density_thresh_torso, self.mean_density_torso)
-            occupancy = F.grid_sample(self.density_grid_torso.view(1, 1, self.grid_size, self.grid_size), bg_coords.view(1, -1, 1, 2), align_corners=True).view(-1)
-            mask = occupancy > density_thresh_torso
+            mask_inds, mask_coords = self.get_torso_mask(bg_coords) # [M], [M, 2]
 
             # masked query of torso
             torso_alpha = torch.zeros([N, 1], device=device)
             torso_color = torch.zeros([N, 3], device=device)
 
-            if mask.any():
-                torso_alpha_mask, torso_color_mask, deform = self.forward_torso(bg_coords[mask], poses, enc_a, ind_code_torso)
-
-                torso_alpha[mask] = torso_alpha_mask.float()
-                torso_color[mask] = torso_color_mask.float()
-
-                results['deform'] = deform
+            if mask_inds.shape[0] > 0:
+                if B == 1 and (self.training or self.torso_downscale <= 1):
+                    torso_alpha_mask, torso_color_mask, deform = self.get_torso_layer(bg_coords, mask_coords, poses, enc_a, ind_code_torso)
+
+                    torso_alpha[mask_inds] = torso_alpha_mask.float()
+                    torso_color[mask_inds] = torso_color_mask.float()
+
+                    results['deform'] = deform
+                elif self.training:
+                    # frames sample their own pixels, each takes its part of the mask and its own pose / codes
+                    mask_frame = torch.div(mask_inds, N_frame, rounding_mode='floor')
+                    for b in range(B):
+                        sel = torch.nonzero(mask_frame == b).squeeze(-1)
+                        if sel.shape[0] == 0:
+                            continue
+                        torso_alpha_mask, torso_color_mask, _ = self.forward_torso(mask_coords[sel], poses[[b]], enc_a[[b]] if enc_a is not None else None, ind_code_torso[[b]] if ind_code_torso is not None else None)
+                        torso_alpha[mask_inds[sel]] = torso_alpha_mask.float()
+                        torso_color[mask_inds[sel]] = torso_color_mask.float()
+                else:
+                    # all frames share bg_coords (and so the mask), but not the pose
+                    torso_alpha = torso_alpha.view(B, N_frame, 1)
+                    torso_color = torso_color.view(B, N_frame, 3)
+                    for b in range(B):
+                        if self.torso_downscale > 1:
+                            torso_alpha_mask, torso_color_mask = self.get_torso_layer_upsampled(bg_coords, mask_inds, mask_coords, poses[[b]], enc_a[[b]], ind_code_torso, weights_sum.view(B, N_frame)[b], self.torso_downscale)
+                        else:
+                            torso_alpha_mask, torso_color_mask, _ = self.get_torso_layer(bg_coords, mask_coords, poses[[b]], enc_a[[b]], ind_code_torso)
+                        torso_alpha[b, mask_inds] = torso_alpha_mask.float()
+                        torso_color[b, mask_inds] = torso_color_mask.float()
+                    torso_alpha = torso_alpha.view(N, 1)
+                    torso_color = torso_color.view(N, 3)
             
             # first mix torso with background
             
             bg_color = torso_color * torso_alpha + bg_color * (1 - torso_alpha)
 
-            results['torso_alpha'] = torso_alpha
-            results['torso_color'] = bg_color
+            # back to the batch shape, B > 1 frames were flattened above
+            results['torso_alpha'] = torso_alpha.view(*prefix, 1)
+            results['torso_color'] = bg_color.view(*prefix, 3)
 
             # print(torso_alpha.shape, torso_alpha.max().item(), torso_alpha.min().item())
 
@@ -316,9 +762,10 @@ class NeRFRenderer(nn.Module):
         return results
 
     @torch.no_grad()
-    def mark_untrained_grid(self, poses, intrinsic, S=64):
+    def mark_untrained_grid(self, poses, intrinsic, S=64, cache_dir=None):
         # poses: [B, 4, 4]
         # intrinsic: [3, 3]
+        # cache_dir: if given, the untrained mask is saved / loaded there, keyed by poses, intrinsic, bound and grid size.
 
         if not self.cuda_ray:
             return
@@ -329,56 +776,265 @@ class NeRFRenderer(nn.Module):
         B = poses.shape[0]
         
         fx, fy, cx, cy = intrinsic
-        
-        X = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
-        Y = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
-        Z = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
-
-        count = torch.zeros_like(self.density_grid)
-        poses = poses.to(count.device)
-
-        # 5-level loop, forgive me...
-
-        for xs in X:
-            for ys in Y:
-                for zs in Z:
-                    
-                    # construct points
-                    xx, yy, zz = custom_meshgrid(xs, ys, zs)
-                    coords = torch.cat([xx.reshape(-1, 1), yy.reshape(-1, 1), zz.reshape(-1, 1)], dim=-1) # [N, 3], in [0, 128)
-                    indices = raymarching.morton3D(coords).long() # [N]
-                    world_xyzs = (2 * coords.float() / (self.grid_size - 1) - 1).unsqueeze(0) # [1, N, 3] in [-1, 1]
-
-                    # cascading
-                    for cas in range(self.cascade):
-                        bound = min(2 ** cas, self.bound)
-                        half_grid_size = bound / self.grid_size
-                        # scale to current cascade's resolution
-                        cas_world_xyzs = world_xyzs * (bound - half_grid_size)
-
-                        # split batch to avoid OOM
-                        head = 0
-                        while head < B:
-                            tail = min(head + S, B)
-
-                            # world2cam transform (poses is c2w, so we need to transpose it. Another transpose is needed for batched matmul, so the final form is without transpose.)
-                            cam_xyzs = cas_world_xyzs - poses[head:tail, :3, 3].unsqueeze(1)
-                            cam_xyzs = cam_xyzs @ poses[head:tail, :3, :3] # [S, N, 3]
-                            
-                            # query if point is covered by any camera
-                            mask_z = cam_xyzs[:, :, 2] > 0 # [S, N]
-                            mask_x = torch.abs(cam_xyzs[:, :, 0]) < cx / fx * cam_xyzs[:, :, 2] + half_grid_size * 2
-                            mask_y = torch.abs(cam_xyzs[:, :, 1]) < cy / fy * cam_xyzs[:, :, 2] + half_grid_size * 2
-                            mask = (mask_z & mask_x & mask_y).sum(0).reshape(-1) # [N]
-
-                            # update count 
-                            count[cas, indices] += mask
-                            head += S
+
+        poses = poses.to(self.density_grid.device, torch.float32)
+
+        cache_path = None
+        if cache_dir is not None:
+            key = hashlib.sha1()
+            key.update(poses.cpu().numpy().tobytes())
+            key.update(np.asarray(intrinsic, dtype=np.float32).tobytes())
+            key.update(f'{self.bound}_{self.cascade}_{self.grid_size}'.encode())
+            cache_path = os.path.join(cache_dir, f'untrained_grid_{key.hexdigest()}.pt')
+            if os.path.exists(cache_path):
+                untrained = torch.load(cache_path, map_location=self.density_grid.device)
+                density_grid = self.get_density_grid()
+                density_grid[untrained] = -1
+                self.set_density_grid(density_grid)
+                return
+
+        untrained = torch.zeros_like(self.density_grid, dtype=torch.bool)
+
+        # cached cell positions in morton order
+        grid_xyzs = self.get_grid_xyzs()
+        H3 = self.grid_size ** 3
+
+        # cascading
+        for cas in range(self.cascade):
+            bound = min(2 ** cas, self.bound)
+            half_grid_size = bound / self.grid_size
+
+            # cells not covered by any camera so far, only these are tested against the next poses
+            remain = torch.arange(H3, device=self.density_grid.device)
+
+            # world2cam transform (poses is c2w, so we need to transpose it. Another transpose is needed for batched matmul, so the final form is without transpose.)
+            # (xyz - T) @ R = xyz @ R - T @ R, the translation term is shared by all cells.
+            rots = poses[:, :3, :3] # [B, 3, 3]
+            trans = (poses[:, :3, 3].unsqueeze(1) @ rots).squeeze(1) # [B, 3]
+
+            # split batch to avoid OOM, about S ** 4 tests per chunk: few poses while many cells remain, more as they get covered.
+            head = 0
+            while head < B and remain.numel() > 0:
+                tail = min(head + max(S ** 4 // remain.numel(), 1), B)
+
+                cas_world_xyzs = grid_xyzs[cas][remain] # [N, 3]
+                cam_xyzs = torch.einsum('nj,bjk->bnk', cas_world_xyzs, rots[head:tail]) - trans[head:tail].unsqueeze(1) # [S, N, 3]
+
+                # query if point is covered by any camera
+                mask_z = cam_xyzs[:, :, 2] > 0 # [S, N]
+                mask_x = torch.abs(cam_xyzs[:, :, 0]) < cx / fx * cam_xyzs[:, :, 2] + half_grid_size * 2
+                mask_y = torch.abs(cam_xyzs[:, :, 1]) < cy / fy * cam_xyzs[:, :, 2] + half_grid_size * 2
+
+                remain = remain[~(mask_z & mask_x & mask_y).any(0)]
+                head = tail
+
+            untrained[cas, remain] = True
+
+        if cache_path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            torch.save(untrained.cpu(), cache_path)
     
         # mark untrained grid as -1
-        self.density_grid[count == 0] = -1
+        density_grid = self.get_density_grid()
+        density_grid[untrained] = -1
+        self.set_density_grid(density_grid)
+
+        #print(f'[mark untrained grid] {untrained.sum()} from {resolution ** 3 * self.cascade}')
+
+    @torch.no_grad()
+    def sample_grid_indices(self, N):
+        # cells to re-evaluate in a partial update of the density grid, per cascade: N uniformly sampled, N sampled among occupied cells.
+        # return: [CAS, 2N], int64 (may contain duplicates)
+        device = self.density_grid.device
+        H3 = self.grid_size ** 3
+        density_thresh = min(self.mean_density, self.density_thresh)
+        density_grid = self.get_density_grid()
+
+        indices = []
+        for cas in range(self.cascade):
+            rand_indices = torch.randint(0, H3, (N,), device=device) # [N]
+            occ_indices = torch.nonzero(density_grid[cas] > density_thresh).squeeze(-1) # [Nz]
+            if occ_indices.shape[0] > 0:
+                occ_indices = occ_indices[torch.randint(0, occ_indices.shape[0], (N,), device=device)] # [Nz] --> [N], allow for duplication
+            else:
+                occ_indices = torch.randint(0, H3, (N,), device=device)
+            indices.append(torch.cat([rand_indices, occ_indices], dim=0))
+
+        return torch.stack(indices, dim=0)
+
+
+    def encode_train_conds(self, idx):
+        # encoded audio of training frames idx (list of K ints), from self.aud_features.
+        # return: [K, 64]
+        enc_a = []
+        for i in idx:
+            if self.opt.cond_type == 'idexp':
+                auds = get_audio_features(self.aud_features, self.att, i, smooth_win_size=5).to(self.density_bitfield.device)
+            else:
+                auds = get_audio_features(self.aud_features, self.att, i).to(self.density_bitfield.device)
+            enc_a.append(self.encode_audio(auds))
+        return torch.cat(enc_a, dim=0)
+
+
+    @torch.no_grad()
+    def query_density_grid(self, enc_a, eye, indices=None, S=128):
+        # density at all (or some) cells of the density grid, max over K conditions.
+        # enc_a: [K, 64], eye: [K, 1] or None
+        # indices: [CAS, N] cells to query (see sample_grid_indices), None for all cells.
+        # return: [CAS, H * H * H], scaled by density_scale, not dilated. Cells not queried are -1.
+        K = enc_a.shape[0]
+        cond = self.get_cond(enc_a, None, eye)
+
+        # cached cell positions in morton order, so each chunk of a full update is a contiguous slice of the grid
+        grid_xyzs = self.get_grid_xyzs()
+        if indices is None:
+            tmp_grid = torch.zeros(self.cascade, self.grid_size ** 3, device=self.density_bitfield.device)
+            N = self.grid_size ** 3
+        else:
+            tmp_grid = - torch.ones(self.cascade, self.grid_size ** 3, device=self.density_bitfield.device)
+            N = indices.shape[1]
+
+        # K conditions are queried in one pass, so each chunk holds S ** 3 samples.
+        chunk = max(S ** 3 // K, 1)
+        if K > 1:
+            frame = torch.arange(K, device=self.density_bitfield.device).repeat_interleave(chunk) # [K * chunk]
+            cond_chunk = self.select_cond(cond, frame, K)
+
+        for start in range(0, N, chunk):
+            end = min(start + chunk, N)
+
+            # cascading
+            for cas in range(self.cascade):
+                bound = min(2 ** cas, self.bound)
+                half_grid_size = bound / self.grid_size
+                cells = slice(start, end) if indices is None else indices[cas, start:end]
+                cas_xyzs = grid_xyzs[cas][cells]
+                # add noise in [-hgs, hgs]
+                cas_xyzs = cas_xyzs + (torch.rand_like(cas_xyzs) * 2 - 1) * half_grid_size
+                # query density
+                if K > 1:
+                    n = end - start
+                    cond_n = cond_chunk if n == chunk else self.select_cond(cond, frame.view(K, chunk)[:, :n].reshape(-1), K)
+                    sigmas = self.density(cas_xyzs.repeat(K, 1), enc_a, eye, cond=cond_n)['sigma'].view(K, n).amax(0).detach().to(tmp_grid.dtype) # max over conditions
+                else:
+                    sigmas = self.density(cas_xyzs, enc_a, eye, cond=cond)['sigma'].reshape(-1).detach().to(tmp_grid.dtype)
+                sigmas *= self.density_scale
+                # assign 
+                tmp_grid[cas, cells] = sigmas
+
+        return tmp_grid
+
+
+    def get_cond_features(self, enc_a, eye=None):
+        # features the condition clusters are defined on: encoded audio, and eye area if used.
+        # return: [B, D]
+        if self.exp_eye and eye is not None:
+            return torch.cat([enc_a.float(), eye.float()], dim=-1)
+        return enc_a.float()
+
+
+    @torch.no_grad()
+    def build_grid_clusters(self, n_clusters, n_conds=16, iters=20, S=128):
+        ''' offline step after training: cluster the training conditions (encoded audio and eye area) with k-means,
+        and build an occupancy bitfield per cluster from the max density over all of its frames.
+        Each cluster bitfield is a subset of density_bitfield (the union over all conditions), so rays of a frame
+        skip space that is only occupied under other mouth / eye states.
+        Args:
+            n_clusters: int
+            n_conds: int, frames of a cluster queried in one pass.
+            iters: int, k-means iterations.
+        Returns:
+            occupancy: list of float, occupied fraction of each cluster bitfield relative to density_bitfield.
+        '''
+        if not self.cuda_ray or self.torso:
+            return []
+
+        device = self.density_bitfield.device
+        n_frames = self.aud_features.shape[0]
+
+        # conditions of all training frames
+        enc_a = torch.cat([self.encode_train_conds(list(range(start, min(start + 256, n_frames)))) for start in range(0, n_frames, 256)], dim=0) # [F, 64]
+        eye = self.eye_area[:n_frames].to(device) if self.exp_eye else None # [F, 1]
+        feats = self.get_cond_features(enc_a, eye)
+        mean, std = feats.mean(0), feats.std(0) + 1e-6
+        feats = (feats - mean) / std
+
+        # k-means
+        n_clusters = min(n_clusters, n_frames)
+        centers = feats[torch.randperm(n_frames, device=device)[:n_clusters]].clone()
+        for _ in range(iters):
+            labels = torch.cdist(feats, centers).argmin(1)
+            for k in range(n_clusters):
+                members = feats[labels == k]
+                if members.shape[0] > 0:
+                    centers[k] = members.mean(0)
+        labels = torch.cdist(feats, centers).argmin(1)
+
+        density_thresh = min(self.mean_density, self.density_thresh)
+        n_occupied = max(raymarching.count_bits(self.density_bitfield), 1)
+
+        bitfields = []
+        occupancy = []
+        for k in range(n_clusters):
+            members = torch.nonzero(labels == k).squeeze(-1)
+            if members.shape[0] == 0:
+                bitfield = self.density_bitfield.clone()
+            else:
+                tmp_grid = None
+                for start in range(0, members.shape[0], n_conds):
+                    batch = members[start:start + n_conds]
+                    batch_grid = self.query_density_grid(enc_a[batch], eye[batch] if eye is not None else None, S=S)
+                    tmp_grid = batch_grid if tmp_grid is None else torch.maximum(tmp_grid, batch_grid)
+                # dilate as the grid update, and keep untrained cells empty
+                tmp_grid = raymarching.morton3D_dilation(tmp_grid)
+                tmp_grid[self.get_density_grid() < 0] = -1
+                bitfield = raymarching.packbits(tmp_grid, density_thresh) & self.density_bitfield
+            bitfields.append(bitfield)
+            occupancy.append(raymarching.count_bits(bitfield) / n_occupied)
+
+        self.grid_clusters = {
+            'mean': mean,
+            'std': std,
+            'centers': centers, # [K, D], standardized
+            'bitfields': torch.stack(bitfields, dim=0), # [K, CAS * H * H * H // 8]
+        }
+        self.grid_cluster_cache = {}
+
+        return occupancy
+
+
+    @torch.no_grad()
+    def get_cluster_bitfield(self, enc_a, eye=None):
+        # bitfield and pyramid for inference: the nearest condition cluster's, the union of them if frames of a batch fall into several.
+        # enc_a: [B, 64], eye: [B, 1] or None
+        # return: density_bitfield, density_bitfield_mip (the full ones if there are no clusters).
+        if self.grid_clusters is None or enc_a is None:
+            return self.density_bitfield, self.get_bitfield_mip()
+
+        clusters = self.grid_clusters
+        if clusters['centers'].device != enc_a.device:
+            self.grid_clusters = clusters = {k: v.to(enc_a.device) for k, v in clusters.items()}
+        feats = (self.get_cond_features(enc_a, eye) - clusters['mean']) / clusters['std']
+        labels = tuple(torch.cdist(feats, clusters['centers']).argmin(1).unique().tolist())
+
+        if labels not in self.grid_cluster_cache:
+            bitfield = clusters['bitfields'][labels[0]]
+            for k in labels[1:]:
+                bitfield = bitfield | clusters['bitfields'][k]
+            # unions of many batches could pile up
+            if len(self.grid_cluster_cache) >= 64:
+                self.grid_cluster_cache = {}
+            self.grid_cluster_cache[labels] = (bitfield, raymarching.mip_bitfield(bitfield, self.cascade, self.mip_levels))
+
+        return self.grid_cluster_cache[labels]
+
+
+    def update_step_counter(self):
+        total_step = min(16, self.local_step)
+        if total_step > 0:
+            self.mean_count = int(self.step_counter[:total_step, 0].sum().item() / total_step)
+        self.local_step = 0
 
-        #print(f'[mark untrained grid] {(count == 0).sum()} from {resolution ** 3 * self.cascade}')
 
     @torch.no_grad()
     def update_extra_state(self, decay=0.95, S=128):
@@ -386,70 +1042,65 @@ class NeRFRenderer(nn.Module):
 
         if not self.cuda_ray:
             return 
-        
-        # use random auds (different expressions should have similar density grid...)
-        rand_idx = random.randint(0, self.aud_features.shape[0] - 1)
 
-        if self.opt.cond_type == 'idexp':
-            auds = get_audio_features(self.aud_features, self.att, rand_idx, smooth_win_size=5).to(self.density_bitfield.device)
-        else:
-            auds = get_audio_features(self.aud_features, self.att, rand_idx).to(self.density_bitfield.device)
+        # converged (frozen by the trainer), only refresh the step counter
+        if self.grid_frozen:
+            self.grid_cells_updated = 0
+            self.grid_change_rate = 0
+            self.update_step_counter()
+            return
+        
+        # use K random auds (different expressions should have similar density grid...), the grid takes the max density over them.
+        rand_idx = [random.randint(0, self.aud_features.shape[0] - 1) for _ in range(self.grid_update_conds)]
 
         # encode audio
-        enc_a = self.encode_audio(auds)
+        enc_a = self.encode_train_conds(rand_idx)
 
         ### update density grid
         if not self.torso: # forbid updating head if is training torso...
 
-            tmp_grid = torch.zeros_like(self.density_grid)
-
             # use a random eye area based on training dataset's statistics...
             if self.exp_eye:
-                eye = self.eye_area[[rand_idx]].to(self.density_bitfield.device) # [1, 1]
+                eye = self.eye_area[rand_idx].to(self.density_bitfield.device) # [K, 1]
             else:
                 eye = None
-            
-            # full update
-            X = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
-            Y = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
-            Z = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
-
-            for xs in X:
-                for ys in Y:
-                    for zs in Z:
-                        
-                        # construct points
-                        xx, yy, zz = custom_meshgrid(xs, ys, zs)
-                        coords = torch.cat([xx.reshape(-1, 1), yy.reshape(-1, 1), zz.reshape(-1, 1)], dim=-1) # [N, 3], in [0, 128)
-                        indices = raymarching.morton3D(coords).long() # [N]
-                        xyzs = 2 * coords.float() / (self.grid_size - 1) - 1 # [N, 3] in [-1, 1]
-
-                        # cascading
-                        for cas in range(self.cascade):
-                            bound = min(2 ** cas, self.bound)
-                            half_grid_size = bound / self.grid_size
-                            # scale to current cascade's resolution
-                            cas_xyzs = xyzs * (bound - half_grid_size)
-                            # add noise in [-hgs, hgs]
-                            cas_xyzs += (torch.rand_like(cas_xyzs) * 2 - 1) * half_grid_size
-                            # query density
-                            sigmas = self.density(cas_xyzs, enc_a, eye)['sigma'].reshape(-1).detach().to(tmp_grid.dtype)
-                            sigmas *= self.density_scale
-                            # assign 
-                            tmp_grid[cas, indices] = sigmas
+
+            H3 = self.grid_size ** 3
+
+            # full update for the first 16 updates, then only a fraction of cells (half uniformly, half among occupied cells, as instant-ngp).
+            # cells not queried are -1, they are only decayed.
+            if self.grid_update_ratio < 1 and self.iter_density >= 16:
+                indices = self.sample_grid_indices(max(int(H3 * self.grid_update_ratio) // 2, 1)) # [CAS, N]
+            else:
+                indices = None
+
+            tmp_grid = self.query_density_grid(enc_a, eye, indices, S)
+
+            self.grid_cells_updated = (H3 if indices is None else indices.shape[1]) * self.cascade * len(rand_idx)
+            self.grid_cells_total = H3 * self.cascade
             
             # dilate the density_grid (less aggressive culling)
             tmp_grid = raymarching.morton3D_dilation(tmp_grid)
 
-            # ema update
-            valid_mask = (self.density_grid >= 0) & (tmp_grid >= 0)
-            self.density_grid[valid_mask] = torch.maximum(self.density_grid[valid_mask] * decay, tmp_grid[valid_mask])
-            self.mean_density = torch.mean(self.density_grid.clamp(min=0)).item() # -1 non-training regions are viewed as 0 density.
+            # ema update (decoded if not stored as float32)
+            # all trained cells decay every update, so stale occupancy left out of partial updates fades out too, as instant-ngp.
+            density_grid = self.get_density_grid()
+            trained_mask = density_grid >= 0
+            density_grid[trained_mask] *= decay
+            valid_mask = trained_mask & (tmp_grid >= 0)
+            density_grid[valid_mask] = torch.maximum(density_grid[valid_mask], tmp_grid[valid_mask])
+            self.mean_density = torch.mean(density_grid.clamp(min=0)).item() # -1 non-training regions are viewed as 0 density.
             self.iter_density += 1
 
             # convert to bitfield
             density_thresh = min(self.mean_density, self.density_thresh)
-            self.density_bitfield = raymarching.packbits(self.density_grid, density_thresh, self.density_bitfield)
+            old_bitfield = self.density_bitfield.clone()
+            self.density_bitfield = raymarching.packbits(density_grid, density_thresh, self.density_bitfield)
+            self.set_density_grid(density_grid)
+            self.grid_clusters = None # built from the previous grid
+            self.grid_change_rate = raymarching.count_bits(old_bitfield ^ self.density_bitfield) / self.grid_cells_total
+            self.reset_bitfield_caches()
+            self.density_bitfield_mip = raymarching.mip_bitfield(self.density_bitfield, self.cascade, self.mip_levels)
 
         ### update torso density grid
         if self.torso:
@@ -464,25 +1115,22 @@ class NeRFRenderer(nn.Module):
             else:
                 ind_code = None
 
-            X = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
-            Y = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
+            # cached cell positions in index order, so each chunk is a contiguous slice of the grid
+            torso_grid_xys = self.get_torso_grid_xys()
+            H2 = self.grid_size ** 2
 
             half_grid_size = 1 / self.grid_size
 
-            for xs in X:
-                for ys in Y:
-                    xx, yy = custom_meshgrid(xs, ys)
-                    coords = torch.cat([xx.reshape(-1, 1), yy.reshape(-1, 1)], dim=-1) # [N, 2], in [0, 128)
-                    indices = (coords[:, 1] * self.grid_size + coords[:, 0]).long() # NOTE: xy transposed!
-                    xys = 2 * coords.float() / (self.grid_size - 1) - 1 # [N, 2] in [-1, 1]
-                    xys = xys * (1 - half_grid_size)
-                    # add noise in [-hgs, hgs]
-                    xys += (torch.rand_like(xys) * 2 - 1) * half_grid_size
-                    # query density
-                    alphas, _, _ = self.forward_torso(xys, pose, enc_a, ind_code) # [N, 1]
-                    
-                    # assign 
-                    tmp_grid_torso[indices] = alphas.squeeze(1).float()
+            for start in range(0, H2, S ** 2):
+                end = min(start + S ** 2, H2)
+                xys = torso_grid_xys[start:end]
+                # add noise in [-hgs, hgs]
+                xys = xys + (torch.rand_like(xys) * 2 - 1) * half_grid_size
+                # query density
+                alphas, _, _ = self.forward_torso(xys, pose, enc_a, ind_code) # [N, 1]
+                
+                # assign 
+                tmp_grid_torso[start:end] = alphas.squeeze(1).float()
 
             # dilate
             tmp_grid_torso = tmp_grid_torso.view(1, 1, self.grid_size, self.grid_size)
@@ -490,17 +1138,23 @@ class NeRFRenderer(nn.Module):
             tmp_grid_torso = F.max_pool2d(tmp_grid_torso, kernel_size=5, stride=1, padding=2)
             tmp_grid_torso = tmp_grid_torso.view(-1)
             
+            density_thresh_torso = min(self.density_thresh_torso, self.mean_density_torso)
+            old_mask_torso = self.density_grid_torso > density_thresh_torso
+
             self.density_grid_torso = torch.maximum(self.density_grid_torso * decay, tmp_grid_torso)
             self.mean_density_torso = torch.mean(self.density_grid_torso).item()
+            self.torso_mask_cache = {}
+            self.torso_layer_cache = {}
+
+            density_thresh_torso = min(self.density_thresh_torso, self.mean_density_torso)
+            self.grid_change_rate = (old_mask_torso != (self.density_grid_torso > density_thresh_torso)).float().mean().item()
+            self.grid_cells_updated = self.grid_cells_total = H2
 
             # density_thresh_torso = min(self.density_thresh_torso, self.mean_density_torso)
             # print(f'[density grid torso] min={self.density_grid_torso.min().item():.4f}, max={self.density_grid_torso.max().item():.4f}, mean={self.mean_density_torso:.4f}, occ_rate={(self.density_grid_torso > density_thresh_torso).sum() / (128**2):.3f}')
 
         ### update step counter
-        total_step = min(16, self.local_step)
-        if total_step > 0:
-            self.mean_count = int(self.step_counter[:total_step, 0].sum().item() / total_step)
-        self.local_step = 0
+        self.update_step_counter()
 
         #print(f'[density grid] min={self.density_grid.min().item():.4f}, max={self.density_grid.max().item():.4f}, mean={self.mean_density:.4f}, occ_rate={(self.density_grid > 0.01).sum() / (128**3 * self.cascade):.3f} | [step counter] mean={self.mean_count}')
 
@@ -0,0 +1,85 @@
+class StepScheduler:
+    ''' decide how many steps every alive ray marches per call of the inference loop in run_cuda.
+    Each call queries the network with n_alive * n_step samples, so the policy sets the network batch size:
+    GPUs like large batches, while CPUs prefer smaller ones that stay in cache.
+    The scheduler also keeps telemetry (iterations, alive rays, samples per call) until reset().
+    '''
+    def __init__(self, max_n_step=8):
+        self.max_n_step = max_n_step
+        self.reset()
+
+    def reset(self):
+        self.frames = 0
+        self.iters = 0
+        self.alive = 0
+        self.samples = 0
+        self.max_samples = 0
+
+    def __call__(self, N, n_alive):
+        # N: total rays of the frame, n_alive: rays still alive
+        # return: n_step, int >= 1
+        raise NotImplementedError()
+
+    def record(self, n_alive, n_step):
+        self.iters += 1
+        self.alive += n_alive
+        self.samples += n_alive * n_step
+        self.max_samples = max(self.max_samples, n_alive * n_step)
+
+    def end_frame(self, B=1):
+        # B: frames rendered by this run_cuda call
+        self.frames += B
+
+    def summary(self):
+        iters = max(self.iters, 1)
+        return {
+            'frames': self.frames,
+            'iters_per_frame': self.iters / max(self.frames, 1),
+            'alive_per_call': self.alive / iters,
+            'samples_per_call': self.samples / iters,
+            'max_samples_per_call': self.max_samples,
+        }
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}: max_n_step={self.max_n_step}'
+
+
+class FixedStepScheduler(StepScheduler):
+    # always march max_n_step steps.
+    def __call__(self, N, n_alive):
+        return self.max_n_step
+
+
+class AliveStepScheduler(StepScheduler):
+    # march more steps as rays terminate, keeping the batch close to N samples (the default).
+    def __call__(self, N, n_alive):
+        return max(min(N // n_alive, self.max_n_step), 1)
+
+
+class SamplesStepScheduler(StepScheduler):
+    # march as many steps as needed to reach about target_samples samples per call.
+    def __init__(self, max_n_step=64, target_samples=2**18):
+        self.target_samples = target_samples
+        super().__init__(max_n_step)
+
+    def __call__(self, N, n_alive):
+        return max(min(self.target_samples // n_alive, self.max_n_step), 1)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}: max_n_step={self.max_n_step} target_samples={self.target_samples}'
+
+
+def get_step_scheduler(policy, max_n_step=None, target_samples=2**18):
+    # max_n_step: None for the policy's own cap (8 for fixed / alive, 64 for samples).
+
+    if policy == 'fixed':
+        return FixedStepScheduler(max_n_step or 8)
+
+    elif policy == 'alive':
+        return AliveStepScheduler(max_n_step or 8)
+
+    elif policy == 'samples':
+        return SamplesStepScheduler(max_n_step or 64, target_samples)
+
+    else:
+        raise NotImplementedError('Unknown march policy, choose from [fixed, alive, samples]')
@@ -333,6 +333,26 @@ def get_rays(poses, intrinsics, H, W, N=-1, patch_size=1, rect=None):
     return results
 
 
+def merge_frames(datas):
+    # stack B collated test frames (each of batch size 1), so they can be rendered in a single run_cuda call.
+    # frame-level entries are concatenated along the batch dim, auds windows are stacked to [B, ...].
+    # also used for --train_batch, where the dataset concatenates the per-frame bg_coords itself.
+    results = dict(datas[0])
+
+    for k in ['rays_o', 'rays_d', 'poses', 'poses_matrix', 'bg_color', 'images', 'bg_torso_color', 'face_mask']:
+        if k in results and torch.is_tensor(results[k]):
+            results[k] = torch.cat([data[k] for data in datas], dim=0)
+
+    if results.get('auds') is not None:
+        results['auds'] = torch.stack([data['auds'] for data in datas], dim=0)
+    if results.get('eye') is not None:
+        results['eye'] = torch.cat([data['eye'] for data in datas], dim=0)
+
+    results['index'] = [i for data in datas for i in data['index']]
+
+    return results
+
+
 def seed_everything(seed):
     random.seed(seed)
     os.environ['PYTHONHASHSEED'] = str(seed)
@@ -653,6 +673,10 @@ class Trainer(object):
         self.epoch = 0
         self.global_step = 0
         self.local_step = 0
+        # density grid update interval, backs off up to --update_extra_interval_max while the occupancy is stable.
+        self.update_extra_interval = self.opt.update_extra_interval
+        self.grid_stats = {'steps': 0, 'updates': 0, 'cells': 0, 'change': 0}
+        self.grid_stable = 0 # consecutive stable updates, the grid is frozen after --grid_freeze_patience of them
         self.stats = {
             "loss": [],
             "valid_loss": [],
@@ -860,7 +884,22 @@ class Trainer(object):
         else:
             bg_color = data['bg_color']
 
-        outputs = self.model.render(rays_o, rays_d, auds, bg_coords, poses, eye=eye, index=index, staged=True, bg_color=bg_color, perturb=perturb, **vars(self.opt))
+        # only march the rays inside the screen-space bbox of the head density grid
+        head_mask = None
+        if self.opt.head_cull and 'intrinsics' in data:
+            poses_matrix = data['poses_matrix'].view(-1, 4, 4)
+            head_mask = torch.zeros(poses_matrix.shape[0], H, W, dtype=torch.bool, device=self.device)
+            for b in range(poses_matrix.shape[0]):
+                rect = self.model.get_head_rect(poses_matrix[b], data['intrinsics'], H, W)
+                if rect is None:
+                    head_mask = None
+                    break
+                xmin, xmax, ymin, ymax = rect
+                head_mask[b, xmin:xmax, ymin:ymax] = 1
+            if head_mask is not None:
+                head_mask = head_mask.view(-1)
+
+        outputs = self.model.render(rays_o, rays_d, auds, bg_coords, poses, eye=eye, index=index, staged=True, bg_color=bg_color, perturb=perturb, head_mask=head_mask, **vars(self.opt))
 
         pred_rgb = outputs['image'].reshape(-1, H, W, 3)
         pred_depth = outputs['depth'].reshape(-1, H, W)
@@ -898,7 +937,7 @@ class Trainer(object):
 
         # mark untrained region (i.e., not covered by any camera from the training dataset)
         if self.model.cuda_ray:
-            self.model.mark_untrained_grid(train_loader._data.poses, train_loader._data.intrinsics)
+            self.model.mark_untrained_grid(train_loader._data.poses, train_loader._data.intrinsics, cache_dir=os.path.join(self.workspace, 'cache') if self.workspace is not None else None)
 
         for epoch in range(self.epoch + 1, max_epochs + 1):
             self.epoch = epoch
@@ -934,44 +973,110 @@ class Trainer(object):
 
         pbar = tqdm.tqdm(total=len(loader) * loader.batch_size, bar_format='{percentage:3.0f}% {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}]')
         self.model.eval()
+        self.model.warm_start_state = None # do not warm-start from another sequence
+        if self.model.cuda_ray:
+            self.model.step_scheduler.reset()
+        self.model.torso_layer_stats = {'hits': 0, 'calls': 0}
 
         all_preds = []
 
         with torch.no_grad():
 
+            # with --test_batch > 1, consecutive frames are rendered together in one run_cuda call.
+            frames = []
+
             for i, data in enumerate(loader):
+
+                frames.append(data)
+                if len(frames) < self.opt.test_batch and i < len(loader) - 1:
+                    continue
+
+                data = merge_frames(frames) if len(frames) > 1 else frames[0]
+                frames = []
                 
                 with torch.cuda.amp.autocast(enabled=self.fp16):
                     preds, preds_depth = self.test_step(data)                
-                
-                path = os.path.join(save_path, f'{name}_{i:04d}_rgb.png')
-                path_depth = os.path.join(save_path, f'{name}_{i:04d}_depth.png')
-
-                #self.log(f"[INFO] saving test image to {path}")
 
                 if self.opt.color_space == 'linear':
                     preds = linear_to_srgb(preds)
 
-                pred = preds[0].detach().cpu().numpy()
-                pred = (pred * 255).astype(np.uint8)
+                B = preds.shape[0]
+
+                for b in range(B):
+                    
+                    k = i - B + 1 + b
+                    path = os.path.join(save_path, f'{name}_{k:04d}_rgb.png')
+                    path_depth = os.path.join(save_path, f'{name}_{k:04d}_depth.png')
 
-                pred_depth = preds_depth[0].detach().cpu().numpy()
-                pred_depth = (pred_depth * 255).astype(np.uint8)
+                    #self.log(f"[INFO] saving test image to {path}")
 
-                if write_image:
-                    imageio.imwrite(path, pred)
-                    imageio.imwrite(path_depth, pred_depth)
+                    pred = preds[b].detach().cpu().numpy()
+                    pred = (pred * 255).astype(np.uint8)
 
-                all_preds.append(pred)
+                    pred_depth = preds_depth[b].detach().cpu().numpy()
+                    pred_depth = (pred_depth * 255).astype(np.uint8)
 
-                pbar.update(loader.batch_size)
+                    if write_image:
+                        imageio.imwrite(path, pred)
+                        imageio.imwrite(path_depth, pred_depth)
+
+                    all_preds.append(pred)
+
+                pbar.update(loader.batch_size * B)
 
         # write video
         all_preds = np.stack(all_preds, axis=0)
         imageio.mimwrite(os.path.join(save_path, f'{name}.mp4'), all_preds, fps=25, quality=8, macro_block_size=1)
 
+        if self.model.cuda_ray:
+            stats = self.model.step_scheduler.summary()
+            self.log(f"[INFO] {self.model.step_scheduler}, {stats['iters_per_frame']:.1f} iters/frame, {stats['alive_per_call']:.0f} alive rays/call, {stats['samples_per_call']:.0f} samples/call (max {stats['max_samples_per_call']})")
+
+        if self.model.torso_layer_stats['calls'] > 0:
+            stats = self.model.torso_layer_stats
+            self.log(f"[INFO] torso layers reused in {stats['hits']} / {stats['calls']} frames")
+
         self.log(f"==> Finished Test.")
     
+    def benchmark_torso(self, loader, factors=(1, 2, 4, 8), max_frames=100):
+        # FPS against PSNR of the torso rendered at --torso_downscale factors, on the first max_frames frames of loader.
+        # PSNR is measured against the full resolution rendering (factor 1) of the same frames.
+        self.log(f"==> Start torso benchmark, factors = {list(factors)}")
+        self.model.eval()
+
+        refs = None
+        with torch.no_grad():
+            for factor in factors:
+                self.model.torso_downscale = factor
+                self.model.torso_layer_cache = {}
+                self.model.warm_start_state = None
+                if self.model.smooth_lips:
+                    self.model.enc_a = None
+
+                preds = []
+                elapsed = 0
+                for i, data in enumerate(loader):
+                    if i >= max_frames:
+                        break
+                    if self.device.type == 'cuda':
+                        torch.cuda.synchronize()
+                    t = time.time()
+                    with torch.cuda.amp.autocast(enabled=self.fp16):
+                        pred, _ = self.test_step(data)
+                    if self.device.type == 'cuda':
+                        torch.cuda.synchronize()
+                    elapsed += time.time() - t
+                    preds.append(pred.float())
+
+                preds = torch.cat(preds, dim=0)
+                if refs is None:
+                    refs = preds
+                psnr = -10 * torch.log10(torch.mean((preds - refs) ** 2).clamp(min=1e-10)).item()
+                self.log(f"[INFO] torso x{factor}: {preds.shape[0] / elapsed:.2f} FPS, PSNR = {psnr:.2f} dB against x{factors[0]}")
+
+        self.model.torso_downscale = self.opt.torso_downscale
+        self.log(f"==> Finished torso benchmark.")
+    
     # [GUI] just train for 16 steps, without any other overhead that may slow down rendering.
     def train_gui(self, train_loader, step=16):
 
@@ -983,7 +1088,7 @@ class Trainer(object):
 
         # mark untrained grid
         if self.global_step == 0:
-            self.model.mark_untrained_grid(train_loader._data.poses, train_loader._data.intrinsics)
+            self.model.mark_untrained_grid(train_loader._data.poses, train_loader._data.intrinsics, cache_dir=os.path.join(self.workspace, 'cache') if self.workspace is not None else None)
 
         for _ in range(step):
             
@@ -995,9 +1100,7 @@ class Trainer(object):
                 data = next(loader)
 
             # update grid every 16 steps
-            if self.model.cuda_ray and self.global_step % self.opt.update_extra_interval == 0:
-                with torch.cuda.amp.autocast(enabled=self.fp16):
-                    self.model.update_extra_state()
+            self.update_density_grid()
             
             self.global_step += 1
 
@@ -1061,6 +1164,8 @@ class Trainer(object):
             'index': [index], # support choosing index for individual codes
             'eye': eye,
             'poses': convert_poses(pose),
+            'poses_matrix': pose,
+            'intrinsics': intrinsics,
             'bg_coords': bg_coords,
         }
         
@@ -1153,12 +1258,16 @@ class Trainer(object):
 
         self.local_step = 0
 
+        # time blocked on the loader, measured here so it covers both the plain and the prefetching loader
+        t_epoch = t_data = time.time()
+        data_wait = 0
+
         for data in loader:
+
+            data_wait += time.time() - t_data
             
             # update grid every 16 steps
-            if self.model.cuda_ray and self.global_step % self.opt.update_extra_interval == 0:
-                with torch.cuda.amp.autocast(enabled=self.fp16):
-                    self.model.update_extra_state()
+            self.update_density_grid()
                     
             self.local_step += 1
             self.global_step += 1
@@ -1196,6 +1305,8 @@ class Trainer(object):
                     pbar.set_description(f"loss={loss_val:.4f} ({total_loss/self.local_step:.4f})")
                 pbar.update(loader.batch_size)
 
+            t_data = time.time()
+
         average_loss = total_loss / self.local_step
         self.stats["loss"].append(average_loss)
 
@@ -1214,9 +1325,100 @@ class Trainer(object):
             else:
                 self.lr_scheduler.step()
 
+        self.report_density_grid()
+
+        if self.local_rank == 0:
+            epoch_time = time.time() - t_epoch
+            self.log(f"[INFO] waited {data_wait:.2f}s for data, {data_wait / epoch_time:.1%} of the epoch")
+            if self.use_tensorboardX:
+                self.writer.add_scalar("train/data_wait", data_wait / epoch_time, self.global_step)
+
         self.log(f"==> Finished Epoch {self.epoch}.")
 
 
+    def update_density_grid(self):
+        # update the density grid every self.update_extra_interval steps.
+        # the interval doubles while the occupancy bitfield changes less than --grid_change_thresh, and resets otherwise.
+        self.grid_stats['steps'] += 1
+
+        if not self.model.cuda_ray or self.global_step % self.update_extra_interval != 0:
+            return
+
+        with torch.cuda.amp.autocast(enabled=self.fp16):
+            self.model.update_extra_state()
+
+        change_rate = self.model.grid_change_rate
+        self.grid_stats['updates'] += 1
+        self.grid_stats['cells'] += self.model.grid_cells_updated
+        self.grid_stats['change'] += change_rate
+
+        if self.opt.grid_freeze_patience > 0 and not self.model.grid_frozen:
+            self.grid_stable = self.grid_stable + 1 if change_rate < self.opt.grid_change_thresh else 0
+            if self.grid_stable >= self.opt.grid_freeze_patience:
+                self.model.grid_frozen = True
+                self.log(f"[INFO] density grid converged at step {self.global_step}, frozen")
+
+        if self.opt.update_extra_interval_max > self.opt.update_extra_interval:
+            if change_rate < self.opt.grid_change_thresh:
+                self.update_extra_interval = min(self.update_extra_interval * 2, self.opt.update_extra_interval_max)
+            else:
+                self.update_extra_interval = self.opt.update_extra_interval
+
+
+    def report_density_grid(self):
+        # log the density grid updates since the last report, and the cells queried relative to full updates every --update_extra_interval steps.
+        stats = self.grid_stats
+        if self.model.cuda_ray and stats['updates'] > 0:
+            full_cells = stats['steps'] / self.opt.update_extra_interval * self.model.grid_cells_total
+            change_rate = stats['change'] / stats['updates']
+            self.log(f"[INFO] density grid: {stats['updates']} updates in {stats['steps']} steps, interval = {self.update_extra_interval}, change rate = {change_rate:.2e}, cells queried = {stats['cells'] / max(full_cells, 1):.1%} of full updates")
+            if self.use_tensorboardX and self.local_rank == 0:
+                self.writer.add_scalar("train/grid_change_rate", change_rate, self.global_step)
+                self.writer.add_scalar("train/grid_cells_queried", stats['cells'] / max(full_cells, 1), self.global_step)
+                self.writer.add_scalar("train/update_extra_interval", self.update_extra_interval, self.global_step)
+        self.grid_stats = {'steps': 0, 'updates': 0, 'cells': 0, 'change': 0}
+
+
+    def build_grid_clusters(self, n_clusters, loader=None):
+        # offline step after training, builds a density bitfield per cluster of training conditions and saves them with the checkpoints.
+        # if a (validation) loader is given, also reports the PSNR with the cluster bitfields against the full bitfield.
+        self.log(f"==> Building {n_clusters} condition clusters of the density grid ...")
+        self.model.eval()
+        with torch.cuda.amp.autocast(enabled=self.fp16):
+            occupancy = self.model.build_grid_clusters(n_clusters)
+        if len(occupancy) == 0:
+            return
+        self.log(f"[INFO] cluster occupancy relative to the full bitfield: {', '.join(f'{o:.1%}' for o in occupancy)}")
+        if loader is not None:
+            psnr_clusters = self.measure_psnr(loader)
+            grid_clusters, self.model.grid_clusters = self.model.grid_clusters, None
+            psnr_full = self.measure_psnr(loader)
+            self.model.grid_clusters = grid_clusters
+            self.log(f"[INFO] PSNR with cluster bitfields = {psnr_clusters:.4f}, with the full bitfield = {psnr_full:.4f} ({psnr_clusters - psnr_full:+.4f})")
+        self.save_checkpoint(full=True, remove_old=False)
+        self.save_checkpoint(full=False, best=True)
+
+
+    def measure_psnr(self, loader):
+        # mean PSNR of the model over a loader, without saving images or touching the training stats.
+        self.model.eval()
+        if self.ema is not None:
+            self.ema.store()
+            self.ema.copy_to()
+
+        psnr = PSNRMeter()
+        with torch.no_grad():
+            for data in loader:
+                with torch.cuda.amp.autocast(enabled=self.fp16):
+                    preds, preds_depth, truths, loss = self.eval_step(data)
+                psnr.update(preds, truths)
+
+        if self.ema is not None:
+            self.ema.restore()
+
+        return psnr.measure()
+
+
     def evaluate_one_epoch(self, loader, name=None):
         self.log(f"++> Evaluate at epoch {self.epoch} ...")
 
@@ -1314,6 +1516,8 @@ class Trainer(object):
         state['mean_count'] = self.model.mean_count
         state['mean_density'] = self.model.mean_density
         state['mean_density_torso'] = self.model.mean_density_torso
+        if self.model.grid_clusters is not None:
+            state['grid_clusters'] = self.model.grid_clusters
 
         if full:
             state['optimizer'] = self.optimizer.state_dict()
@@ -1395,6 +1599,10 @@ class Trainer(object):
             self.model.mean_density = checkpoint_dict['mean_density']
         if 'mean_density_torso' in checkpoint_dict:
             self.model.mean_density_torso = checkpoint_dict['mean_density_torso']
+        if 'grid_clusters' in checkpoint_dict:
+            self.model.grid_clusters = checkpoint_dict['grid_clusters']
+            self.log(f"[INFO] loaded {self.model.grid_clusters['centers'].shape[0]} condition clusters of the density grid.")
+        self.model.reset_bitfield_caches()
         
         if model_only:
             return
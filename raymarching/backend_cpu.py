@@ -0,0 +1,515 @@
+import torch
+import torch.nn.functional as F
+
+# Pure PyTorch implementation of the `_raymarching_face` bindings, used when CUDA is not available.
+# Every function mirrors the signature of its CUDA counterpart in `src/bindings.cpp` and writes into the pre-allocated outputs,
+# so `raymarching.py` can dispatch to either backend transparently.
+# Kernels that loop per ray on the GPU are vectorized over rays here, and only iterate over the (short) marching / compositing steps.
+
+SQRT3 = 1.7320508075688772
+RPI = 0.3183098861837907
+
+
+# ----------------------------------------
+# helpers
+# ----------------------------------------
+
+def _expand_bits(v):
+    # v: int64 tensor, emulates uint32 arithmetic
+    v = (v * 0x00010001) & 0xFF0000FF
+    v = (v * 0x00000101) & 0x0F00F00F
+    v = (v * 0x00000011) & 0xC30C30C3
+    v = (v * 0x00000005) & 0x49249249
+    return v
+
+
+def _morton3D(x, y, z):
+    # x/y/z: int64 tensor, return int64 tensor
+    return _expand_bits(x) | (_expand_bits(y) << 1) | (_expand_bits(z) << 2)
+
+
+def _morton3D_invert(x):
+    # x: int64 tensor, return int64 tensor
+    x = x & 0x49249249
+    x = (x | (x >> 2)) & 0xc30c30c3
+    x = (x | (x >> 4)) & 0x0f00f00f
+    x = (x | (x >> 8)) & 0xff0000ff
+    x = (x | (x >> 16)) & 0x0000ffff
+    return x
+
+
+def _mip_level(mx, C):
+    # frexp exponent: [0, 0.5) --> -1, [0.5, 1) --> 0, [1, 2) --> 1, [2, 4) --> 2, ...
+    _, exponent = torch.frexp(mx)
+    return exponent.clamp(0, C - 1).long()
+
+
+def _dt_bounds(C, H, max_steps):
+    dt_max = 2 * SQRT3 * (1 << (C - 1)) / H
+    dt_min = min(dt_max, 2 * SQRT3 / max_steps)
+    return dt_min, dt_max
+
+
+def _query_grid(o, d, t, bound, dt_gamma, dt_min, dt_max, C, H, grid):
+    ''' locate the current sample of each ray in the multi-cascade bitfield.
+    Args:
+        o, d: float, [n, 3]
+        t: float, [n]
+    Returns:
+        xyz: float, [n, 3], clamped sample position
+        dt: float, [n], step size at t
+        occ: bool, [n], whether the grid cell is occupied
+        nxyz: int64, [n, 3], grid cell coordinate in the selected cascade
+        mip_bound: float, [n]
+        level: int64, [n], the selected cascade
+    '''
+    xyz = (o + t.unsqueeze(-1) * d).clamp(-bound, bound)
+    dt = (t * dt_gamma).clamp(dt_min, dt_max)
+
+    level = torch.maximum(_mip_level(xyz.abs().amax(-1), C), _mip_level(dt * H * 0.5, C))
+
+    mip_bound = torch.exp2(level.to(xyz.dtype)).clamp(max=bound)
+    mip_rbound = 1 / mip_bound
+
+    nxyz = (0.5 * (xyz * mip_rbound.unsqueeze(-1) + 1) * H).clamp(0, H - 1).long()
+
+    index = level * H ** 3 + _morton3D(nxyz[:, 0], nxyz[:, 1], nxyz[:, 2])
+    occ = ((grid[index >> 3].long() >> (index & 7)) & 1).bool()
+
+    return xyz, dt, occ, nxyz, mip_bound, level
+
+
+def _empty_block_size(grid_mip, K, C, H, level, nxyz):
+    # size (in cells) of the largest empty block in the occupancy pyramid that contains the (empty) cell nxyz.
+    # level k of grid_mip has one bit per 2^k x 2^k x 2^k block, i.e. per 8^k consecutive morton indices.
+    morton = _morton3D(nxyz[:, 0], nxyz[:, 1], nxyz[:, 2])
+    bs = torch.ones_like(morton)
+    empty = torch.ones_like(morton, dtype=torch.bool)
+    offset = 0
+    cells = H ** 3
+    for k in range(1, K + 1):
+        cells //= 8
+        index = offset * 8 + level * cells + (morton >> (3 * k))
+        empty = empty & (((grid_mip[index >> 3].long() >> (index & 7)) & 1) == 0)
+        bs = torch.where(empty, torch.full_like(bs, 1 << k), bs)
+        offset += C * cells // 8
+    return bs
+
+
+def _skip_voxel(t, xyz, nxyz, mip_bound, rd, sign, dt_gamma, dt_min, dt_max, H, bs=None):
+    # advance t (with regular steps) until it leaves the current empty voxel (or empty block of bs^3 voxels)
+    if bs is None:
+        txyz = (((nxyz.to(xyz.dtype) + 0.5 + 0.5 * sign) * (1 / H) * 2 - 1) * mip_bound.unsqueeze(-1) - xyz) * rd
+    else:
+        bs = bs.unsqueeze(-1)
+        txyz = ((((nxyz & ~(bs - 1)).to(xyz.dtype) + bs.to(xyz.dtype) * (0.5 + 0.5 * sign)) * (1 / H) * 2 - 1) * mip_bound.unsqueeze(-1) - xyz) * rd
+    # fmin/fmax ignore NaNs (0 * inf) exactly as fminf/fmaxf do.
+    tmin = torch.fmin(txyz[:, 0], torch.fmin(txyz[:, 1], txyz[:, 2]))
+    tt = t + torch.fmax(torch.zeros_like(tmin), tmin)
+
+    # do { t += dt } while (t < tt)
+    pending = torch.ones_like(t, dtype=torch.bool)
+    while True:
+        t = torch.where(pending, t + (t * dt_gamma).clamp(dt_min, dt_max), t)
+        pending = pending & (t < tt)
+        if not pending.any():
+            break
+    return t
+
+
+# ----------------------------------------
+# utils
+# ----------------------------------------
+
+def near_far_from_aabb(rays_o, rays_d, aabb, N, min_near, nears, fars):
+    # rays_o/d: [N, 3]
+    # nears/fars: [N]
+    rd = 1 / rays_d
+    lo = (aabb[:3] - rays_o) * rd
+    hi = (aabb[3:] - rays_o) * rd
+
+    # swap if near > far (comparison with NaN is false, so no swap, same as the kernel)
+    swap = lo > hi
+    near_xyz = torch.where(swap, hi, lo)
+    far_xyz = torch.where(swap, lo, hi)
+
+    near, far = near_xyz[:, 0], far_xyz[:, 0]
+    miss = torch.zeros_like(near, dtype=torch.bool)
+
+    for i in (1, 2):
+        miss |= (near > far_xyz[:, i]) | (near_xyz[:, i] > far)
+        near = torch.where(near_xyz[:, i] > near, near_xyz[:, i], near)
+        far = torch.where(far_xyz[:, i] < far, far_xyz[:, i], far)
+
+    near = torch.where(near < min_near, torch.full_like(near, min_near), near)
+
+    fmax = torch.finfo(nears.dtype).max
+    nears.copy_(torch.where(miss, torch.full_like(near, fmax), near))
+    fars.copy_(torch.where(miss, torch.full_like(far, fmax), far))
+
+
+def sph_from_ray(rays_o, rays_d, radius, N, coords):
+    # rays_o/d: [N, 3]
+    # coords: [N, 2]
+    A = (rays_d * rays_d).sum(-1)
+    B = (rays_o * rays_d).sum(-1) # in fact B / 2
+    C = (rays_o * rays_o).sum(-1) - radius * radius
+
+    t = (- B + torch.sqrt(B * B - A * C)) / A # always use the larger solution (positive)
+
+    x, y, z = (rays_o + t.unsqueeze(-1) * rays_d).unbind(-1)
+    theta = torch.atan2(torch.sqrt(x * x + z * z), y) # [0, PI)
+    phi = torch.atan2(z, x) # [-PI, PI)
+
+    coords[:, 0] = 2 * theta * RPI - 1
+    coords[:, 1] = phi * RPI
+
+
+def morton3D(coords, N, indices):
+    # coords: int32, [N, 3]
+    # indices: int32, [N]
+    coords = coords.long()
+    indices.copy_(_morton3D(coords[:, 0], coords[:, 1], coords[:, 2]))
+
+
+def morton3D_invert(indices, N, coords):
+    # indices: int32, [N]
+    # coords: int32, [N, 3]
+    indices = indices.long()
+    coords[:, 0] = _morton3D_invert(indices >> 0)
+    coords[:, 1] = _morton3D_invert(indices >> 1)
+    coords[:, 2] = _morton3D_invert(indices >> 2)
+
+
+def packbits(grid, N, density_thresh, bitfield):
+    # grid: float, [C, H * H * H]
+    # bitfield: uint8, [N], N = C * H * H * H / 8
+    bits = (grid.reshape(N, 8) > density_thresh).to(torch.uint8)
+    shifts = torch.arange(8, dtype=torch.uint8, device=grid.device)
+    bitfield.copy_((bits << shifts).sum(-1))
+
+
+def morton3D_dilation(grid, C, H, grid_dilation):
+    # grid: float, [C, H * H * H], max pool over the 6-neighborhood
+    H3 = H * H * H
+    ind = torch.arange(H3, dtype=torch.int64, device=grid.device)
+    x, y, z = _morton3D_invert(ind >> 0), _morton3D_invert(ind >> 1), _morton3D_invert(ind >> 2)
+
+    dense = torch.empty(C, H, H, H, dtype=grid.dtype, device=grid.device)
+    dense[:, x, y, z] = grid
+
+    padded = F.pad(dense, (1, 1, 1, 1, 1, 1), value=-float('inf'))
+    res = dense
+    res = torch.maximum(res, padded[:, 2:, 1:-1, 1:-1])
+    res = torch.maximum(res, padded[:, :-2, 1:-1, 1:-1])
+    res = torch.maximum(res, padded[:, 1:-1, 2:, 1:-1])
+    res = torch.maximum(res, padded[:, 1:-1, :-2, 1:-1])
+    res = torch.maximum(res, padded[:, 1:-1, 1:-1, 2:])
+    res = torch.maximum(res, padded[:, 1:-1, 1:-1, :-2])
+
+    grid_dilation.copy_(res[:, x, y, z])
+
+
+# ----------------------------------------
+# train functions
+# ----------------------------------------
+
+def march_rays_train(rays_o, rays_d, grid, grid_mip, K, bound, dt_gamma, max_steps, N, C, H, M, nears, fars, xyzs, dirs, deltas, rays, counter, noises):
+    # rays_o/d: [N, 3]
+    # grid: [CHHH / 8]
+    # grid_mip: occupancy pyramid levels 1 ... K
+    # xyzs, dirs, deltas: [M, 3], [M, 3], [M, 2]
+    # rays: [N, 3], idx, offset, num_steps
+    device = rays_o.device
+    dt_min, dt_max = _dt_bounds(C, H, max_steps)
+
+    rd = 1 / rays_d
+    sign = torch.copysign(torch.ones_like(rays_d), rays_d)
+
+    # perturb
+    t = nears + (nears * dt_gamma).clamp(dt_min, dt_max) * noises
+    num_steps = torch.zeros(N, dtype=torch.int64, device=device)
+
+    # single pass: record every occupied sample as (ray, step, xyz, dt, t), then scatter to the packed layout.
+    rec_rays, rec_steps, rec_xyzs, rec_deltas = [], [], [], []
+
+    alive = torch.nonzero(t < fars).squeeze(-1)
+
+    while alive.numel() > 0:
+        ta = t[alive]
+        xyz, dt, occ, nxyz, mip_bound, level = _query_grid(rays_o[alive], rays_d[alive], ta, bound, dt_gamma, dt_min, dt_max, C, H, grid)
+
+        # if occupied, advance a small step, and write to output
+        hit = alive[occ]
+        if hit.numel() > 0:
+            t_hit = ta[occ] + dt[occ]
+            rec_rays.append(hit)
+            rec_steps.append(num_steps[hit])
+            rec_xyzs.append(xyz[occ])
+            rec_deltas.append(torch.stack([dt[occ], t_hit], dim=-1))
+            num_steps[hit] += 1
+            t[hit] = t_hit
+
+        # else, skip a large step (basically skip a voxel grid, or a larger empty block of the pyramid)
+        empty = ~occ
+        if empty.any():
+            miss = alive[empty]
+            bs = _empty_block_size(grid_mip, K, C, H, level[empty], nxyz[empty]) if K > 0 else None
+            t[miss] = _skip_voxel(ta[empty], xyz[empty], nxyz[empty], mip_bound[empty], rd[miss], sign[miss], dt_gamma, dt_min, dt_max, H, bs)
+
+        alive = alive[(t[alive] < fars[alive]) & (num_steps[alive] < max_steps)]
+
+    # allocate points in ray order (the CUDA kernel uses atomicAdd, so the order there is arbitrary anyway)
+    point_index = counter[0].long() + torch.cumsum(num_steps, 0) - num_steps
+    ray_index = counter[1].long() + torch.arange(N, dtype=torch.int64, device=device)
+
+    rays[ray_index, 0] = torch.arange(N, dtype=torch.int32, device=device)
+    rays[ray_index, 1] = point_index.int()
+    rays[ray_index, 2] = num_steps.int()
+
+    counter[0] += int(num_steps.sum().item())
+    counter[1] += N
+
+    if len(rec_rays) == 0:
+        return
+
+    rec_rays = torch.cat(rec_rays)
+    rec_steps = torch.cat(rec_steps)
+
+    # rays exceeding M are dropped (not written)
+    keep = (point_index + num_steps <= M)[rec_rays]
+    pos = (point_index[rec_rays] + rec_steps)[keep]
+
+    xyzs[pos] = torch.cat(rec_xyzs)[keep].to(xyzs.dtype)
+    dirs[pos] = rays_d[rec_rays[keep]].to(dirs.dtype)
+    deltas[pos] = torch.cat(rec_deltas)[keep].to(deltas.dtype)
+
+
+def _ray_samples(rays, M):
+    # expand [N, 3] (index, offset, num_steps) to per-sample (ray position, sample position), skipping empty / overflowed rays.
+    offset = rays[:, 1].long()
+    num_steps = rays[:, 2].long()
+    valid = torch.nonzero((num_steps > 0) & (offset + num_steps <= M)).squeeze(-1)
+
+    counts = num_steps[valid]
+    owner = torch.repeat_interleave(valid, counts)
+    local = torch.arange(owner.shape[0], device=rays.device) - torch.repeat_interleave(torch.cumsum(counts, 0) - counts, counts)
+    pos = offset[owner] + local
+
+    return owner, pos
+
+
+def march_rays_train_backward(grad_xyzs, grad_dirs, rays, deltas, N, M, grad_rays_o, grad_rays_d):
+    # grad_xyzs/dirs: [M, 3]
+    # rays: [N, 3]
+    # deltas: [M, 2]
+    # grad_rays_o/d: [N, 3]
+    owner, pos = _ray_samples(rays, M)
+
+    grad_rays_o.index_add_(0, owner, grad_xyzs[pos].to(grad_rays_o.dtype))
+    grad_rays_d.index_add_(0, owner, (grad_xyzs[pos] * deltas[pos, 1:] + grad_dirs[pos]).to(grad_rays_d.dtype))
+
+
+def _composite_train_rays(rays, M):
+    index = rays[:, 0].long()
+    offset = rays[:, 1].long()
+    num_steps = rays[:, 2].long()
+    valid = (num_steps > 0) & (offset + num_steps <= M)
+    return index, offset, num_steps, valid
+
+
+def composite_rays_train_forward(sigmas, rgbs, ambient, deltas, rays, M, N, T_thresh, weights_sum, ambient_sum, depth, image):
+    # sigmas: [M]
+    # rgbs: [M, 3]
+    # deltas: [M, 2]
+    # rays: [N, 3], idx, offset, num_steps
+    # weights_sum, ambient_sum, depth: [N]
+    # image: [N, 3]
+    index, offset, num_steps, valid = _composite_train_rays(rays, M)
+
+    # empty ray, or ray that exceed max step count.
+    weights_sum[index] = 0
+    ambient_sum[index] = 0
+    depth[index] = 0
+    image[index] = 0
+
+    r = torch.nonzero(valid).squeeze(-1)
+    if r.numel() == 0:
+        return
+
+    n = r.shape[0]
+    T = torch.ones(n, dtype=sigmas.dtype, device=sigmas.device)
+    ws = torch.zeros_like(T)
+    amb = torch.zeros_like(T)
+    d = torch.zeros_like(T)
+    rgb = torch.zeros(n, 3, dtype=sigmas.dtype, device=sigmas.device)
+
+    # iterate over steps, vectorized over rays
+    alive = torch.arange(n, device=sigmas.device)
+    for step in range(int(num_steps[r].max().item())):
+        alive = alive[num_steps[r[alive]] > step]
+        if alive.numel() == 0:
+            break
+
+        p = offset[r[alive]] + step
+        alpha = 1.0 - torch.exp(- sigmas[p] * deltas[p, 0])
+        weight = alpha * T[alive]
+
+        rgb[alive] += weight.unsqueeze(-1) * rgbs[p]
+        d[alive] += weight * deltas[p, 1]
+        ws[alive] += weight
+        amb[alive] += ambient[p]
+
+        T[alive] *= 1.0 - alpha
+
+        # minimal remained transmittence
+        alive = alive[T[alive] >= T_thresh]
+
+    weights_sum[index[r]] = ws
+    ambient_sum[index[r]] = amb
+    depth[index[r]] = d
+    image[index[r]] = rgb
+
+
+def composite_rays_train_backward(grad_weights_sum, grad_ambient_sum, grad_image, sigmas, rgbs, ambient, deltas, rays, weights_sum, ambient_sum, image, M, N, T_thresh, grad_sigmas, grad_rgbs, grad_ambient):
+    # check https://note.kiui.moe/others/nerf_gradient/ for the gradient calculation.
+    index, offset, num_steps, valid = _composite_train_rays(rays, M)
+
+    r = torch.nonzero(valid).squeeze(-1)
+    if r.numel() == 0:
+        return
+
+    idx = index[r]
+    n = r.shape[0]
+
+    g_ws = grad_weights_sum[idx]
+    g_amb = grad_ambient_sum[idx]
+    g_img = grad_image[idx]
+    ws_final = weights_sum[idx]
+    rgb_final = image[idx]
+
+    T = torch.ones(n, dtype=sigmas.dtype, device=sigmas.device)
+    rgb = torch.zeros(n, 3, dtype=sigmas.dtype, device=sigmas.device)
+
+    alive = torch.arange(n, device=sigmas.device)
+    for step in range(int(num_steps[r].max().item())):
+        alive = alive[num_steps[r[alive]] > step]
+        if alive.numel() == 0:
+            break
+
+        p = offset[r[alive]] + step
+        alpha = 1.0 - torch.exp(- sigmas[p] * deltas[p, 0])
+        weight = alpha * T[alive]
+
+        rgb[alive] += weight.unsqueeze(-1) * rgbs[p]
+        T[alive] *= 1.0 - alpha
+
+        grad_rgbs[p] = g_img[alive] * weight.unsqueeze(-1)
+        grad_ambient[p] = g_amb[alive]
+        grad_sigmas[p] = deltas[p, 0] * (
+            (g_img[alive] * (T[alive].unsqueeze(-1) * rgbs[p] - (rgb_final[alive] - rgb[alive]))).sum(-1) +
+            g_ws[alive] * (1 - ws_final[alive])
+        )
+
+        # minimal remained transmittence
+        alive = alive[T[alive] >= T_thresh]
+
+
+# ----------------------------------------
+# infer functions
+# ----------------------------------------
+
+def march_rays(n_alive, n_step, rays_alive, rays_t, rays_o, rays_d, bound, dt_gamma, max_steps, C, H, grid, grid_mip, K, near, far, xyzs, dirs, deltas, noises):
+    # rays_alive: int, [N], only the first n_alive are used
+    # rays_t: float, [N]
+    # xyzs, dirs: [n_alive * n_step, 3], deltas: [n_alive * n_step, 2]
+    device = rays_o.device
+    dt_min, dt_max = _dt_bounds(C, H, max_steps)
+
+    index = rays_alive[:n_alive].long()
+    o = rays_o[index]
+    d = rays_d[index]
+    fr = far[index]
+    rd = 1 / d
+    sign = torch.copysign(torch.ones_like(d), d)
+
+    # introduce some randomness
+    t = rays_t[index]
+    t = t + (t * dt_gamma).clamp(dt_min, dt_max) * noises[:n_alive]
+
+    step = torch.zeros(n_alive, dtype=torch.int64, device=device)
+    base = torch.arange(n_alive, dtype=torch.int64, device=device) * n_step
+
+    alive = torch.nonzero(t < fr).squeeze(-1)
+
+    while alive.numel() > 0:
+        ta = t[alive]
+        xyz, dt, occ, nxyz, mip_bound, level = _query_grid(o[alive], d[alive], ta, bound, dt_gamma, dt_min, dt_max, C, H, grid)
+
+        # if occupied, advance a small step, and write to output
+        hit = alive[occ]
+        if hit.numel() > 0:
+            t_hit = ta[occ] + dt[occ]
+            pos = base[hit] + step[hit]
+            xyzs[pos] = xyz[occ].to(xyzs.dtype)
+            dirs[pos] = d[hit].to(dirs.dtype)
+            deltas[pos, 0] = dt[occ].to(deltas.dtype)
+            deltas[pos, 1] = t_hit.to(deltas.dtype) # used to calc depth
+            step[hit] += 1
+            t[hit] = t_hit
+
+        # else, skip a large step (basically skip a voxel grid, or a larger empty block of the pyramid)
+        empty = ~occ
+        if empty.any():
+            miss = alive[empty]
+            bs = _empty_block_size(grid_mip, K, C, H, level[empty], nxyz[empty]) if K > 0 else None
+            t[miss] = _skip_voxel(ta[empty], xyz[empty], nxyz[empty], mip_bound[empty], rd[miss], sign[miss], dt_gamma, dt_min, dt_max, H, bs)
+
+        alive = alive[(t[alive] < fr[alive]) & (step[alive] < n_step)]
+
+
+def composite_rays(n_alive, n_step, T_thresh, rays_alive, rays_t, sigmas, rgbs, deltas, weights_sum, depth, image):
+    # rays_alive: int, [n_alive], set to -1 in-place for terminated rays
+    # sigmas: [n_alive * n_step], rgbs: [n_alive * n_step, 3], deltas: [n_alive * n_step, 2]
+    # weights_sum, depth: [N], image: [N, 3], in-place
+    index = rays_alive[:n_alive].long()
+
+    sigmas = sigmas[:n_alive * n_step].view(n_alive, n_step).to(image.dtype)
+    rgbs = rgbs[:n_alive * n_step].view(n_alive, n_step, 3).to(image.dtype)
+    deltas = deltas[:n_alive * n_step].view(n_alive, n_step, 2)
+
+    t = rays_t[index]
+    ws = weights_sum[index]
+    d = depth[index]
+    rgb = image[index]
+
+    running = torch.ones(n_alive, dtype=torch.bool, device=sigmas.device)
+    steps = torch.zeros(n_alive, dtype=torch.int64, device=sigmas.device)
+
+    for k in range(n_step):
+        # ray is terminated if delta == 0
+        running = running & (deltas[:, k, 0] != 0)
+        if not running.any():
+            break
+
+        alpha = 1.0 - torch.exp(- sigmas[:, k] * deltas[:, k, 0])
+        T = 1 - ws
+        weight = torch.where(running, alpha * T, torch.zeros_like(T))
+
+        ws = ws + weight
+        t = torch.where(running, deltas[:, k, 1], t)
+        d = d + weight * t
+        rgb = rgb + weight.unsqueeze(-1) * rgbs[:, k]
+
+        # ray is terminated if T is too small
+        running = running & (T >= T_thresh)
+        steps += running
+
+    # rays_alive = -1 means ray is terminated early.
+    finished = steps < n_step
+    rays_alive[:n_alive] = torch.where(finished, torch.full_like(rays_alive[:n_alive], -1), rays_alive[:n_alive])
+    rays_t[index] = torch.where(finished, rays_t[index], t)
+
+    weights_sum[index] = ws
+    depth[index] = d
+    image[index] = rgb
@@ -6,10 +6,16 @@ import torch.nn as nn
 from torch.autograd import Function
 from torch.cuda.amp import custom_bwd, custom_fwd
 
-try:
-    import _raymarching_face as _backend
-except ImportError:
-    from .backend import _backend
+if torch.cuda.is_available():
+    try:
+        import _raymarching_face as _backend
+    except ImportError:
+        from .backend import _backend
+else:
+    # no GPU, fall back to the pure PyTorch implementation (same interface as the CUDA bindings).
+    from . import backend_cpu as _backend
+
+_use_cuda = torch.cuda.is_available()
 
 # ----------------------------------------
 # utils
@@ -30,8 +36,8 @@ class _near_far_from_aabb(Function):
             nears: float, [N]
             fars: float, [N]
         '''
-        if not rays_o.is_cuda: rays_o = rays_o.cuda()
-        if not rays_d.is_cuda: rays_d = rays_d.cuda()
+        if _use_cuda and not rays_o.is_cuda: rays_o = rays_o.cuda()
+        if _use_cuda and not rays_d.is_cuda: rays_d = rays_d.cuda()
 
         rays_o = rays_o.contiguous().view(-1, 3)
         rays_d = rays_d.contiguous().view(-1, 3)
@@ -62,8 +68,8 @@ class _sph_from_ray(Function):
         Return:
             coords: [N, 2], in [-1, 1], theta and phi on a sphere. (further-surface)
         '''
-        if not rays_o.is_cuda: rays_o = rays_o.cuda()
-        if not rays_d.is_cuda: rays_d = rays_d.cuda()
+        if _use_cuda and not rays_o.is_cuda: rays_o = rays_o.cuda()
+        if _use_cuda and not rays_d.is_cuda: rays_d = rays_d.cuda()
 
         rays_o = rays_o.contiguous().view(-1, 3)
         rays_d = rays_d.contiguous().view(-1, 3)
@@ -90,7 +96,7 @@ class _morton3D(Function):
             indices: [N], int32, in [0, 128^3)
             
         '''
-        if not coords.is_cuda: coords = coords.cuda()
+        if _use_cuda and not coords.is_cuda: coords = coords.cuda()
         
         N = coords.shape[0]
 
@@ -112,7 +118,7 @@ class _morton3D_invert(Function):
             coords: [N, 3], int32, in [0, 128)
             
         '''
-        if not indices.is_cuda: indices = indices.cuda()
+        if _use_cuda and not indices.is_cuda: indices = indices.cuda()
         
         N = indices.shape[0]
 
@@ -137,7 +143,7 @@ class _packbits(Function):
         Returns:
             bitfield: uint8, [C, H * H * H / 8]
         '''
-        if not grid.is_cuda: grid = grid.cuda()
+        if _use_cuda and not grid.is_cuda: grid = grid.cuda()
         grid = grid.contiguous()
 
         C = grid.shape[0]
@@ -165,7 +171,7 @@ class _morton3D_dilation(Function):
         Returns:
             grid_dilate: float, [C, H * H * H], assume H % 2 == 0bitfield: uint8, [C, H * H * H / 8]
         '''
-        if not grid.is_cuda: grid = grid.cuda()
+        if _use_cuda and not grid.is_cuda: grid = grid.cuda()
         grid = grid.contiguous()
 
         C = grid.shape[0]
@@ -179,6 +185,58 @@ class _morton3D_dilation(Function):
 
 morton3D_dilation = _morton3D_dilation.apply
 
+
+def mip_bitfield(density_bitfield, C, levels=4):
+    ''' build an occupancy pyramid on top of the density bitfield.
+    In morton order a 2x2x2 block of cells is 8 consecutive bits (one byte), so level k is simply
+    whether each byte of level k-1 is non-zero, packed again.
+    Args:
+        density_bitfield: uint8, [C * H * H * H / 8]
+        C: int
+        levels: int, number of coarse levels K, each level k marks 2^k x 2^k x 2^k blocks.
+    Returns:
+        bitfield_mip: uint8, [sum_k C * H * H * H / 8^(k+1)], levels 1 ... K concatenated.
+    '''
+    shifts = torch.arange(8, dtype=torch.uint8, device=density_bitfield.device)
+    mips = []
+    prev = density_bitfield
+    for _ in range(levels):
+        # each level must keep at least one byte per cascade
+        if prev.shape[0] // C < 8:
+            break
+        prev = ((prev != 0).view(-1, 8).to(torch.uint8) << shifts).sum(-1, dtype=torch.uint8)
+        mips.append(prev)
+
+    if len(mips) == 0:
+        return torch.empty(0, dtype=torch.uint8, device=density_bitfield.device)
+
+    return torch.cat(mips, dim=0)
+
+
+def count_bits(bitfield):
+    ''' number of set bits of a uint8 bitfield, e.g. occupied cells, or flipped cells of (old ^ new).
+    Args:
+        bitfield: uint8, [N]
+    Returns:
+        count: int
+    '''
+    shifts = torch.arange(8, dtype=torch.uint8, device=bitfield.device)
+    return ((bitfield.unsqueeze(-1) >> shifts) & 1).sum().item()
+
+
+def _mip_args(density_bitfield, density_bitfield_mip, C):
+    # (grid_mip, K) passed to the marching kernels, K = 0 disables coarse skipping.
+    if density_bitfield_mip is None or density_bitfield_mip.numel() == 0:
+        return torch.empty(1, dtype=torch.uint8, device=density_bitfield.device), 0
+    K = 0
+    n = density_bitfield.shape[0]
+    total = 0
+    while total < density_bitfield_mip.shape[0]:
+        n //= 8
+        total += n
+        K += 1
+    return density_bitfield_mip.contiguous(), K
+
 # ----------------------------------------
 # train functions
 # ----------------------------------------
@@ -186,7 +244,7 @@ morton3D_dilation = _morton3D_dilation.apply
 class _march_rays_train(Function):
     @staticmethod
     @custom_fwd(cast_inputs=torch.float32)
-    def forward(ctx, rays_o, rays_d, bound, density_bitfield, C, H, nears, fars, step_counter=None, mean_count=-1, perturb=False, align=-1, force_all_rays=False, dt_gamma=0, max_steps=1024):
+    def forward(ctx, rays_o, rays_d, bound, density_bitfield, C, H, nears, fars, step_counter=None, mean_count=-1, perturb=False, align=-1, force_all_rays=False, dt_gamma=0, max_steps=1024, density_bitfield_mip=None):
         ''' march rays to generate points (forward only)
         Args:
             rays_o/d: float, [N, 3]
@@ -202,6 +260,7 @@ class _march_rays_train(Function):
             force_all_rays: bool, ignore step_counter and mean_count, always calculate all rays. Useful if rendering the whole image, instead of some rays.
             dt_gamma: float, called cone_angle in instant-ngp, exponentially accelerate ray marching if > 0. (very significant effect, but generally lead to worse performance)
             max_steps: int, max number of sampled points along each ray, also affect min_stepsize.
+            density_bitfield_mip: uint8, occupancy pyramid from `mip_bitfield`, used to skip large empty blocks. None to skip voxel by voxel.
         Returns:
             xyzs: float, [M, 3], all generated points' coords. (all rays concated, need to use `rays` to extract points belonging to each ray)
             dirs: float, [M, 3], all generated points' view dirs.
@@ -209,13 +268,14 @@ class _march_rays_train(Function):
             rays: int32, [N, 3], all rays' (index, point_offset, point_count), e.g., xyzs[rays[i, 1]:rays[i, 1] + rays[i, 2]] --> points belonging to rays[i, 0]
         '''
 
-        if not rays_o.is_cuda: rays_o = rays_o.cuda()
-        if not rays_d.is_cuda: rays_d = rays_d.cuda()
-        if not density_bitfield.is_cuda: density_bitfield = density_bitfield.cuda()
+        if _use_cuda and not rays_o.is_cuda: rays_o = rays_o.cuda()
+        if _use_cuda and not rays_d.is_cuda: rays_d = rays_d.cuda()
+        if _use_cuda and not density_bitfield.is_cuda: density_bitfield = density_bitfield.cuda()
         
         rays_o = rays_o.contiguous().view(-1, 3)
         rays_d = rays_d.contiguous().view(-1, 3)
         density_bitfield = density_bitfield.contiguous()
+        grid_mip, K = _mip_args(density_bitfield, density_bitfield_mip, C)
 
         N = rays_o.shape[0] # num rays
         M = N * max_steps # init max points number in total
@@ -240,7 +300,7 @@ class _march_rays_train(Function):
         else:
             noises = torch.zeros(N, dtype=rays_o.dtype, device=rays_o.device)
         
-        _backend.march_rays_train(rays_o, rays_d, density_bitfield, bound, dt_gamma, max_steps, N, C, H, M, nears, fars, xyzs, dirs, deltas, rays, step_counter, noises) # m is the actually used points number
+        _backend.march_rays_train(rays_o, rays_d, density_bitfield, grid_mip, K, bound, dt_gamma, max_steps, N, C, H, M, nears, fars, xyzs, dirs, deltas, rays, step_counter, noises) # m is the actually used points number
 
         #print(step_counter, M)
 
@@ -275,7 +335,7 @@ class _march_rays_train(Function):
         
         _backend.march_rays_train_backward(grad_xyzs, grad_dirs, rays, deltas, N, M, grad_rays_o, grad_rays_d)
         
-        return grad_rays_o, grad_rays_d, None, None, None, None, None, None, None, None, None, None, None, None, None
+        return grad_rays_o, grad_rays_d, None, None, None, None, None, None, None, None, None, None, None, None, None, None
 
 march_rays_train = _march_rays_train.apply
 
@@ -347,7 +407,7 @@ composite_rays_train = _composite_rays_train.apply
 class _march_rays(Function):
     @staticmethod
     @custom_fwd(cast_inputs=torch.float32)
-    def forward(ctx, n_alive, n_step, rays_alive, rays_t, rays_o, rays_d, bound, density_bitfield, C, H, near, far, align=-1, perturb=False, dt_gamma=0, max_steps=1024):
+    def forward(ctx, n_alive, n_step, rays_alive, rays_t, rays_o, rays_d, bound, density_bitfield, C, H, near, far, align=-1, perturb=False, dt_gamma=0, max_steps=1024, density_bitfield_mip=None):
         ''' march rays to generate points (forward only, for inference)
         Args:
             n_alive: int, number of alive rays
@@ -364,17 +424,19 @@ class _march_rays(Function):
             perturb: bool/int, int > 0 is used as the random seed.
             dt_gamma: float, called cone_angle in instant-ngp, exponentially accelerate ray marching if > 0. (very significant effect, but generally lead to worse performance)
             max_steps: int, max number of sampled points along each ray, also affect min_stepsize.
+            density_bitfield_mip: uint8, occupancy pyramid from `mip_bitfield`, used to skip large empty blocks. None to skip voxel by voxel.
         Returns:
             xyzs: float, [n_alive * n_step, 3], all generated points' coords
             dirs: float, [n_alive * n_step, 3], all generated points' view dirs.
             deltas: float, [n_alive * n_step, 2], all generated points' deltas (here we record two deltas, the first is for RGB, the second for depth).
         '''
         
-        if not rays_o.is_cuda: rays_o = rays_o.cuda()
-        if not rays_d.is_cuda: rays_d = rays_d.cuda()
+        if _use_cuda and not rays_o.is_cuda: rays_o = rays_o.cuda()
+        if _use_cuda and not rays_d.is_cuda: rays_d = rays_d.cuda()
         
         rays_o = rays_o.contiguous().view(-1, 3)
         rays_d = rays_d.contiguous().view(-1, 3)
+        grid_mip, K = _mip_args(density_bitfield, density_bitfield_mip, C)
 
         M = n_alive * n_step
 
@@ -391,7 +453,7 @@ class _march_rays(Function):
         else:
             noises = torch.zeros(n_alive, dtype=rays_o.dtype, device=rays_o.device)
 
-        _backend.march_rays(n_alive, n_step, rays_alive, rays_t, rays_o, rays_d, bound, dt_gamma, max_steps, C, H, density_bitfield, near, far, xyzs, dirs, deltas, noises)
+        _backend.march_rays(n_alive, n_step, rays_alive, rays_t, rays_o, rays_d, bound, dt_gamma, max_steps, C, H, density_bitfield, grid_mip, K, near, far, xyzs, dirs, deltas, noises)
 
         return xyzs, dirs, deltas
 
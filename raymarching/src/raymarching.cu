@@ -80,6 +80,23 @@ inline __host__ __device__ uint32_t __morton3D_invert(uint32_t x)
 	return x;
 }
 
+// occupancy pyramid: level k (1 <= k <= K) has one bit per block of 2^k x 2^k x 2^k cells, i.e. 8^k consecutive morton indices.
+// grid_mip: uint8, levels 1 ... K concatenated, level k has C * H3 / 8^k bits.
+// return the size (in cells) of the largest empty block containing the (empty) cell `morton` of cascade `level`.
+inline __device__ uint32_t empty_block_size(const uint8_t * __restrict__ grid_mip, const uint32_t K, const uint32_t C, const uint32_t H3, const uint32_t level, const uint32_t morton) 
+{
+    uint32_t k = 0;
+    uint32_t cells = H3; // cells per cascade at level k
+    while (k < K) {
+        cells >>= 3;
+        const uint32_t index = level * cells + (morton >> (3 * (k + 1)));
+        if (grid_mip[index / 8] & (1 << (index % 8))) break;
+        grid_mip += C * cells / 8;
+        k++;
+    }
+    return 1u << k;
+}
+
 
 ////////////////////////////////////////////////////
 /////////////           utils          /////////////
@@ -346,6 +363,7 @@ void morton3D_dilation(const at::Tensor grid, const uint32_t C, const uint32_t H
 
 // rays_o/d: [N, 3]
 // grid: [CHHH / 8]
+// grid_mip: [sum_k CHHH / 8^(k+1)], occupancy pyramid levels 1 ... K
 // xyzs, dirs, deltas: [M, 3], [M, 3], [M, 2]
 // dirs: [M, 3]
 // rays: [N, 3], idx, offset, num_steps
@@ -354,6 +372,7 @@ __global__ void kernel_march_rays_train(
     const scalar_t * __restrict__ rays_o,
     const scalar_t * __restrict__ rays_d,  
     const uint8_t * __restrict__ grid,
+    const uint8_t * __restrict__ grid_mip, const uint32_t K,
     const float bound,
     const float dt_gamma, const uint32_t max_steps,
     const uint32_t N, const uint32_t C, const uint32_t H, const uint32_t M,
@@ -427,10 +446,11 @@ __global__ void kernel_march_rays_train(
             t += dt;
         // else, skip a large step (basically skip a voxel grid)
         } else {
-            // calc distance to next voxel
-            const float tx = (((nx + 0.5f + 0.5f * signf(dx)) * rH * 2 - 1) * mip_bound - x) * rdx;
-            const float ty = (((ny + 0.5f + 0.5f * signf(dy)) * rH * 2 - 1) * mip_bound - y) * rdy;
-            const float tz = (((nz + 0.5f + 0.5f * signf(dz)) * rH * 2 - 1) * mip_bound - z) * rdz;
+            // calc distance to next voxel, or to the end of the largest empty block in the occupancy pyramid
+            const uint32_t bs = empty_block_size(grid_mip, K, C, H * H * H, level, __morton3D(nx, ny, nz));
+            const float tx = ((((nx & ~(bs - 1)) + bs * (0.5f + 0.5f * signf(dx))) * rH * 2 - 1) * mip_bound - x) * rdx;
+            const float ty = ((((ny & ~(bs - 1)) + bs * (0.5f + 0.5f * signf(dy))) * rH * 2 - 1) * mip_bound - y) * rdy;
+            const float tz = ((((nz & ~(bs - 1)) + bs * (0.5f + 0.5f * signf(dz))) * rH * 2 - 1) * mip_bound - z) * rdz;
 
             const float tt = t + fmaxf(0.0f, fminf(tx, fminf(ty, tz)));
             // step until next voxel
@@ -504,10 +524,11 @@ __global__ void kernel_march_rays_train(
             step++;
         // else, skip a large step (basically skip a voxel grid)
         } else {
-            // calc distance to next voxel
-            const float tx = (((nx + 0.5f + 0.5f * signf(dx)) * rH * 2 - 1) * mip_bound - x) * rdx;
-            const float ty = (((ny + 0.5f + 0.5f * signf(dy)) * rH * 2 - 1) * mip_bound - y) * rdy;
-            const float tz = (((nz + 0.5f + 0.5f * signf(dz)) * rH * 2 - 1) * mip_bound - z) * rdz;
+            // calc distance to next voxel, or to the end of the largest empty block in the occupancy pyramid
+            const uint32_t bs = empty_block_size(grid_mip, K, C, H * H * H, level, __morton3D(nx, ny, nz));
+            const float tx = ((((nx & ~(bs - 1)) + bs * (0.5f + 0.5f * signf(dx))) * rH * 2 - 1) * mip_bound - x) * rdx;
+            const float ty = ((((ny & ~(bs - 1)) + bs * (0.5f + 0.5f * signf(dy))) * rH * 2 - 1) * mip_bound - y) * rdy;
+            const float tz = ((((nz & ~(bs - 1)) + bs * (0.5f + 0.5f * signf(dz))) * rH * 2 - 1) * mip_bound - z) * rdz;
             const float tt = t + fmaxf(0.0f, fminf(tx, fminf(ty, tz)));
             // step until next voxel
             do { 
@@ -517,13 +538,13 @@ __global__ void kernel_march_rays_train(
     }
 }
 
-void march_rays_train(const at::Tensor rays_o, const at::Tensor rays_d, const at::Tensor grid, const float bound, const float dt_gamma, const uint32_t max_steps, const uint32_t N, const uint32_t C, const uint32_t H, const uint32_t M, const at::Tensor nears, const at::Tensor fars, at::Tensor xyzs, at::Tensor dirs, at::Tensor deltas, at::Tensor rays, at::Tensor counter, at::Tensor noises) {
+void march_rays_train(const at::Tensor rays_o, const at::Tensor rays_d, const at::Tensor grid, const at::Tensor grid_mip, const uint32_t K, const float bound, const float dt_gamma, const uint32_t max_steps, const uint32_t N, const uint32_t C, const uint32_t H, const uint32_t M, const at::Tensor nears, const at::Tensor fars, at::Tensor xyzs, at::Tensor dirs, at::Tensor deltas, at::Tensor rays, at::Tensor counter, at::Tensor noises) {
 
     static constexpr uint32_t N_THREAD = 128;
     
     AT_DISPATCH_FLOATING_TYPES_AND_HALF(
     rays_o.scalar_type(), "march_rays_train", ([&] {
-        kernel_march_rays_train<<<div_round_up(N, N_THREAD), N_THREAD>>>(rays_o.data_ptr<scalar_t>(), rays_d.data_ptr<scalar_t>(), grid.data_ptr<uint8_t>(), bound, dt_gamma, max_steps, N, C, H, M, nears.data_ptr<scalar_t>(), fars.data_ptr<scalar_t>(), xyzs.data_ptr<scalar_t>(), dirs.data_ptr<scalar_t>(), deltas.data_ptr<scalar_t>(), rays.data_ptr<int>(), counter.data_ptr<int>(), noises.data_ptr<scalar_t>());
+        kernel_march_rays_train<<<div_round_up(N, N_THREAD), N_THREAD>>>(rays_o.data_ptr<scalar_t>(), rays_d.data_ptr<scalar_t>(), grid.data_ptr<uint8_t>(), grid_mip.data_ptr<uint8_t>(), K, bound, dt_gamma, max_steps, N, C, H, M, nears.data_ptr<scalar_t>(), fars.data_ptr<scalar_t>(), xyzs.data_ptr<scalar_t>(), dirs.data_ptr<scalar_t>(), deltas.data_ptr<scalar_t>(), rays.data_ptr<int>(), counter.data_ptr<int>(), noises.data_ptr<scalar_t>());
     }));
 }
 
@@ -836,6 +857,7 @@ __global__ void kernel_march_rays(
     const float dt_gamma, const uint32_t max_steps,
     const uint32_t C, const uint32_t H,
     const uint8_t * __restrict__ grid,
+    const uint8_t * __restrict__ grid_mip, const uint32_t K,
     const scalar_t* __restrict__ nears,
     const scalar_t* __restrict__ fars,
     scalar_t* xyzs, scalar_t* dirs, scalar_t* deltas,
@@ -915,10 +937,11 @@ __global__ void kernel_march_rays(
 
         // else, skip a large step (basically skip a voxel grid)
         } else {
-            // calc distance to next voxel
-            const float tx = (((nx + 0.5f + 0.5f * signf(dx)) * rH * 2 - 1) * mip_bound - x) * rdx;
-            const float ty = (((ny + 0.5f + 0.5f * signf(dy)) * rH * 2 - 1) * mip_bound - y) * rdy;
-            const float tz = (((nz + 0.5f + 0.5f * signf(dz)) * rH * 2 - 1) * mip_bound - z) * rdz;
+            // calc distance to next voxel, or to the end of the largest empty block in the occupancy pyramid
+            const uint32_t bs = empty_block_size(grid_mip, K, C, H * H * H, level, __morton3D(nx, ny, nz));
+            const float tx = ((((nx & ~(bs - 1)) + bs * (0.5f + 0.5f * signf(dx))) * rH * 2 - 1) * mip_bound - x) * rdx;
+            const float ty = ((((ny & ~(bs - 1)) + bs * (0.5f + 0.5f * signf(dy))) * rH * 2 - 1) * mip_bound - y) * rdy;
+            const float tz = ((((nz & ~(bs - 1)) + bs * (0.5f + 0.5f * signf(dz))) * rH * 2 - 1) * mip_bound - z) * rdz;
             const float tt = t + fmaxf(0.0f, fminf(tx, fminf(ty, tz)));
             // step until next voxel
             do { 
@@ -929,12 +952,12 @@ __global__ void kernel_march_rays(
 }
 
 
-void march_rays(const uint32_t n_alive, const uint32_t n_step, const at::Tensor rays_alive, const at::Tensor rays_t, const at::Tensor rays_o, const at::Tensor rays_d, const float bound, const float dt_gamma, const uint32_t max_steps, const uint32_t C, const uint32_t H, const at::Tensor grid, const at::Tensor near, const at::Tensor far, at::Tensor xyzs, at::Tensor dirs, at::Tensor deltas, at::Tensor noises) {
+void march_rays(const uint32_t n_alive, const uint32_t n_step, const at::Tensor rays_alive, const at::Tensor rays_t, const at::Tensor rays_o, const at::Tensor rays_d, const float bound, const float dt_gamma, const uint32_t max_steps, const uint32_t C, const uint32_t H, const at::Tensor grid, const at::Tensor grid_mip, const uint32_t K, const at::Tensor near, const at::Tensor far, at::Tensor xyzs, at::Tensor dirs, at::Tensor deltas, at::Tensor noises) {
     static constexpr uint32_t N_THREAD = 128;
 
     AT_DISPATCH_FLOATING_TYPES_AND_HALF(
     rays_o.scalar_type(), "march_rays", ([&] {
-        kernel_march_rays<<<div_round_up(n_alive, N_THREAD), N_THREAD>>>(n_alive, n_step, rays_alive.data_ptr<int>(), rays_t.data_ptr<scalar_t>(), rays_o.data_ptr<scalar_t>(), rays_d.data_ptr<scalar_t>(), bound, dt_gamma, max_steps, C, H, grid.data_ptr<uint8_t>(), near.data_ptr<scalar_t>(), far.data_ptr<scalar_t>(), xyzs.data_ptr<scalar_t>(), dirs.data_ptr<scalar_t>(), deltas.data_ptr<scalar_t>(), noises.data_ptr<scalar_t>());
+        kernel_march_rays<<<div_round_up(n_alive, N_THREAD), N_THREAD>>>(n_alive, n_step, rays_alive.data_ptr<int>(), rays_t.data_ptr<scalar_t>(), rays_o.data_ptr<scalar_t>(), rays_d.data_ptr<scalar_t>(), bound, dt_gamma, max_steps, C, H, grid.data_ptr<uint8_t>(), grid_mip.data_ptr<uint8_t>(), K, near.data_ptr<scalar_t>(), far.data_ptr<scalar_t>(), xyzs.data_ptr<scalar_t>(), dirs.data_ptr<scalar_t>(), deltas.data_ptr<scalar_t>(), noises.data_ptr<scalar_t>());
     }));
 }
 
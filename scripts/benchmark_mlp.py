@@ -0,0 +1,95 @@
+''' micro-benchmark of the FiLM-conditioned sigma network (CondMLP) against the previous repeat-based FiLM.
+usage: python scripts/benchmark_mlp.py [--N 1000000] [--compile]
+reports time and memory allocated per call for N samples, for inference (no_grad) and training (forward + backward).
+'''
+import os
+import sys
+import time
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from nerf.network import CondMLP
+
+
+def forward_repeat(mlp, x, scales, shifts, e):
+    # the previous implementation: conditions are repeated to [N, dim] and concatenated per sample.
+    x = torch.cat([x, e.repeat(x.shape[0], 1)], dim=-1)
+    for l in range(mlp.num_layers):
+        x = mlp.net[l](x)
+        if l != mlp.num_layers - 1:
+            shift = scales[l].repeat(x.shape[0], 1)
+            scale = shifts[l].repeat(x.shape[0], 1)
+            x = x*(scale+1.0)+shift
+            x = F.relu(x, inplace=True)
+    return x
+
+
+def forward_cond(mlp, x, scales, shifts, e):
+    return mlp(x, scales=scales, shifts=shifts, bias=mlp.cond_bias(e))
+
+
+def measure(fn, device, train, repeat=5):
+    # returns (ms per call, MB allocated per call)
+    def step():
+        out = fn()
+        if train:
+            out.sum().backward()
+
+    step() # warm up (and compile)
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        t = time.time()
+        for _ in range(repeat):
+            step()
+        torch.cuda.synchronize()
+        ms = (time.time() - t) / repeat * 1000
+        mem = (torch.cuda.max_memory_allocated() - base) / 2 ** 20
+    else:
+        t = time.time()
+        for _ in range(repeat):
+            step()
+        ms = (time.time() - t) / repeat * 1000
+        with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+            step()
+        mem = sum(e.self_cpu_memory_usage for e in prof.key_averages() if e.self_cpu_memory_usage > 0) / 2 ** 20
+
+    return ms, mem
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--N', type=int, default=1000000, help="number of samples per call")
+    parser.add_argument('--in_dim', type=int, default=64)
+    parser.add_argument('--hidden_dim', type=int, default=64)
+    parser.add_argument('--num_layers', type=int, default=3)
+    parser.add_argument('--compile', action='store_true', help="also benchmark the torch.compile variant")
+    opt = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    mlp = CondMLP(opt.in_dim + 1, 65, opt.hidden_dim, opt.num_layers).to(device)
+    variants = [('repeat', mlp, forward_repeat), ('broadcast', mlp, forward_cond)]
+    if opt.compile:
+        mlp_compiled = CondMLP(opt.in_dim + 1, 65, opt.hidden_dim, opt.num_layers, compile=True).to(device)
+        mlp_compiled.load_state_dict(mlp.state_dict())
+        variants.append(('compiled', mlp_compiled, forward_cond))
+
+    x = torch.rand(opt.N, opt.in_dim, device=device)
+    e = torch.rand(1, 1, device=device)
+
+    print(f'[INFO] device = {device}, N = {opt.N}, per call (per million samples = x {1e6 / opt.N:.2f})')
+
+    for train in [False, True]:
+        for name, net, fn in variants:
+            scales = [torch.randn(1, opt.hidden_dim, device=device, requires_grad=train) for _ in range(2)]
+            shifts = [torch.randn(1, opt.hidden_dim, device=device, requires_grad=train) for _ in range(2)]
+            with torch.set_grad_enabled(train):
+                ms, mem = measure(lambda: fn(net, x, scales, shifts, e), device, train)
+            print(f"[INFO] {'train' if train else 'infer'} {name:10s} {ms:8.2f} ms {mem:9.1f} MB")
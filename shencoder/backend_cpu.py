@@ -0,0 +1,336 @@
+import torch
+
+# Pure PyTorch implementation of the `_shencoder` bindings, used when CUDA is not available.
+# Functions mirror the signatures in `src/bindings.cpp` and write into the pre-allocated outputs.
+# The closed-form basis and its derivatives are the same polynomials as `kernel_sh`, evaluated column-wise over the whole batch.
+
+
+def _monomials(inputs):
+    x, y, z = inputs[:, 0], inputs[:, 1], inputs[:, 2]
+    xy, xz, yz, x2, y2, z2 = x*y, x*z, y*z, x*x, y*y, z*z
+    xyz = xy*z
+    x4, y4, z4 = x2*x2, y2*y2, z2*z2
+    x6, y6, z6 = x4*x2, y4*y2, z4*z2
+    return x, y, z, xy, xz, yz, x2, y2, z2, xyz, x4, y4, z4, x6, y6, z6
+
+
+def _write_sh(outputs, C, m):
+    x, y, z, xy, xz, yz, x2, y2, z2, xyz, x4, y4, z4, x6, y6, z6 = m
+    outputs[:, 0] = 0.28209479177387814 # 1/(2*sqrt(pi))
+    if C <= 1: return
+    outputs[:, 1] = -0.48860251190291987*y # -sqrt(3)*y/(2*sqrt(pi))
+    outputs[:, 2] = 0.48860251190291987*z # sqrt(3)*z/(2*sqrt(pi))
+    outputs[:, 3] = -0.48860251190291987*x # -sqrt(3)*x/(2*sqrt(pi))
+    if C <= 2: return
+    outputs[:, 4] = 1.0925484305920792*xy # sqrt(15)*xy/(2*sqrt(pi))
+    outputs[:, 5] = -1.0925484305920792*yz # -sqrt(15)*yz/(2*sqrt(pi))
+    outputs[:, 6] = 0.94617469575755997*z2 - 0.31539156525251999 # sqrt(5)*(3*z2 - 1)/(4*sqrt(pi))
+    outputs[:, 7] = -1.0925484305920792*xz # -sqrt(15)*xz/(2*sqrt(pi))
+    outputs[:, 8] = 0.54627421529603959*x2 - 0.54627421529603959*y2 # sqrt(15)*(x2 - y2)/(4*sqrt(pi))
+    if C <= 3: return
+    outputs[:, 9] = 0.59004358992664352*y*(-3.0*x2 + y2) # sqrt(70)*y*(-3*x2 + y2)/(8*sqrt(pi))
+    outputs[:, 10] = 2.8906114426405538*xy*z # sqrt(105)*xy*z/(2*sqrt(pi))
+    outputs[:, 11] = 0.45704579946446572*y*(1.0 - 5.0*z2) # sqrt(42)*y*(1 - 5*z2)/(8*sqrt(pi))
+    outputs[:, 12] = 0.3731763325901154*z*(5.0*z2 - 3.0) # sqrt(7)*z*(5*z2 - 3)/(4*sqrt(pi))
+    outputs[:, 13] = 0.45704579946446572*x*(1.0 - 5.0*z2) # sqrt(42)*x*(1 - 5*z2)/(8*sqrt(pi))
+    outputs[:, 14] = 1.4453057213202769*z*(x2 - y2) # sqrt(105)*z*(x2 - y2)/(4*sqrt(pi))
+    outputs[:, 15] = 0.59004358992664352*x*(-x2 + 3.0*y2) # sqrt(70)*x*(-x2 + 3*y2)/(8*sqrt(pi))
+    if C <= 4: return
+    outputs[:, 16] = 2.5033429417967046*xy*(x2 - y2) # 3*sqrt(35)*xy*(x2 - y2)/(4*sqrt(pi))
+    outputs[:, 17] = 1.7701307697799304*yz*(-3.0*x2 + y2) # 3*sqrt(70)*yz*(-3*x2 + y2)/(8*sqrt(pi))
+    outputs[:, 18] = 0.94617469575756008*xy*(7.0*z2 - 1.0) # 3*sqrt(5)*xy*(7*z2 - 1)/(4*sqrt(pi))
+    outputs[:, 19] = 0.66904654355728921*yz*(3.0 - 7.0*z2) # 3*sqrt(10)*yz*(3 - 7*z2)/(8*sqrt(pi))
+    outputs[:, 20] = -3.1735664074561294*z2 + 3.7024941420321507*z4 + 0.31735664074561293 # 3*(-30*z2 + 35*z4 + 3)/(16*sqrt(pi))
+    outputs[:, 21] = 0.66904654355728921*xz*(3.0 - 7.0*z2) # 3*sqrt(10)*xz*(3 - 7*z2)/(8*sqrt(pi))
+    outputs[:, 22] = 0.47308734787878004*(x2 - y2)*(7.0*z2 - 1.0) # 3*sqrt(5)*(x2 - y2)*(7*z2 - 1)/(8*sqrt(pi))
+    outputs[:, 23] = 1.7701307697799304*xz*(-x2 + 3.0*y2) # 3*sqrt(70)*xz*(-x2 + 3*y2)/(8*sqrt(pi))
+    outputs[:, 24] = -3.7550144126950569*x2*y2 + 0.62583573544917614*x4 + 0.62583573544917614*y4 # 3*sqrt(35)*(-6*x2*y2 + x4 + y4)/(16*sqrt(pi))
+    if C <= 5: return
+    outputs[:, 25] = 0.65638205684017015*y*(10.0*x2*y2 - 5.0*x4 - y4) # 3*sqrt(154)*y*(10*x2*y2 - 5*x4 - y4)/(32*sqrt(pi))
+    outputs[:, 26] = 8.3026492595241645*xy*z*(x2 - y2) # 3*sqrt(385)*xy*z*(x2 - y2)/(4*sqrt(pi))
+    outputs[:, 27] = -0.48923829943525038*y*(3.0*x2 - y2)*(9.0*z2 - 1.0) # -sqrt(770)*y*(3*x2 - y2)*(9*z2 - 1)/(32*sqrt(pi))
+    outputs[:, 28] = 4.7935367849733241*xy*z*(3.0*z2 - 1.0) # sqrt(1155)*xy*z*(3*z2 - 1)/(4*sqrt(pi))
+    outputs[:, 29] = 0.45294665119569694*y*(14.0*z2 - 21.0*z4 - 1.0) # sqrt(165)*y*(14*z2 - 21*z4 - 1)/(16*sqrt(pi))
+    outputs[:, 30] = 0.1169503224534236*z*(-70.0*z2 + 63.0*z4 + 15.0) # sqrt(11)*z*(-70*z2 + 63*z4 + 15)/(16*sqrt(pi))
+    outputs[:, 31] = 0.45294665119569694*x*(14.0*z2 - 21.0*z4 - 1.0) # sqrt(165)*x*(14*z2 - 21*z4 - 1)/(16*sqrt(pi))
+    outputs[:, 32] = 2.3967683924866621*z*(x2 - y2)*(3.0*z2 - 1.0) # sqrt(1155)*z*(x2 - y2)*(3*z2 - 1)/(8*sqrt(pi))
+    outputs[:, 33] = -0.48923829943525038*x*(x2 - 3.0*y2)*(9.0*z2 - 1.0) # -sqrt(770)*x*(x2 - 3*y2)*(9*z2 - 1)/(32*sqrt(pi))
+    outputs[:, 34] = 2.0756623148810411*z*(-6.0*x2*y2 + x4 + y4) # 3*sqrt(385)*z*(-6*x2*y2 + x4 + y4)/(16*sqrt(pi))
+    outputs[:, 35] = 0.65638205684017015*x*(10.0*x2*y2 - x4 - 5.0*y4) # 3*sqrt(154)*x*(10*x2*y2 - x4 - 5*y4)/(32*sqrt(pi))
+    if C <= 6: return
+    outputs[:, 36] = 1.3663682103838286*xy*(-10.0*x2*y2 + 3.0*x4 + 3.0*y4) # sqrt(6006)*xy*(-10*x2*y2 + 3*x4 + 3*y4)/(32*sqrt(pi))
+    outputs[:, 37] = 2.3666191622317521*yz*(10.0*x2*y2 - 5.0*x4 - y4) # 3*sqrt(2002)*yz*(10*x2*y2 - 5*x4 - y4)/(32*sqrt(pi))
+    outputs[:, 38] = 2.0182596029148963*xy*(x2 - y2)*(11.0*z2 - 1.0) # 3*sqrt(91)*xy*(x2 - y2)*(11*z2 - 1)/(8*sqrt(pi))
+    outputs[:, 39] = -0.92120525951492349*yz*(3.0*x2 - y2)*(11.0*z2 - 3.0) # -sqrt(2730)*yz*(3*x2 - y2)*(11*z2 - 3)/(32*sqrt(pi))
+    outputs[:, 40] = 0.92120525951492349*xy*(-18.0*z2 + 33.0*z4 + 1.0) # sqrt(2730)*xy*(-18*z2 + 33*z4 + 1)/(32*sqrt(pi))
+    outputs[:, 41] = 0.58262136251873131*yz*(30.0*z2 - 33.0*z4 - 5.0) # sqrt(273)*yz*(30*z2 - 33*z4 - 5)/(16*sqrt(pi))
+    outputs[:, 42] = 6.6747662381009842*z2 - 20.024298714302954*z4 + 14.684485723822165*z6 - 0.31784601133814211 # sqrt(13)*(105*z2 - 315*z4 + 231*z6 - 5)/(32*sqrt(pi))
+    outputs[:, 43] = 0.58262136251873131*xz*(30.0*z2 - 33.0*z4 - 5.0) # sqrt(273)*xz*(30*z2 - 33*z4 - 5)/(16*sqrt(pi))
+    outputs[:, 44] = 0.46060262975746175*(x2 - y2)*(11.0*z2*(3.0*z2 - 1.0) - 7.0*z2 + 1.0) # sqrt(2730)*(x2 - y2)*(11*z2*(3*z2 - 1) - 7*z2 + 1)/(64*sqrt(pi))
+    outputs[:, 45] = -0.92120525951492349*xz*(x2 - 3.0*y2)*(11.0*z2 - 3.0) # -sqrt(2730)*xz*(x2 - 3*y2)*(11*z2 - 3)/(32*sqrt(pi))
+    outputs[:, 46] = 0.50456490072872406*(11.0*z2 - 1.0)*(-6.0*x2*y2 + x4 + y4) # 3*sqrt(91)*(11*z2 - 1)*(-6*x2*y2 + x4 + y4)/(32*sqrt(pi))
+    outputs[:, 47] = 2.3666191622317521*xz*(10.0*x2*y2 - x4 - 5.0*y4) # 3*sqrt(2002)*xz*(10*x2*y2 - x4 - 5*y4)/(32*sqrt(pi))
+    outputs[:, 48] = 10.247761577878714*x2*y4 - 10.247761577878714*x4*y2 + 0.6831841051919143*x6 - 0.6831841051919143*y6 # sqrt(6006)*(15*x2*y4 - 15*x4*y2 + x6 - y6)/(64*sqrt(pi))
+    if C <= 7: return
+    outputs[:, 49] = 0.70716273252459627*y*(-21.0*x2*y4 + 35.0*x4*y2 - 7.0*x6 + y6) # 3*sqrt(715)*y*(-21*x2*y4 + 35*x4*y2 - 7*x6 + y6)/(64*sqrt(pi))
+    outputs[:, 50] = 5.2919213236038001*xy*z*(-10.0*x2*y2 + 3.0*x4 + 3.0*y4) # 3*sqrt(10010)*xy*z*(-10*x2*y2 + 3*x4 + 3*y4)/(32*sqrt(pi))
+    outputs[:, 51] = -0.51891557872026028*y*(13.0*z2 - 1.0)*(-10.0*x2*y2 + 5.0*x4 + y4) # -3*sqrt(385)*y*(13*z2 - 1)*(-10*x2*y2 + 5*x4 + y4)/(64*sqrt(pi))
+    outputs[:, 52] = 4.1513246297620823*xy*z*(x2 - y2)*(13.0*z2 - 3.0) # 3*sqrt(385)*xy*z*(x2 - y2)*(13*z2 - 3)/(8*sqrt(pi))
+    outputs[:, 53] = -0.15645893386229404*y*(3.0*x2 - y2)*(13.0*z2*(11.0*z2 - 3.0) - 27.0*z2 + 3.0) # -3*sqrt(35)*y*(3*x2 - y2)*(13*z2*(11*z2 - 3) - 27*z2 + 3)/(64*sqrt(pi))
+    outputs[:, 54] = 0.44253269244498261*xy*z*(-110.0*z2 + 143.0*z4 + 15.0) # 3*sqrt(70)*xy*z*(-110*z2 + 143*z4 + 15)/(32*sqrt(pi))
+    outputs[:, 55] = 0.090331607582517306*y*(-135.0*z2 + 495.0*z4 - 429.0*z6 + 5.0) # sqrt(105)*y*(-135*z2 + 495*z4 - 429*z6 + 5)/(64*sqrt(pi))
+    outputs[:, 56] = 0.068284276912004949*z*(315.0*z2 - 693.0*z4 + 429.0*z6 - 35.0) # sqrt(15)*z*(315*z2 - 693*z4 + 429*z6 - 35)/(32*sqrt(pi))
+    outputs[:, 57] = 0.090331607582517306*x*(-135.0*z2 + 495.0*z4 - 429.0*z6 + 5.0) # sqrt(105)*x*(-135*z2 + 495*z4 - 429*z6 + 5)/(64*sqrt(pi))
+    outputs[:, 58] = 0.07375544874083044*z*(x2 - y2)*(143.0*z2*(3.0*z2 - 1.0) - 187.0*z2 + 45.0) # sqrt(70)*z*(x2 - y2)*(143*z2*(3*z2 - 1) - 187*z2 + 45)/(64*sqrt(pi))
+    outputs[:, 59] = -0.15645893386229404*x*(x2 - 3.0*y2)*(13.0*z2*(11.0*z2 - 3.0) - 27.0*z2 + 3.0) # -3*sqrt(35)*x*(x2 - 3*y2)*(13*z2*(11*z2 - 3) - 27*z2 + 3)/(64*sqrt(pi))
+    outputs[:, 60] = 1.0378311574405206*z*(13.0*z2 - 3.0)*(-6.0*x2*y2 + x4 + y4) # 3*sqrt(385)*z*(13*z2 - 3)*(-6*x2*y2 + x4 + y4)/(32*sqrt(pi))
+    outputs[:, 61] = -0.51891557872026028*x*(13.0*z2 - 1.0)*(-10.0*x2*y2 + x4 + 5.0*y4) # -3*sqrt(385)*x*(13*z2 - 1)*(-10*x2*y2 + x4 + 5*y4)/(64*sqrt(pi))
+    outputs[:, 62] = 2.6459606618019*z*(15.0*x2*y4 - 15.0*x4*y2 + x6 - y6) # 3*sqrt(10010)*z*(15*x2*y4 - 15*x4*y2 + x6 - y6)/(64*sqrt(pi))
+    outputs[:, 63] = 0.70716273252459627*x*(-35.0*x2*y4 + 21.0*x4*y2 - x6 + 7.0*y6) # 3*sqrt(715)*x*(-35*x2*y4 + 21*x4*y2 - x6 + 7*y6)/(64*sqrt(pi))
+
+
+def _write_sh_dx(dx, C, m):
+    x, y, z, xy, xz, yz, x2, y2, z2, xyz, x4, y4, z4, x6, y6, z6 = m
+    dx[:, 0] = 0.0 # 0
+    if C <= 1: return
+    dx[:, 1] = 0.0 # 0
+    dx[:, 2] = 0.0 # 0
+    dx[:, 3] = -0.48860251190291992 # -sqrt(3)/(2*sqrt(pi))
+    if C <= 2: return
+    dx[:, 4] = 1.0925484305920792*y # sqrt(15)*y/(2*sqrt(pi))
+    dx[:, 5] = 0.0 # 0
+    dx[:, 6] = 0.0 # 0
+    dx[:, 7] = -1.0925484305920792*z # -sqrt(15)*z/(2*sqrt(pi))
+    dx[:, 8] = 1.0925484305920792*x # sqrt(15)*x/(2*sqrt(pi))
+    if C <= 3: return
+    dx[:, 9] = -3.5402615395598609*xy # -3*sqrt(70)*xy/(4*sqrt(pi))
+    dx[:, 10] = 2.8906114426405538*yz # sqrt(105)*yz/(2*sqrt(pi))
+    dx[:, 11] = 0.0 # 0
+    dx[:, 12] = 0.0 # 0
+    dx[:, 13] = 0.45704579946446572 - 2.2852289973223288*z2 # sqrt(42)*(1 - 5*z2)/(8*sqrt(pi))
+    dx[:, 14] = 2.8906114426405538*xz # sqrt(105)*xz/(2*sqrt(pi))
+    dx[:, 15] = -1.7701307697799304*x2 + 1.7701307697799304*y2 # 3*sqrt(70)*(-x2 + y2)/(8*sqrt(pi))
+    if C <= 4: return
+    dx[:, 16] = 2.5033429417967046*y*(3.0*x2 - y2) # 3*sqrt(35)*y*(3*x2 - y2)/(4*sqrt(pi))
+    dx[:, 17] = -10.620784618679583*xy*z # -9*sqrt(70)*xy*z/(4*sqrt(pi))
+    dx[:, 18] = 0.94617469575756008*y*(7.0*z2 - 1.0) # 3*sqrt(5)*y*(7*z2 - 1)/(4*sqrt(pi))
+    dx[:, 19] = 0.0 # 0
+    dx[:, 20] = 0.0 # 0
+    dx[:, 21] = 0.66904654355728921*z*(3.0 - 7.0*z2) # 3*sqrt(10)*z*(3 - 7*z2)/(8*sqrt(pi))
+    dx[:, 22] = 0.94617469575756008*x*(7.0*z2 - 1.0) # 3*sqrt(5)*x*(7*z2 - 1)/(4*sqrt(pi))
+    dx[:, 23] = 5.3103923093397913*z*(-x2 + y2) # 9*sqrt(70)*z*(-x2 + y2)/(8*sqrt(pi))
+    dx[:, 24] = 2.5033429417967046*x*(x2 - 3.0*y2) # 3*sqrt(35)*x*(x2 - 3*y2)/(4*sqrt(pi))
+    if C <= 5: return
+    dx[:, 25] = 13.127641136803401*xy*(-x2 + y2) # 15*sqrt(154)*xy*(-x2 + y2)/(8*sqrt(pi))
+    dx[:, 26] = 8.3026492595241645*yz*(3.0*x2 - y2) # 3*sqrt(385)*yz*(3*x2 - y2)/(4*sqrt(pi))
+    dx[:, 27] = 2.9354297966115022*xy*(1.0 - 9.0*z2) # 3*sqrt(770)*xy*(1 - 9*z2)/(16*sqrt(pi))
+    dx[:, 28] = 4.7935367849733241*yz*(3.0*z2 - 1.0) # sqrt(1155)*yz*(3*z2 - 1)/(4*sqrt(pi))
+    dx[:, 29] = 0.0 # 0
+    dx[:, 30] = 0.0 # 0
+    dx[:, 31] = 6.3412531167397574*z2 - 9.5118796751096362*z4 - 0.45294665119569694 # sqrt(165)*(14*z2 - 21*z4 - 1)/(16*sqrt(pi))
+    dx[:, 32] = 4.7935367849733241*xz*(3.0*z2 - 1.0) # sqrt(1155)*xz*(3*z2 - 1)/(4*sqrt(pi))
+    dx[:, 33] = -13.209434084751759*x2*z2 + 1.4677148983057511*x2 + 13.209434084751759*y2*z2 - 1.4677148983057511*y2 # 3*sqrt(770)*(-9*x2*z2 + x2 + 9*y2*z2 - y2)/(32*sqrt(pi))
+    dx[:, 34] = 8.3026492595241645*xz*(x2 - 3.0*y2) # 3*sqrt(385)*xz*(x2 - 3*y2)/(4*sqrt(pi))
+    dx[:, 35] = 19.6914617052051*x2*y2 - 3.2819102842008503*x4 - 3.2819102842008503*y4 # 15*sqrt(154)*(6*x2*y2 - x4 - y4)/(32*sqrt(pi))
+    if C <= 6: return
+    dx[:, 36] = 4.0991046311514854*y*(-10.0*x2*y2 + 5.0*x4 + y4) # 3*sqrt(6006)*y*(-10*x2*y2 + 5*x4 + y4)/(32*sqrt(pi))
+    dx[:, 37] = 47.332383244635047*xy*z*(-x2 + y2) # 15*sqrt(2002)*xy*z*(-x2 + y2)/(8*sqrt(pi))
+    dx[:, 38] = 2.0182596029148963*y*(3.0*x2 - y2)*(11.0*z2 - 1.0) # 3*sqrt(91)*y*(3*x2 - y2)*(11*z2 - 1)/(8*sqrt(pi))
+    dx[:, 39] = 5.5272315570895412*xy*z*(3.0 - 11.0*z2) # 3*sqrt(2730)*xy*z*(3 - 11*z2)/(16*sqrt(pi))
+    dx[:, 40] = 0.92120525951492349*y*(-18.0*z2 + 33.0*z4 + 1.0) # sqrt(2730)*y*(-18*z2 + 33*z4 + 1)/(32*sqrt(pi))
+    dx[:, 41] = 0.0 # 0
+    dx[:, 42] = 0.0 # 0
+    dx[:, 43] = 0.58262136251873131*z*(30.0*z2 - 33.0*z4 - 5.0) # sqrt(273)*z*(30*z2 - 33*z4 - 5)/(16*sqrt(pi))
+    dx[:, 44] = 0.92120525951492349*x*(-18.0*z2 + 33.0*z4 + 1.0) # sqrt(2730)*x*(-18*z2 + 33*z4 + 1)/(32*sqrt(pi))
+    dx[:, 45] = -2.7636157785447706*z*(x2 - y2)*(11.0*z2 - 3.0) # -3*sqrt(2730)*z*(x2 - y2)*(11*z2 - 3)/(32*sqrt(pi))
+    dx[:, 46] = 2.0182596029148963*x*(x2 - 3.0*y2)*(11.0*z2 - 1.0) # 3*sqrt(91)*x*(x2 - 3*y2)*(11*z2 - 1)/(8*sqrt(pi))
+    dx[:, 47] = 11.833095811158762*z*(6.0*x2*y2 - x4 - y4) # 15*sqrt(2002)*z*(6*x2*y2 - x4 - y4)/(32*sqrt(pi))
+    dx[:, 48] = 4.0991046311514854*x*(-10.0*x2*y2 + x4 + 5.0*y4) # 3*sqrt(6006)*x*(-10*x2*y2 + x4 + 5*y4)/(32*sqrt(pi))
+    if C <= 7: return
+    dx[:, 49] = 9.9002782553443485*xy*(10.0*x2*y2 - 3.0*x4 - 3.0*y4) # 21*sqrt(715)*xy*(10*x2*y2 - 3*x4 - 3*y4)/(32*sqrt(pi))
+    dx[:, 50] = 15.875763970811402*yz*(-10.0*x2*y2 + 5.0*x4 + y4) # 9*sqrt(10010)*yz*(-10*x2*y2 + 5*x4 + y4)/(32*sqrt(pi))
+    dx[:, 51] = -10.378311574405206*xy*(x2 - y2)*(13.0*z2 - 1.0) # -15*sqrt(385)*xy*(x2 - y2)*(13*z2 - 1)/(16*sqrt(pi))
+    dx[:, 52] = 4.1513246297620823*yz*(3.0*x2 - y2)*(13.0*z2 - 3.0) # 3*sqrt(385)*yz*(3*x2 - y2)*(13*z2 - 3)/(8*sqrt(pi))
+    dx[:, 53] = 0.93875360317376422*xy*(66.0*z2 - 143.0*z4 - 3.0) # 9*sqrt(35)*xy*(66*z2 - 143*z4 - 3)/(32*sqrt(pi))
+    dx[:, 54] = 0.44253269244498261*yz*(-110.0*z2 + 143.0*z4 + 15.0) # 3*sqrt(70)*yz*(-110*z2 + 143*z4 + 15)/(32*sqrt(pi))
+    dx[:, 55] = 0.0 # 0
+    dx[:, 56] = 0.0 # 0
+    dx[:, 57] = -12.194767023639836*z2 + 44.714145753346067*z4 - 38.752259652899923*z6 + 0.45165803791258652 # sqrt(105)*(-135*z2 + 495*z4 - 429*z6 + 5)/(64*sqrt(pi))
+    dx[:, 58] = 0.44253269244498261*xz*(-110.0*z2 + 143.0*z4 + 15.0) # 3*sqrt(70)*xz*(-110*z2 + 143*z4 + 15)/(32*sqrt(pi))
+    dx[:, 59] = 30.97886890473422*x2*z2 - 67.120882626924143*x2*z4 - 1.4081304047606462*x2 - 30.97886890473422*y2*z2 + 67.120882626924143*y2*z4 + 1.4081304047606462*y2 # 9*sqrt(35)*(66*x2*z2 - 143*x2*z4 - 3*x2 - 66*y2*z2 + 143*y2*z4 + 3*y2)/(64*sqrt(pi))
+    dx[:, 60] = 4.1513246297620823*xz*(x2 - 3.0*y2)*(13.0*z2 - 3.0) # 3*sqrt(385)*xz*(x2 - 3*y2)*(13*z2 - 3)/(8*sqrt(pi))
+    dx[:, 61] = -0.51891557872026028*(13.0*z2 - 1.0)*(-10.0*x2*y2 + 4.0*x2*(x2 - 5.0*y2) + x4 + 5.0*y4) # -3*sqrt(385)*(13*z2 - 1)*(-10*x2*y2 + 4*x2*(x2 - 5*y2) + x4 + 5*y4)/(64*sqrt(pi))
+    dx[:, 62] = 15.875763970811402*xz*(-10.0*x2*y2 + x4 + 5.0*y4) # 9*sqrt(10010)*xz*(-10*x2*y2 + x4 + 5*y4)/(32*sqrt(pi))
+    dx[:, 63] = -74.252086915082614*x2*y4 + 74.252086915082614*x4*y2 - 4.9501391276721742*x6 + 4.9501391276721742*y6 # 21*sqrt(715)*(-15*x2*y4 + 15*x4*y2 - x6 + y6)/(64*sqrt(pi))
+
+
+def _write_sh_dy(dy, C, m):
+    x, y, z, xy, xz, yz, x2, y2, z2, xyz, x4, y4, z4, x6, y6, z6 = m
+    dy[:, 0] = 0.0 # 0
+    if C <= 1: return
+    dy[:, 1] = -0.48860251190291992 # -sqrt(3)/(2*sqrt(pi))
+    dy[:, 2] = 0.0 # 0
+    dy[:, 3] = 0.0 # 0
+    if C <= 2: return
+    dy[:, 4] = 1.0925484305920792*x # sqrt(15)*x/(2*sqrt(pi))
+    dy[:, 5] = -1.0925484305920792*z # -sqrt(15)*z/(2*sqrt(pi))
+    dy[:, 6] = 0.0 # 0
+    dy[:, 7] = 0.0 # 0
+    dy[:, 8] = -1.0925484305920792*y # -sqrt(15)*y/(2*sqrt(pi))
+    if C <= 3: return
+    dy[:, 9] = -1.7701307697799304*x2 + 1.7701307697799304*y2 # 3*sqrt(70)*(-x2 + y2)/(8*sqrt(pi))
+    dy[:, 10] = 2.8906114426405538*xz # sqrt(105)*xz/(2*sqrt(pi))
+    dy[:, 11] = 0.45704579946446572 - 2.2852289973223288*z2 # sqrt(42)*(1 - 5*z2)/(8*sqrt(pi))
+    dy[:, 12] = 0.0 # 0
+    dy[:, 13] = 0.0 # 0
+    dy[:, 14] = -2.8906114426405538*yz # -sqrt(105)*yz/(2*sqrt(pi))
+    dy[:, 15] = 3.5402615395598609*xy # 3*sqrt(70)*xy/(4*sqrt(pi))
+    if C <= 4: return
+    dy[:, 16] = 2.5033429417967046*x*(x2 - 3.0*y2) # 3*sqrt(35)*x*(x2 - 3*y2)/(4*sqrt(pi))
+    dy[:, 17] = 5.3103923093397913*z*(-x2 + y2) # 9*sqrt(70)*z*(-x2 + y2)/(8*sqrt(pi))
+    dy[:, 18] = 0.94617469575756008*x*(7.0*z2 - 1.0) # 3*sqrt(5)*x*(7*z2 - 1)/(4*sqrt(pi))
+    dy[:, 19] = 0.66904654355728921*z*(3.0 - 7.0*z2) # 3*sqrt(10)*z*(3 - 7*z2)/(8*sqrt(pi))
+    dy[:, 20] = 0.0 # 0
+    dy[:, 21] = 0.0 # 0
+    dy[:, 22] = 0.94617469575756008*y*(1.0 - 7.0*z2) # 3*sqrt(5)*y*(1 - 7*z2)/(4*sqrt(pi))
+    dy[:, 23] = 10.620784618679583*xy*z # 9*sqrt(70)*xy*z/(4*sqrt(pi))
+    dy[:, 24] = 2.5033429417967046*y*(-3.0*x2 + y2) # 3*sqrt(35)*y*(-3*x2 + y2)/(4*sqrt(pi))
+    if C <= 5: return
+    dy[:, 25] = 19.6914617052051*x2*y2 - 3.2819102842008503*x4 - 3.2819102842008503*y4 # 15*sqrt(154)*(6*x2*y2 - x4 - y4)/(32*sqrt(pi))
+    dy[:, 26] = 8.3026492595241645*xz*(x2 - 3.0*y2) # 3*sqrt(385)*xz*(x2 - 3*y2)/(4*sqrt(pi))
+    dy[:, 27] = -1.4677148983057511*(x2 - y2)*(9.0*z2 - 1.0) # -3*sqrt(770)*(x2 - y2)*(9*z2 - 1)/(32*sqrt(pi))
+    dy[:, 28] = 4.7935367849733241*xz*(3.0*z2 - 1.0) # sqrt(1155)*xz*(3*z2 - 1)/(4*sqrt(pi))
+    dy[:, 29] = 6.3412531167397574*z2 - 9.5118796751096362*z4 - 0.45294665119569694 # sqrt(165)*(14*z2 - 21*z4 - 1)/(16*sqrt(pi))
+    dy[:, 30] = 0.0 # 0
+    dy[:, 31] = 0.0 # 0
+    dy[:, 32] = 4.7935367849733241*yz*(1.0 - 3.0*z2) # sqrt(1155)*yz*(1 - 3*z2)/(4*sqrt(pi))
+    dy[:, 33] = 2.9354297966115022*xy*(9.0*z2 - 1.0) # 3*sqrt(770)*xy*(9*z2 - 1)/(16*sqrt(pi))
+    dy[:, 34] = 8.3026492595241645*yz*(-3.0*x2 + y2) # 3*sqrt(385)*yz*(-3*x2 + y2)/(4*sqrt(pi))
+    dy[:, 35] = 13.127641136803401*xy*(x2 - y2) # 15*sqrt(154)*xy*(x2 - y2)/(8*sqrt(pi))
+    if C <= 6: return
+    dy[:, 36] = 4.0991046311514854*x*(-10.0*x2*y2 + x4 + 5.0*y4) # 3*sqrt(6006)*x*(-10*x2*y2 + x4 + 5*y4)/(32*sqrt(pi))
+    dy[:, 37] = 11.833095811158762*z*(6.0*x2*y2 - x4 - y4) # 15*sqrt(2002)*z*(6*x2*y2 - x4 - y4)/(32*sqrt(pi))
+    dy[:, 38] = 2.0182596029148963*x*(x2 - 3.0*y2)*(11.0*z2 - 1.0) # 3*sqrt(91)*x*(x2 - 3*y2)*(11*z2 - 1)/(8*sqrt(pi))
+    dy[:, 39] = -2.7636157785447706*z*(x2 - y2)*(11.0*z2 - 3.0) # -3*sqrt(2730)*z*(x2 - y2)*(11*z2 - 3)/(32*sqrt(pi))
+    dy[:, 40] = 0.92120525951492349*x*(-18.0*z2 + 33.0*z4 + 1.0) # sqrt(2730)*x*(-18*z2 + 33*z4 + 1)/(32*sqrt(pi))
+    dy[:, 41] = 0.58262136251873131*z*(30.0*z2 - 33.0*z4 - 5.0) # sqrt(273)*z*(30*z2 - 33*z4 - 5)/(16*sqrt(pi))
+    dy[:, 42] = 0.0 # 0
+    dy[:, 43] = 0.0 # 0
+    dy[:, 44] = 0.92120525951492349*y*(18.0*z2 - 33.0*z4 - 1.0) # sqrt(2730)*y*(18*z2 - 33*z4 - 1)/(32*sqrt(pi))
+    dy[:, 45] = 5.5272315570895412*xy*z*(11.0*z2 - 3.0) # 3*sqrt(2730)*xy*z*(11*z2 - 3)/(16*sqrt(pi))
+    dy[:, 46] = -2.0182596029148963*y*(3.0*x2 - y2)*(11.0*z2 - 1.0) # -3*sqrt(91)*y*(3*x2 - y2)*(11*z2 - 1)/(8*sqrt(pi))
+    dy[:, 47] = 47.332383244635047*xy*z*(x2 - y2) # 15*sqrt(2002)*xy*z*(x2 - y2)/(8*sqrt(pi))
+    dy[:, 48] = 4.0991046311514854*y*(10.0*x2*y2 - 5.0*x4 - y4) # 3*sqrt(6006)*y*(10*x2*y2 - 5*x4 - y4)/(32*sqrt(pi))
+    if C <= 7: return
+    dy[:, 49] = -74.252086915082614*x2*y4 + 74.252086915082614*x4*y2 - 4.9501391276721742*x6 + 4.9501391276721742*y6 # 21*sqrt(715)*(-15*x2*y4 + 15*x4*y2 - x6 + y6)/(64*sqrt(pi))
+    dy[:, 50] = 15.875763970811402*xz*(-10.0*x2*y2 + x4 + 5.0*y4) # 9*sqrt(10010)*xz*(-10*x2*y2 + x4 + 5*y4)/(32*sqrt(pi))
+    dy[:, 51] = 0.51891557872026028*(13.0*z2 - 1.0)*(10.0*x2*y2 - 5.0*x4 + 4.0*y2*(5.0*x2 - y2) - y4) # 3*sqrt(385)*(13*z2 - 1)*(10*x2*y2 - 5*x4 + 4*y2*(5*x2 - y2) - y4)/(64*sqrt(pi))
+    dy[:, 52] = 4.1513246297620823*xz*(x2 - 3.0*y2)*(13.0*z2 - 3.0) # 3*sqrt(385)*xz*(x2 - 3*y2)*(13*z2 - 3)/(8*sqrt(pi))
+    dy[:, 53] = -0.46937680158688211*(x2 - y2)*(13.0*z2*(11.0*z2 - 3.0) - 27.0*z2 + 3.0) # -9*sqrt(35)*(x2 - y2)*(13*z2*(11*z2 - 3) - 27*z2 + 3)/(64*sqrt(pi))
+    dy[:, 54] = 0.44253269244498261*xz*(-110.0*z2 + 143.0*z4 + 15.0) # 3*sqrt(70)*xz*(-110*z2 + 143*z4 + 15)/(32*sqrt(pi))
+    dy[:, 55] = -12.194767023639836*z2 + 44.714145753346067*z4 - 38.752259652899923*z6 + 0.45165803791258652 # sqrt(105)*(-135*z2 + 495*z4 - 429*z6 + 5)/(64*sqrt(pi))
+    dy[:, 56] = 0.0 # 0
+    dy[:, 57] = 0.0 # 0
+    dy[:, 58] = 0.44253269244498261*yz*(110.0*z2 - 143.0*z4 - 15.0) # 3*sqrt(70)*yz*(110*z2 - 143*z4 - 15)/(32*sqrt(pi))
+    dy[:, 59] = 0.93875360317376422*xy*(-66.0*z2 + 143.0*z4 + 3.0) # 9*sqrt(35)*xy*(-66*z2 + 143*z4 + 3)/(32*sqrt(pi))
+    dy[:, 60] = -4.1513246297620823*yz*(3.0*x2 - y2)*(13.0*z2 - 3.0) # -3*sqrt(385)*yz*(3*x2 - y2)*(13*z2 - 3)/(8*sqrt(pi))
+    dy[:, 61] = 10.378311574405206*xy*(x2 - y2)*(13.0*z2 - 1.0) # 15*sqrt(385)*xy*(x2 - y2)*(13*z2 - 1)/(16*sqrt(pi))
+    dy[:, 62] = 15.875763970811402*yz*(10.0*x2*y2 - 5.0*x4 - y4) # 9*sqrt(10010)*yz*(10*x2*y2 - 5*x4 - y4)/(32*sqrt(pi))
+    dy[:, 63] = 9.9002782553443485*xy*(-10.0*x2*y2 + 3.0*x4 + 3.0*y4) # 21*sqrt(715)*xy*(-10*x2*y2 + 3*x4 + 3*y4)/(32*sqrt(pi))
+
+
+def _write_sh_dz(dz, C, m):
+    x, y, z, xy, xz, yz, x2, y2, z2, xyz, x4, y4, z4, x6, y6, z6 = m
+    dz[:, 0] = 0.0 # 0
+    if C <= 1: return
+    dz[:, 1] = 0.0 # 0
+    dz[:, 2] = 0.48860251190291992 # sqrt(3)/(2*sqrt(pi))
+    dz[:, 3] = 0.0 # 0
+    if C <= 2: return
+    dz[:, 4] = 0.0 # 0
+    dz[:, 5] = -1.0925484305920792*y # -sqrt(15)*y/(2*sqrt(pi))
+    dz[:, 6] = 1.8923493915151202*z # 3*sqrt(5)*z/(2*sqrt(pi))
+    dz[:, 7] = -1.0925484305920792*x # -sqrt(15)*x/(2*sqrt(pi))
+    dz[:, 8] = 0.0 # 0
+    if C <= 3: return
+    dz[:, 9] = 0.0 # 0
+    dz[:, 10] = 2.8906114426405538*xy # sqrt(105)*xy/(2*sqrt(pi))
+    dz[:, 11] = -4.5704579946446566*yz # -5*sqrt(42)*yz/(4*sqrt(pi))
+    dz[:, 12] = 5.597644988851731*z2 - 1.1195289977703462 # 3*sqrt(7)*(5*z2 - 1)/(4*sqrt(pi))
+    dz[:, 13] = -4.5704579946446566*xz # -5*sqrt(42)*xz/(4*sqrt(pi))
+    dz[:, 14] = 1.4453057213202769*x2 - 1.4453057213202769*y2 # sqrt(105)*(x2 - y2)/(4*sqrt(pi))
+    dz[:, 15] = 0.0 # 0
+    if C <= 4: return
+    dz[:, 16] = 0.0 # 0
+    dz[:, 17] = 1.7701307697799304*y*(-3.0*x2 + y2) # 3*sqrt(70)*y*(-3*x2 + y2)/(8*sqrt(pi))
+    dz[:, 18] = 13.246445740605839*xy*z # 21*sqrt(5)*xy*z/(2*sqrt(pi))
+    dz[:, 19] = 2.0071396306718676*y*(1.0 - 7.0*z2) # 9*sqrt(10)*y*(1 - 7*z2)/(8*sqrt(pi))
+    dz[:, 20] = 14.809976568128603*pow(z, 3) - 6.3471328149122579*z # (105*z**3 - 45*z)/(4*sqrt(pi))
+    dz[:, 21] = 2.0071396306718676*x*(1.0 - 7.0*z2) # 9*sqrt(10)*x*(1 - 7*z2)/(8*sqrt(pi))
+    dz[:, 22] = 6.6232228703029197*z*(x2 - y2) # 21*sqrt(5)*z*(x2 - y2)/(4*sqrt(pi))
+    dz[:, 23] = 1.7701307697799304*x*(-x2 + 3.0*y2) # 3*sqrt(70)*x*(-x2 + 3*y2)/(8*sqrt(pi))
+    dz[:, 24] = 0.0 # 0
+    if C <= 5: return
+    dz[:, 25] = 0.0 # 0
+    dz[:, 26] = 8.3026492595241645*xy*(x2 - y2) # 3*sqrt(385)*xy*(x2 - y2)/(4*sqrt(pi))
+    dz[:, 27] = 8.8062893898345074*yz*(-3.0*x2 + y2) # 9*sqrt(770)*yz*(-3*x2 + y2)/(16*sqrt(pi))
+    dz[:, 28] = 4.7935367849733241*xy*(9.0*z2 - 1.0) # sqrt(1155)*xy*(9*z2 - 1)/(4*sqrt(pi))
+    dz[:, 29] = 12.682506233479513*yz*(1.0 - 3.0*z2) # 7*sqrt(165)*yz*(1 - 3*z2)/(4*sqrt(pi))
+    dz[:, 30] = -24.559567715218954*z2 + 36.839351572828434*z4 + 1.754254836801354 # 15*sqrt(11)*(-14*z2 + 21*z4 + 1)/(16*sqrt(pi))
+    dz[:, 31] = 12.682506233479513*xz*(1.0 - 3.0*z2) # 7*sqrt(165)*xz*(1 - 3*z2)/(4*sqrt(pi))
+    dz[:, 32] = 2.3967683924866621*(x2 - y2)*(9.0*z2 - 1.0) # sqrt(1155)*(x2 - y2)*(9*z2 - 1)/(8*sqrt(pi))
+    dz[:, 33] = 8.8062893898345074*xz*(-x2 + 3.0*y2) # 9*sqrt(770)*xz*(-x2 + 3*y2)/(16*sqrt(pi))
+    dz[:, 34] = -12.453973889286246*x2*y2 + 2.0756623148810411*x4 + 2.0756623148810411*y4 # 3*sqrt(385)*(-6*x2*y2 + x4 + y4)/(16*sqrt(pi))
+    dz[:, 35] = 0.0 # 0
+    if C <= 6: return
+    dz[:, 36] = 0.0 # 0
+    dz[:, 37] = 2.3666191622317521*y*(10.0*x2*y2 - 5.0*x4 - y4) # 3*sqrt(2002)*y*(10*x2*y2 - 5*x4 - y4)/(32*sqrt(pi))
+    dz[:, 38] = 44.401711264127719*xy*z*(x2 - y2) # 33*sqrt(91)*xy*z*(x2 - y2)/(4*sqrt(pi))
+    dz[:, 39] = -2.7636157785447706*y*(3.0*x2 - y2)*(11.0*z2 - 1.0) # -3*sqrt(2730)*y*(3*x2 - y2)*(11*z2 - 1)/(32*sqrt(pi))
+    dz[:, 40] = 11.054463114179082*xy*z*(11.0*z2 - 3.0) # 3*sqrt(2730)*xy*z*(11*z2 - 3)/(8*sqrt(pi))
+    dz[:, 41] = 2.9131068125936568*y*(18.0*z2 - 33.0*z4 - 1.0) # 5*sqrt(273)*y*(18*z2 - 33*z4 - 1)/(16*sqrt(pi))
+    dz[:, 42] = 2.6699064952403937*z*(-30.0*z2 + 33.0*z4 + 5.0) # 21*sqrt(13)*z*(-30*z2 + 33*z4 + 5)/(16*sqrt(pi))
+    dz[:, 43] = 2.9131068125936568*x*(18.0*z2 - 33.0*z4 - 1.0) # 5*sqrt(273)*x*(18*z2 - 33*z4 - 1)/(16*sqrt(pi))
+    dz[:, 44] = 5.5272315570895412*z*(x2 - y2)*(11.0*z2 - 3.0) # 3*sqrt(2730)*z*(x2 - y2)*(11*z2 - 3)/(16*sqrt(pi))
+    dz[:, 45] = -2.7636157785447706*x*(x2 - 3.0*y2)*(11.0*z2 - 1.0) # -3*sqrt(2730)*x*(x2 - 3*y2)*(11*z2 - 1)/(32*sqrt(pi))
+    dz[:, 46] = 11.10042781603193*z*(-6.0*x2*y2 + x4 + y4) # 33*sqrt(91)*z*(-6*x2*y2 + x4 + y4)/(16*sqrt(pi))
+    dz[:, 47] = 2.3666191622317521*x*(10.0*x2*y2 - x4 - 5.0*y4) # 3*sqrt(2002)*x*(10*x2*y2 - x4 - 5*y4)/(32*sqrt(pi))
+    dz[:, 48] = 0.0 # 0
+    if C <= 7: return
+    dz[:, 49] = 0.0 # 0
+    dz[:, 50] = 5.2919213236038001*xy*(-10.0*x2*y2 + 3.0*x4 + 3.0*y4) # 3*sqrt(10010)*xy*(-10*x2*y2 + 3*x4 + 3*y4)/(32*sqrt(pi))
+    dz[:, 51] = 13.491805046726766*yz*(10.0*x2*y2 - 5.0*x4 - y4) # 39*sqrt(385)*yz*(10*x2*y2 - 5*x4 - y4)/(32*sqrt(pi))
+    dz[:, 52] = 12.453973889286248*xy*(x2 - y2)*(13.0*z2 - 1.0) # 9*sqrt(385)*xy*(x2 - y2)*(13*z2 - 1)/(8*sqrt(pi))
+    dz[:, 53] = -6.8841930899409371*yz*(3.0*x2 - y2)*(13.0*z2 - 3.0) # -33*sqrt(35)*yz*(3*x2 - y2)*(13*z2 - 3)/(16*sqrt(pi))
+    dz[:, 54] = 2.2126634622249131*xy*(-66.0*z2 + 143.0*z4 + 3.0) # 15*sqrt(70)*xy*(-66*z2 + 143*z4 + 3)/(32*sqrt(pi))
+    dz[:, 55] = 1.6259689364853116*yz*(110.0*z2 - 143.0*z4 - 15.0) # 9*sqrt(105)*yz*(110*z2 - 143*z4 - 15)/(32*sqrt(pi))
+    dz[:, 56] = 64.528641681844675*z2 - 236.60501950009714*z4 + 205.05768356675085*z6 - 2.3899496919201733 # 7*sqrt(15)*(135*z2 - 495*z4 + 429*z6 - 5)/(32*sqrt(pi))
+    dz[:, 57] = 1.6259689364853116*xz*(110.0*z2 - 143.0*z4 - 15.0) # 9*sqrt(105)*xz*(110*z2 - 143*z4 - 15)/(32*sqrt(pi))
+    dz[:, 58] = 0.07375544874083044*(x2 - y2)*(143.0*z2*(3.0*z2 - 1.0) + 132.0*z2*(13.0*z2 - 5.0) - 187.0*z2 + 45.0) # sqrt(70)*(x2 - y2)*(143*z2*(3*z2 - 1) + 132*z2*(13*z2 - 5) - 187*z2 + 45)/(64*sqrt(pi))
+    dz[:, 59] = -6.8841930899409371*xz*(x2 - 3.0*y2)*(13.0*z2 - 3.0) # -33*sqrt(35)*xz*(x2 - 3*y2)*(13*z2 - 3)/(16*sqrt(pi))
+    dz[:, 60] = 3.1134934723215619*(13.0*z2 - 1.0)*(-6.0*x2*y2 + x4 + y4) # 9*sqrt(385)*(13*z2 - 1)*(-6*x2*y2 + x4 + y4)/(32*sqrt(pi))
+    dz[:, 61] = 13.491805046726766*xz*(10.0*x2*y2 - x4 - 5.0*y4) # 39*sqrt(385)*xz*(10*x2*y2 - x4 - 5*y4)/(32*sqrt(pi))
+    dz[:, 62] = 39.6894099270285*x2*y4 - 39.6894099270285*x4*y2 + 2.6459606618019*x6 - 2.6459606618019*y6 # 3*sqrt(10010)*(15*x2*y4 - 15*x4*y2 + x6 - y6)/(64*sqrt(pi))
+    dz[:, 63] = 0.0 # 0
+
+
+def sh_encode_forward(inputs, outputs, B, D, C, dy_dx):
+    # inputs: [B, D], float, in [-1, 1]
+    # outputs: [B, C * C], float
+    # dy_dx: [B, D * C * C] or None
+    m = _monomials(inputs)
+
+    _write_sh(outputs, C, m)
+
+    if dy_dx is not None:
+        dy_dx = dy_dx.view(B, D, C * C)
+        _write_sh_dx(dy_dx[:, 0], C, m)
+        _write_sh_dy(dy_dx[:, 1], C, m)
+        _write_sh_dz(dy_dx[:, 2], C, m)
+
+
+def sh_encode_backward(grad, inputs, B, D, C, dy_dx, grad_inputs):
+    # grad: [B, C * C]
+    # dy_dx: [B, D * C * C]
+    # grad_inputs: [B, D]
+    grad_inputs += torch.bmm(dy_dx.view(B, D, C * C), grad.unsqueeze(-1)).squeeze(-1)
@@ -6,10 +6,14 @@ from torch.autograd import Function
 from torch.autograd.function import once_differentiable
 from torch.cuda.amp import custom_bwd, custom_fwd 
 
-try:
-    import _shencoder as _backend
-except ImportError:
-    from .backend import _backend
+if torch.cuda.is_available():
+    try:
+        import _shencoder as _backend
+    except ImportError:
+        from .backend import _backend
+else:
+    # no GPU, fall back to the pure PyTorch implementation (same interface as the CUDA bindings).
+    from . import backend_cpu as _backend
 
 class _sh_encoder(Function):
     @staticmethod
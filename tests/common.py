@@ -0,0 +1,21 @@
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# options of an R2TalkerNeRF small enough for the cpu backends, overridden by kwargs
+def make_opt(**kwargs):
+    opt = argparse.Namespace(
+        test=False, bound=1, min_near=0.05, density_thresh=10, density_thresh_torso=0.01, exp_eye=True, test_train=False,
+        smooth_lips=False, torso=False, cuda_ray=True, ind_num=100, ind_dim=4, ind_dim_torso=8, train_camera=False, att=2,
+        cond_type='idexp', emb=False, asr_model='', torso_shrink=0.8, fix_eye=-1, head_cull=False, mip_levels=4,
+        grid_update_ratio=1, grid_update_conds=1, grid_dtype='float32', bitfield_only=False, torso_reuse_thresh=0,
+        torso_downscale=1, test_batch=1, compile_mlp=False, march_policy='alive', march_n_step=None, march_samples=2**18,
+        dt_gamma=1/256, max_steps=16, T_thresh=1e-4, color_space='srgb', patch_size=1, finetune_lips=False,
+        iters=1000, lambda_amb=0.1,
+    )
+    for k, v in kwargs.items():
+        setattr(opt, k, v)
+    return opt
@@ -0,0 +1,88 @@
+import torch
+import raymarching
+
+from common import make_opt
+from nerf.network import R2TalkerNeRF
+
+
+def make_model(**kwargs):
+    torch.manual_seed(0)
+    model = R2TalkerNeRF(make_opt(**kwargs)).eval()
+    model.aud_features = torch.rand(4, 68, 3) * 2 - 1
+    model.eye_area = torch.rand(4, 1)
+    # the network is empty but for a constant density of 1 everywhere
+    model.density = lambda x, *args, **kwargs: {'sigma': torch.full_like(x[:, 0], 1 / model.density_scale)}
+    return model
+
+
+def test_partial_update_decays_stale_cells():
+    model = make_model(grid_update_ratio=0.5)
+    H3 = model.grid_size ** 3
+
+    # a 16^3 cube (the first 4096 morton indices) is occupied, but never queried by partial updates.
+    # its inner 14^3 cells also stay unqueried after the 3^3 dilation of the queried cells around it.
+    stale = torch.zeros(H3, dtype=torch.bool)
+    stale[:4096] = True
+    density_grid = torch.ones(model.cascade, H3)
+    density_grid[0, stale] = 3
+    model.set_density_grid(density_grid)
+    model.density_bitfield = raymarching.packbits(density_grid, 1.5, model.density_bitfield)
+    model.iter_density = 16 # past the initial full updates
+    model.sample_grid_indices = lambda N: torch.nonzero(~stale).view(1, -1).repeat(model.cascade, 1)
+
+    coords = raymarching.morton3D_invert(torch.arange(4096, dtype=torch.int32)).long() # [4096, 3]
+    inner = ((coords > 0) & (coords < 15)).all(-1) # [4096]
+
+    def stale_bits():
+        bits = torch.stack([(model.density_bitfield >> i) & 1 for i in range(8)], dim=-1).view(-1)[:H3] # morton order
+        return bits[:4096][inner]
+
+    assert stale_bits().all()
+
+    # 3 * 0.95 ** 22 < 1, the density of the queried cells
+    for _ in range(25):
+        model.update_extra_state()
+
+    assert model.get_density_grid()[0, :4096][inner].max() < 1
+    assert not stale_bits().any()
+
+
+def test_uint8_grid_is_stable():
+    model = make_model(grid_dtype='uint8')
+    for _ in range(20):
+        model.update_extra_state()
+
+    # the network does not change, neither may the bitfield once the grid has settled
+    assert model.grid_change_rate < 1e-3
+    assert model.density_grid.dtype == torch.float32
+
+    # checkpoints store uint8 codes, which survive a load and save at inference unchanged
+    state = model.state_dict()
+    assert state['density_grid'].dtype == torch.uint8
+    test_model = make_model(grid_dtype='uint8', test=True)
+    test_model.load_state_dict(state)
+    assert test_model.density_grid.dtype == torch.uint8
+    assert torch.equal(test_model.state_dict()['density_grid'], state['density_grid'])
+
+
+def test_grid_clusters_cover_all_members():
+    model = make_model()
+    F = 40
+    model.aud_features = torch.rand(F, 68, 3) * 2 - 1
+    model.eye_area = torch.arange(F).float().view(F, 1)
+    model.set_density_grid(torch.zeros(model.cascade, model.grid_size ** 3))
+    model.density_bitfield.fill_(255)
+    model.mean_density = model.density_thresh
+
+    # frame i only occupies cell 4096 * i, found by its eye area
+    def query_density_grid(enc_a, eye, S=128):
+        tmp_grid = torch.zeros(model.cascade, model.grid_size ** 3)
+        tmp_grid[0, eye.view(-1).long() * 4096] = 100
+        return tmp_grid
+    model.query_density_grid = query_density_grid
+
+    model.build_grid_clusters(1)
+
+    bitfield = model.grid_clusters['bitfields'][0]
+    bits = torch.stack([(bitfield >> i) & 1 for i in range(8)], dim=-1).view(-1) # morton order
+    assert bits[torch.arange(F) * 4096].all()
@@ -0,0 +1,59 @@
+import numpy as np
+import torch
+
+from common import make_opt
+from nerf.network import R2TalkerNeRF
+from nerf.utils import Trainer, get_rays, get_bg_coords, convert_poses, merge_frames
+
+
+def make_frame(index, yaw, N=32, H=24, W=24):
+    # one collated training frame (batch size 1) with N sampled rays
+    c, s = np.cos(yaw), np.sin(yaw)
+    pose = torch.eye(4)
+    pose[:3, :3] = torch.tensor([[c, 0, s], [0, 1, 0], [-s, 0, c]], dtype=torch.float32) @ torch.tensor([[1., 0, 0], [0, -1, 0], [0, 0, -1]])
+    pose[:3, 3] = torch.tensor([1.6 * s, 0, 1.6 * c])
+    pose = pose.unsqueeze(0)
+    rays = get_rays(pose, np.array([1.2 * W, 1.2 * W, W / 2, H / 2]), H, W, N)
+    inds = rays['inds']
+    return {
+        'rays_o': rays['rays_o'], 'rays_d': rays['rays_d'],
+        'bg_coords': torch.gather(get_bg_coords(H, W, 'cpu'), 1, torch.stack(2 * [inds], -1)),
+        'poses': convert_poses(pose), 'poses_matrix': pose,
+        'face_mask': torch.ones(1, N, dtype=torch.bool),
+        'eye': torch.tensor([[0.25]]), 'auds': torch.rand(5, 68, 3) * 2 - 1, 'index': [index],
+        'bg_color': torch.rand(1, N, 3), 'bg_torso_color': torch.rand(1, N, 3), 'images': torch.rand(1, N, 3),
+    }
+
+
+def make_trainer(opt):
+    torch.manual_seed(0)
+    model = R2TalkerNeRF(opt)
+    with torch.no_grad():
+        model.density_grid_torso.fill_(1.0) # every pixel is torso
+    model.train()
+    # only the attributes train_step needs, the full Trainer sets up a workspace
+    trainer = Trainer.__new__(Trainer)
+    trainer.opt = opt
+    trainer.model = model
+    trainer.criterion = torch.nn.MSELoss(reduction='none')
+    trainer.global_step = 1
+    trainer.flip_finetune_lips = False
+    trainer.log_ptr = None
+    return trainer
+
+
+def test_torso_train_step_multi_frame():
+    opt = make_opt(torso=True)
+    trainer = make_trainer(opt)
+
+    for B in (1, 2):
+        datas = [make_frame(3 + b, 0.1 - 0.2 * b) for b in range(B)]
+        data = merge_frames(datas) if B > 1 else datas[0]
+        if B > 1:
+            data['bg_coords'] = torch.cat([d['bg_coords'] for d in datas], dim=1)
+
+        pred_rgb, rgb, loss = trainer.train_step(data)
+
+        assert pred_rgb.shape == rgb.shape == (B, 32, 3)
+        assert torch.isfinite(loss)
+        loss.backward()